@@ -5,8 +5,6 @@ from pathlib import Path
 # This makes sure Alembic can find your files in the current folder
 sys.path.append(str(Path(__file__).parent.parent))
 
-from database import Base
-
 sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), '..')))
 from juniper_cfg import models # Important! This registers Device, MacTable, etc.
 
@@ -0,0 +1,36 @@
+"""job blobs
+
+Revision ID: 9c3d5f1e8a27
+Revises: e4b9a6f27c15
+Create Date: 2026-10-18 14:02:11.418630
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c3d5f1e8a27'
+down_revision: Union[str, Sequence[str], None] = 'e4b9a6f27c15'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('job_blobs',
+    sa.Column('id', sa.String(length=32), nullable=False),
+    sa.Column('payload', sa.LargeBinary(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_job_blobs_expires_at'), 'job_blobs', ['expires_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_job_blobs_expires_at'), table_name='job_blobs')
+    op.drop_table('job_blobs')
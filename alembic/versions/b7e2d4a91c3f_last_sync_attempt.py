@@ -0,0 +1,28 @@
+"""last sync attempt
+
+Revision ID: b7e2d4a91c3f
+Revises: 9c3d5f1e8a27
+Create Date: 2026-10-18 16:40:27.305118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e2d4a91c3f'
+down_revision: Union[str, Sequence[str], None] = '9c3d5f1e8a27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('devices', sa.Column('last_sync_attempt', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('devices', 'last_sync_attempt')
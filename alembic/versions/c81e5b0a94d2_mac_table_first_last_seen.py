@@ -0,0 +1,46 @@
+"""mac table first/last seen
+
+Revision ID: c81e5b0a94d2
+Revises: a3f1c29d7b40
+Create Date: 2026-10-18 11:03:27.880412
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c81e5b0a94d2'
+down_revision: Union[str, Sequence[str], None] = 'a3f1c29d7b40'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('mac_table', sa.Column('first_seen', sa.DateTime(), server_default=sa.text('now()'), nullable=True))
+    op.add_column('mac_table', sa.Column('last_seen', sa.DateTime(), server_default=sa.text('now()'), nullable=True))
+    # Full replaces could leave the same MAC/VLAN twice on a device, keep the oldest row
+    op.execute("""
+        DELETE FROM mac_table a
+        USING mac_table b
+        WHERE a.device_id = b.device_id
+          AND a.address = b.address
+          AND a.vlan_id = b.vlan_id
+          AND a.id > b.id
+    """)
+    op.create_unique_constraint('uq_mac_device_address_vlan', 'mac_table', ['device_id', 'address', 'vlan_id'])
+    # The unique index starts with device_id, the plain one is redundant now
+    op.drop_index(op.f('ix_mac_table_device_id'), table_name='mac_table')
+    op.create_index(op.f('ix_mac_table_address'), 'mac_table', ['address'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_mac_table_address'), table_name='mac_table')
+    op.create_index(op.f('ix_mac_table_device_id'), 'mac_table', ['device_id'], unique=False)
+    op.drop_constraint('uq_mac_device_address_vlan', 'mac_table', type_='unique')
+    op.drop_column('mac_table', 'last_seen')
+    op.drop_column('mac_table', 'first_seen')
@@ -0,0 +1,36 @@
+"""unique device vlan
+
+Revision ID: e4b9a6f27c15
+Revises: 5e07d4b8c913
+Create Date: 2026-10-18 12:21:55.640193
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4b9a6f27c15'
+down_revision: Union[str, Sequence[str], None] = '5e07d4b8c913'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Concurrent syncs could insert the same vlan twice, keep the oldest row
+    op.execute("""
+        DELETE FROM vlans a
+        USING vlans b
+        WHERE a.device_id = b.device_id
+          AND a.vlan_id = b.vlan_id
+          AND a.id > b.id
+    """)
+    op.create_unique_constraint('uq_device_vlan', 'vlans', ['device_id', 'vlan_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_constraint('uq_device_vlan', 'vlans', type_='unique')
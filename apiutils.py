@@ -1,11 +1,42 @@
 from sqlalchemy.sql._elements_constructors import bindparam
 from .models import *
-from .database import SessionLocal
-from sqlalchemy import update
+from .database import SessionLocal, JobSession
+from sqlalchemy import update, values, column, String
+from sqlalchemy.dialects.postgresql import insert
+
+
+def interface_tagness_update(device_id: int, interface_list: list):
+    """
+    Builds a single set-based UPDATE eth_interfaces ... FROM (VALUES ...) that sets the
+    tagness of every interface in interface_list, one round-trip whatever the port count.
+    Returns None for an empty list. If an interface is listed twice the last one wins.
+    """
+    tagness = {iface["interface_name"]: iface["interface_tagness"] for iface in interface_list}
+    if not tagness:
+        return None
+
+    rows = values(
+        column("interface_name", String),
+        column("interface_tagness", String),
+        name="tagness"
+    ).data(list(tagness.items()))
+
+    return (
+        update(EthInterfaces)
+        .where(
+            EthInterfaces.device_id == device_id,
+            EthInterfaces.interface_name == rows.c.interface_name
+        )
+        .values(interface_tagness=rows.c.interface_tagness)
+        #nothing to sync in the session, skips the RETURNING the ORM would add
+        .execution_options(synchronize_session=False)
+    )
 
 class APIUtils:
-    def __init__(self):
-        self.db = SessionLocal()
+    @property
+    def db(self):
+        #Session of the current job (thread), not one session for the life of the process
+        return JobSession()
 
     def device_id_to_ip(self, device_id: int):
         """
@@ -72,17 +103,38 @@ class APIUtils:
         
         return device
 
-    def update_device_vlans_db(self,device_id: int, vlan_diff: list):
+    def update_device_vlans_db(self,device_id: int, vlans: list):
         """
-        We take device_id and vlan_diff as input and we update the vlans of the device on DB
+        We take device_id and a list of {'vlan_id': 100, 'vlan_name': 'auto-vlan'} as input
+        and add the vlans missing on DB in one INSERT ... ON CONFLICT DO NOTHING.
+        The DB does the diff against uq_device_vlan, so the list can be the full live list
+        and concurrent syncs of the same device can't duplicate rows.
+        Existing rows are left alone, names included (DB is the source of truth).
+        Returns the number of vlans added.
         """
-        #Add new vlans
-        for vlan in vlan_diff:
-            new_vlan = VLANs(device_id=device_id, vlan_id=vlan['vlan_id'], vlan_name=vlan['vlan_name'])
-            self.db.add(new_vlan)
-        self.db.commit()
+        rows = {}
+        for vlan in vlans:
+            rows.setdefault(int(vlan['vlan_id']), {
+                "device_id": device_id,
+                "vlan_id": int(vlan['vlan_id']),
+                "vlan_name": vlan['vlan_name'],
+            })
+        if not rows:
+            return 0
+
+        stmt = (
+            insert(VLANs)
+            .values(list(rows.values()))
+            .on_conflict_do_nothing(constraint="uq_device_vlan")
+        )
+        try:
+            result = self.db.execute(stmt)
+            self.db.commit()
+        except Exception as e:
+            self.db.rollback()
+            raise e
 
-        return True
+        return result.rowcount
     
 
     def update_db_interface_tagness(self,device_id: int, interface_list: list):
@@ -90,19 +142,11 @@ class APIUtils:
         interface_list is a list of dictionary containing interface name and its tagness 
         and we update the existing interface list eth_interfaces
         interface_list = [{"interface_name": "ge-0/0/20", "interface_tagness": "tagged"}...]
+        One UPDATE ... FROM (VALUES ...) for the whole list, see interface_tagness_update.
         """
-
-        for iface in interface_list:
-            update_interface = (
-                             update(EthInterfaces)
-                              .where(
-                                   EthInterfaces.device_id==device_id,
-                                   EthInterfaces.interface_name == iface["interface_name"]
-                              )
-                              .values(interface_tagness=iface["interface_tagness"])
-                              )
-            self.db.execute(update_interface)
-
+        stmt = interface_tagness_update(device_id, interface_list)
+        if stmt is not None:
+            self.db.execute(stmt)
         self.db.commit()    
 
 
@@ -1,10 +1,16 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from jose import jwt, JWTError
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer
 from fastapi import Depends, HTTPException, status
 from sqlalchemy.orm import Session
+from sqlalchemy import event, inspect, select
 from . import models,database
+from .cache import TTLCache, MISSING, invalidation_bus
+from prometheus_client import Histogram
 from dotenv import load_dotenv
 import os
 
@@ -19,6 +25,10 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
 REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS"))
+#How long a user looked up by get_current_user_async is trusted without asking the DB
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "30"))
+#bcrypt runs at most this many at a time per API process, the rest queue up
+PASSWORD_HASH_CONCURRENCY = int(os.getenv("PASSWORD_HASH_CONCURRENCY", "4"))
 
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -30,6 +40,26 @@ def hash_password(password: str):
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
+# bcrypt is deliberately slow (~100s of ms), on the event loop it stalls every other
+# request of the worker. The async versions run it in a small dedicated pool so a
+# login burst only queues logins.
+PASSWORD_HASH_LATENCY = Histogram('password_hash_duration_seconds',
+                                  'bcrypt hash/verify time, queueing for the executor included', ['op'])
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_CONCURRENCY, thread_name_prefix="bcrypt")
+
+async def _run_password_op(op, func, *args):
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_password_executor, func, *args)
+    finally:
+        PASSWORD_HASH_LATENCY.labels(op=op).observe(time.perf_counter() - started)
+
+async def verify_password_async(plain_password, hashed_password):
+    return await _run_password_op("verify", verify_password, plain_password, hashed_password)
+
+async def hash_password_async(password: str):
+    return await _run_password_op("hash", hash_password, password)
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -68,3 +98,70 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     if user is None:
         raise credentials_exception
     return user
+
+
+# --- Async auth path ---
+# JWT subject -> detached User. Changes to a user made through the ORM (deactivation,
+# deletion, password change) evict it in every API process; anything done behind
+# the ORM's back is picked up after USER_CACHE_TTL at the latest.
+user_cache = TTLCache("user", USER_CACHE_TTL, maxsize=5000)
+
+def _on_user_invalidate(usernames):
+    if usernames is None:
+        user_cache.clear()
+    else:
+        user_cache.delete(*usernames)
+
+invalidation_bus.subscribe("user", _on_user_invalidate)
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _user_changed(mapper, connection, target):
+    session = inspect(target).session
+    if session is not None:
+        session.info.setdefault("user_cache_dirty", set()).add(target.username)
+
+#Evict after the commit, at flush time a concurrent request could cache the old row again
+@event.listens_for(Session, "after_commit")
+def _publish_user_invalidations(session):
+    usernames = session.info.pop("user_cache_dirty", None)
+    if usernames:
+        invalidation_bus.publish("user", sorted(usernames))
+
+@event.listens_for(Session, "after_rollback")
+def _forget_user_invalidations(session):
+    session.info.pop("user_cache_dirty", None)
+
+async def get_current_user_async(token: str = Depends(oauth2_scheme)):
+    """
+    Same contract as get_current_user without touching the sync engine: the JWT is
+    decoded and the user comes from user_cache, the async DB is only queried on a miss.
+    Inactive users are rejected and never cached.
+    """
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        username: str = payload.get("sub")
+        if username is None:
+            raise credentials_exception
+    except JWTError:
+        raise credentials_exception
+
+    user = user_cache.get(username)
+    if user is MISSING:
+        async with database.AsyncSessionLocal() as db:
+            result = await db.execute(select(models.User).where(models.User.username == username))
+            user = result.scalar_one_or_none()
+            if user is not None:
+                #Detached with its attributes loaded (expire_on_commit=False), safe to share
+                db.expunge(user)
+        if user is None:
+            raise credentials_exception
+        if not user.is_active:
+            raise HTTPException(status_code=400, detail="Inactive user")
+        user_cache.set(username, user)
+    return user
@@ -0,0 +1,274 @@
+import json
+import logging
+import os
+import time
+import uuid
+
+from dotenv import load_dotenv
+from jnpr.junos.utils.config import Config
+from prometheus_client import Histogram
+
+from juniper_cfg.ratelimit import SessionRateLimited
+
+load_dotenv()
+
+logger = logging.getLogger("ConfigBatcher")
+
+#How long the first change of a batch waits for others before the commit
+CONFIG_BATCH_WINDOW = float(os.getenv("CONFIG_BATCH_WINDOW", "2.0"))
+#A full batch is committed without waiting for the window
+CONFIG_BATCH_MAX = int(os.getenv("CONFIG_BATCH_MAX", "100"))
+#How long a job waits for the outcome of its change
+CONFIG_BATCH_WAIT_TIMEOUT = int(os.getenv("CONFIG_BATCH_WAIT_TIMEOUT", "600"))
+#Lease of the batch leader, must cover one load + commit of a full batch
+CONFIG_BATCH_LEASE = int(os.getenv("CONFIG_BATCH_LEASE", "300"))
+CONFIG_BATCH_TTL = 24 * 3600
+
+#RQ timeout of a configuration job: it may wait the whole CONFIG_BATCH_WAIT_TIMEOUT
+#for its outcome and then lead one commit
+CONFIG_JOB_TIMEOUT = CONFIG_BATCH_WAIT_TIMEOUT + CONFIG_BATCH_LEASE + 60
+
+BATCH_SIZE = Histogram('config_batch_size', 'Changes applied per commit',
+                       buckets=(1, 2, 5, 10, 20, 50, 100, 200))
+
+#Deletes the leader key only if it still holds our token
+_RELEASE_LEADER = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+#Takes a change out of the pending list and drops its commands. A leader that
+#already took it keeps its copy, one that died with it won't find it to requeue.
+_WITHDRAW = """
+local removed = redis.call('LREM', KEYS[1], 0, ARGV[1])
+redis.call('DEL', KEYS[2])
+return removed
+"""
+
+
+class ConfigBatcher:
+    """
+    Coalesces set-command changes for the same device into one candidate load
+    and one commit. Every change is identified by the id of the job that asked
+    for it; whichever job of a device runs first becomes the leader, waits up
+    to CONFIG_BATCH_WINDOW for more changes, commits them together and hands
+    the per-change outcome back to every originating job through Redis.
+    """
+
+    def __init__(self, redis_conn, window=CONFIG_BATCH_WINDOW, max_batch=CONFIG_BATCH_MAX,
+                 wait_timeout=CONFIG_BATCH_WAIT_TIMEOUT, lease=CONFIG_BATCH_LEASE):
+        self.r = redis_conn
+        self.window = window
+        self.max_batch = max_batch
+        self.wait_timeout = wait_timeout
+        self.lease = lease
+        self._release_leader = redis_conn.register_script(_RELEASE_LEADER)
+        self._withdraw = redis_conn.register_script(_WITHDRAW)
+
+    # ------------------------------------------------------------------
+    # Redis keys
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _pending_key(device_ip):
+        return f"cfg_batch:{device_ip}:pending"
+
+    @staticmethod
+    def _leader_key(device_ip):
+        return f"cfg_batch:{device_ip}:leader"
+
+    @staticmethod
+    def _change_key(change_id):
+        return f"cfg_batch:change:{change_id}"
+
+    @staticmethod
+    def _result_key(change_id):
+        return f"cfg_batch:result:{change_id}"
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+    def submit(self, device_ip: str, change_id: str, commands: str, comment: str):
+        """
+        Queues a change for the device. Submitting the same change_id twice is a no-op,
+        so the API can submit at enqueue time and the job again when it runs.
+        """
+        change = json.dumps({"commands": commands, "comment": comment, "submitted_at": time.time()})
+        if not self.r.set(self._change_key(change_id), change, nx=True, ex=CONFIG_BATCH_TTL):
+            return False
+        self.r.rpush(self._pending_key(device_ip), change_id)
+        return True
+
+    def apply(self, device_ip: str, change_id: str, session_factory):
+        """
+        Blocks until the change is committed (by us or by another job) and returns its outcome.
+        session_factory() must return a context manager yielding an open Device.
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            outcome = self._outcome(change_id)
+            if outcome is not None:
+                return outcome
+
+            token = str(uuid.uuid4())
+            if self.r.set(self._leader_key(device_ip), token, nx=True, ex=self.lease):
+                try:
+                    self._lead(device_ip, change_id, session_factory)
+                finally:
+                    self._release(device_ip, token)
+                continue
+
+            #Another job is committing for this device, our change may be in its batch
+            item = self.r.blpop(self._result_key(change_id), timeout=1)
+            if item is not None:
+                self.r.rpush(self._result_key(change_id), item[1])
+                return json.loads(item[1])
+
+        if self.withdraw(device_ip, change_id):
+            return {"status": "Error", "error": f"Not committed after {self.wait_timeout}s, change withdrawn"}
+        return {"status": "Error", "error": f"No commit outcome after {self.wait_timeout}s"}
+
+    def withdraw(self, device_ip: str, change_id: str):
+        """
+        Withdraws a change its job will not wait for, so a later leader doesn't
+        commit it. Returns True if the change was still pending; a change a
+        leader already took is committed or failed with that leader's batch.
+        """
+        return self._withdraw(keys=[self._pending_key(device_ip), self._change_key(change_id)],
+                              args=[change_id]) > 0
+
+    # ------------------------------------------------------------------
+    # Internals
+    # ------------------------------------------------------------------
+    def _outcome(self, change_id):
+        raw = self.r.lindex(self._result_key(change_id), 0)
+        return json.loads(raw) if raw is not None else None
+
+    def _release(self, device_ip, token):
+        self._release_leader(keys=[self._leader_key(device_ip)], args=[token])
+
+    def _wait_for_window(self, device_ip):
+        pending_key = self._pending_key(device_ip)
+        oldest = self.r.lindex(pending_key, 0)
+        if oldest is None:
+            return
+        change = self.r.get(self._change_key(oldest.decode()))
+        submitted_at = json.loads(change)["submitted_at"] if change else time.time()
+        while time.time() < submitted_at + self.window:
+            if self.r.llen(pending_key) >= self.max_batch:
+                return
+            time.sleep(0.05)
+
+    def _take_batch(self, device_ip):
+        pending_key = self._pending_key(device_ip)
+        with self.r.pipeline() as pipe:
+            pipe.lrange(pending_key, 0, self.max_batch - 1)
+            pipe.ltrim(pending_key, self.max_batch, -1)
+            change_ids = [change_id.decode() for change_id in pipe.execute()[0]]
+
+        changes = []
+        for change_id in change_ids:
+            raw = self.r.get(self._change_key(change_id))
+            if raw is None:
+                self._publish(change_id, {"status": "Error", "error": "Change expired before it was applied"})
+                continue
+            changes.append((change_id, json.loads(raw)))
+        return changes
+
+    def _lead(self, device_ip, change_id, session_factory):
+        #We hold the leader lock, so a change of ours that is neither pending nor
+        #answered was taken by a leader that died mid-commit. Queue it again.
+        if (self._outcome(change_id) is None and self.r.exists(self._change_key(change_id))
+                and self.r.lpos(self._pending_key(device_ip), change_id) is None):
+            self.r.lpush(self._pending_key(device_ip), change_id)
+        self._wait_for_window(device_ip)
+        changes = self._take_batch(device_ip)
+        if not changes:
+            return
+
+        batch_id = str(uuid.uuid4())
+        logger.info(f"Committing {len(changes)} changes on {device_ip} in batch {batch_id}")
+        try:
+            with session_factory() as dev:
+                outcomes = self._commit(dev, changes)
+        except SessionRateLimited:
+            #Nothing was loaded, the changes wait for the next leader
+            with self.r.pipeline() as pipe:
+                pipe.lpush(self._pending_key(device_ip), *reversed([cid for cid, _ in changes]))
+                pipe.execute()
+            raise
+        except Exception as e:
+            outcomes = {cid: {"status": "Error", "error": f"Device session failed: {e}"} for cid, _ in changes}
+
+        committed = sum(1 for outcome in outcomes.values() if outcome["status"] == "Success")
+        BATCH_SIZE.observe(committed)
+        for cid, outcome in outcomes.items():
+            outcome.update({"batch_id": batch_id, "batch_size": len(changes), "committed_by": change_id})
+            self._publish(cid, outcome)
+
+    def _commit(self, dev, changes):
+        """
+        Loads every change into the candidate and commits once. A change that fails
+        to load is dropped and the rest is reloaded; if the combined commit fails we
+        fall back to one commit per change so only the bad ones fail.
+        """
+        outcomes = {}
+        remaining = list(changes)
+        cu = Config(dev)
+
+        while remaining:
+            failed = None
+            for cid, change in remaining:
+                try:
+                    cu.load(change["commands"], format="set")
+                except Exception as e:
+                    failed = cid
+                    outcomes[cid] = {"status": "Error", "error": f"Load failed: {e}"}
+                    break
+            if failed:
+                self._rollback(cu)
+                remaining = [(cid, change) for cid, change in remaining if cid != failed]
+                continue
+
+            comment = remaining[0][1]["comment"] if len(remaining) == 1 else \
+                f"Automation: batch of {len(remaining)} changes"
+            try:
+                cu.commit(comment=comment)
+                for cid, _ in remaining:
+                    outcomes[cid] = {"status": "Success"}
+                return outcomes
+            except Exception as e:
+                self._rollback(cu)
+                if len(remaining) == 1:
+                    outcomes[remaining[0][0]] = {"status": "Error", "error": f"Commit failed: {e}"}
+                    return outcomes
+                logger.warning(f"Batch commit failed ({e}), committing changes one by one")
+                for cid, change in remaining:
+                    outcomes[cid] = self._commit_single(cu, change)
+                return outcomes
+
+        return outcomes
+
+    def _commit_single(self, cu, change):
+        try:
+            cu.load(change["commands"], format="set")
+            cu.commit(comment=change["comment"])
+            return {"status": "Success"}
+        except Exception as e:
+            self._rollback(cu)
+            return {"status": "Error", "error": str(e)}
+
+    @staticmethod
+    def _rollback(cu):
+        try:
+            cu.rollback(0)
+        except Exception as e:
+            logger.error(f"Rollback of the candidate failed: {e}")
+
+    def _publish(self, change_id, outcome):
+        with self.r.pipeline() as pipe:
+            pipe.rpush(self._result_key(change_id), json.dumps(outcome))
+            pipe.expire(self._result_key(change_id), CONFIG_BATCH_TTL)
+            pipe.delete(self._change_key(change_id))
+            pipe.execute()
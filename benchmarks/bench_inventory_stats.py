@@ -0,0 +1,140 @@
+"""
+/devices/inventory/stats: the six aggregate queries it used to run vs the one
+GROUPING SETS query of invstats, and what a cached request costs instead.
+Needs DATABASE_URL pointing at a migrated database. The devices are inserted
+in a transaction that is rolled back, the database is left untouched.
+
+    PYTHONPATH=.. python benchmarks/bench_inventory_stats.py --devices 1000 50000 --repeat 20
+"""
+import argparse
+import json
+import random
+import time
+
+from sqlalchemy import event, func, insert, select
+
+from juniper_cfg.cache import TTLCache
+from juniper_cfg.database import SessionLocal, engine
+from juniper_cfg.invstats import fold_stats, stats_stmt
+from juniper_cfg.models import DeviceNet
+
+VENDORS = {"juniper": ["ex2300", "ex3400", "ex4300", "qfx5120", "mx204", "srx345"],
+           "cisco": ["c9200", "c9300", "c9500", "isr4331"],
+           "arista": ["7050sx", "7280r"]}
+OS_VERSIONS = [f"{major}.{minor}R{patch}" for major in (20, 21, 22, 23) for minor in (1, 2, 4) for patch in (1, 3)]
+
+
+class RoundTrips:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+def six_queries(db):
+    #The endpoint before invstats
+    stats = {"total_devices": db.execute(select(func.count(DeviceNet.id))).scalar() or 0,
+             "global": {}, "os_by_vendor": {}}
+    status_map = dict(db.execute(select(DeviceNet.sync_status, func.count(DeviceNet.id))
+                                 .group_by(DeviceNet.sync_status)).all())
+    stats.update(operational_count=status_map.get("synced", 0), failed_count=status_map.get("failed", 0),
+                 pending_count=status_map.get("pending", 0))
+    for key, column in {"type": DeviceNet.type, "model": DeviceNet.model, "vendor": DeviceNet.vendor}.items():
+        rows = db.execute(select(column, func.count(column)).group_by(column)).all()
+        stats["global"][key] = {(row[0] or "Unknown"): row[1] for row in rows}
+    for vendor, os_ver, count in db.execute(select(DeviceNet.vendor, DeviceNet.os_version, func.count(DeviceNet.id))
+                                            .group_by(DeviceNet.vendor, DeviceNet.os_version)).all():
+        stats["os_by_vendor"].setdefault(vendor or "Unknown", {})[os_ver or "Unknown"] = count
+    return stats
+
+
+def grouping_sets(db):
+    return fold_stats(db.execute(stats_stmt()).all())
+
+
+def fake_devices(count):
+    rnd = random.Random(count)
+    rows = []
+    for i in range(count):
+        vendor = rnd.choice(list(VENDORS))
+        rows.append({
+            "hostname": f"bench-{i}", "ip_address": f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}",
+            "type": rnd.choice(["switch", "router", "firewall"]), "vendor": vendor,
+            "model": rnd.choice(VENDORS[vendor]), "os_version": rnd.choice(OS_VERSIONS),
+            "sync_status": rnd.choices(["synced", "failed", "pending"], weights=[85, 5, 10])[0],
+            "site": f"site-{rnd.randrange(200)}", "region": f"region-{rnd.randrange(8)}",
+        })
+    return rows
+
+
+def timed(method, db, repeat):
+    trips = RoundTrips()
+    event.listen(engine, "before_cursor_execute", trips)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = method(db)
+    elapsed = (time.perf_counter() - started) / repeat
+    event.remove(engine, "before_cursor_execute", trips)
+    return result, elapsed, trips.count // repeat
+
+
+def cached(stats, repeat, redis_conn):
+    local = TTLCache("bench_inventory_stats", 60, maxsize=1)
+    local.set("invstats", stats)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        local.get("invstats")
+    timings = [("cached, process", (time.perf_counter() - started) / repeat)]
+    if redis_conn is not None:
+        key = f"bench:invstats:{time.time_ns()}"
+        redis_conn.set(key, json.dumps(stats), ex=60)
+        started = time.perf_counter()
+        for _ in range(repeat):
+            json.loads(redis_conn.get(key))
+        timings.append(("cached, redis", (time.perf_counter() - started) / repeat))
+        redis_conn.delete(key)
+    return timings
+
+
+def run(devices, repeat, redis_conn):
+    db = SessionLocal()
+    try:
+        rows = fake_devices(devices)
+        for i in range(0, len(rows), 5000):
+            db.execute(insert(DeviceNet), rows[i:i + 5000])
+        db.execute(select(func.count()).select_from(DeviceNet))  # flush + warm up
+
+        old, old_s, old_trips = timed(six_queries, db, repeat)
+        new, new_s, new_trips = timed(grouping_sets, db, repeat)
+        assert old == new, "GROUPING SETS stats differ from the six queries"
+
+        total = new["total_devices"]
+        print(f"{'six queries':<18} {total:>8} {old_trips:>11} {old_s * 1000:>10.2f}")
+        print(f"{'grouping sets':<18} {total:>8} {new_trips:>11} {new_s * 1000:>10.2f}")
+        for name, elapsed in cached(new, repeat, redis_conn):
+            print(f"{name:<18} {total:>8} {0:>11} {elapsed * 1000:>10.3f}")
+    finally:
+        db.rollback()
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, nargs="+", default=[1000, 50000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--redis-url", help="also time a cache hit served from this Redis")
+    args = parser.parse_args()
+
+    redis_conn = None
+    if args.redis_url:
+        from redis import Redis
+        redis_conn = Redis.from_url(args.redis_url)
+
+    print(f"{'method':<18} {'devices':>8} {'round-trips':>11} {'ms':>10}")
+    for devices in args.devices:
+        run(devices, args.repeat, redis_conn)
+
+
+if __name__ == "__main__":
+    main()
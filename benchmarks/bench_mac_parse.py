@@ -0,0 +1,93 @@
+"""
+MAC table parsing: full tree + xpath (old fetch_mac_table_job) vs the
+incremental parse in xmlstream. Every run happens in a fresh process so
+ru_maxrss is the peak of that method alone.
+
+    PYTHONPATH=.. python benchmarks/bench_mac_parse.py --entries 10000 100000 200000
+"""
+import argparse
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from lxml import etree
+
+from juniper_cfg.xmlstream import iter_mac_chunks
+
+ENTRY = ("<l2ng-mac-entry><l2ng-l2-mac-vlan-name>vlan-{vlan}</l2ng-l2-mac-vlan-name>"
+         "<l2ng-l2-mac-address>{mac}</l2ng-l2-mac-address>"
+         "<l2ng-l2-mac-flags>D</l2ng-l2-mac-flags><l2ng-l2-mac-age>-</l2ng-l2-mac-age>"
+         "<l2ng-l2-mac-logical-interface>ge-0/0/{port}.0</l2ng-l2-mac-logical-interface>"
+         "<l2ng-l2-mac-fwd-next-hop>0</l2ng-l2-mac-fwd-next-hop><l2ng-l2-mac-rtr-id>0</l2ng-l2-mac-rtr-id>"
+         "</l2ng-mac-entry>")
+
+
+def build_reply(entries):
+    body = "".join(
+        ENTRY.format(vlan=i % 200, mac=":".join(f"{(i >> s) & 0xff:02x}" for s in (40, 32, 24, 16, 8, 0)), port=i % 48)
+        for i in range(entries)
+    )
+    return ('<rpc-reply xmlns="urn:ietf:params:xml:ns:netconf:base:1.0" xmlns:junos="http://xml.juniper.net/junos/21.4R0/junos">'
+            '<l2ng-l2ald-rtb-macdb xmlns="http://xml.juniper.net/junos/21.4R0/junos-l2al"><l2ng-l2ald-mac-entry-vlan>'
+            f'{body}</l2ng-l2ald-mac-entry-vlan></l2ng-l2ald-rtb-macdb></rpc-reply>')
+
+
+def parse_tree(raw):
+    #What dev.rpc + the xpath loop did: parse, strip namespaces (PyEZ copies the tree), list of dicts
+    tree = etree.fromstring(raw.encode(), etree.XMLParser(huge_tree=True))
+    for element in tree.iter():
+        if isinstance(element.tag, str):
+            element.tag = etree.QName(element).localname
+    results = []
+    for entry in tree.xpath('.//l2ng-mac-entry'):
+        results.append({
+            "vlan": entry.findtext('l2ng-l2-mac-vlan-name', default="N/A").strip(),
+            "mac": entry.findtext('l2ng-l2-mac-address', default="N/A").strip(),
+            "interface": entry.findtext('l2ng-l2-mac-logical-interface', default="N/A").strip(),
+        })
+    return len(results)
+
+
+def parse_stream(raw):
+    #Chunks go to a sink and are dropped, as they would be with a DB sink
+    return sum(len(chunk) for chunk in iter_mac_chunks(raw))
+
+
+def run_one(method, path):
+    #Read from a file, building the reply here would set the peak before we measure
+    with open(path) as f:
+        raw = f.read()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    count = {"tree": parse_tree, "stream": parse_stream}[method](raw)
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{method},{count},{count},{elapsed:.3f},{(peak - baseline) / 1024:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, nargs="+", default=[10000, 100000, 200000])
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_one(*args.child)
+        return
+
+    print(f"{'method':<8} {'entries':>8} {'parsed':>8} {'seconds':>8} {'extra MB':>9}")
+    for entries in args.entries:
+        with tempfile.NamedTemporaryFile("w", suffix=".xml") as reply:
+            reply.write(build_reply(entries))
+            reply.flush()
+            for method in ("tree", "stream"):
+                out = subprocess.run([sys.executable, __file__, "--child", method, reply.name],
+                                     capture_output=True, text=True, check=True).stdout.strip()
+                method_, entries_, count, elapsed, mb = out.split(",")
+                print(f"{method_:<8} {entries_:>8} {count:>8} {elapsed:>8} {mb:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Redis footprint of job results: RQ's default pickle vs JunoxSerializer.
+Results are stored the way RQ does (base64 in the rq:results stream), sized
+with len() or, with --redis-url, with MEMORY USAGE on a real Redis (keys are
+deleted afterwards). Payloads look like the mac_table / interface_list results.
+
+    PYTHONPATH=.. python benchmarks/bench_result_serializer.py --macs 1000 10000 50000 \\
+        --redis-url redis://localhost:6379/15
+
+Results above JOB_RESULT_INLINE_MAX would go to job_blobs, Redis then keeps a
+reference only: the "offloaded" column. Nothing is written to Postgres here.
+"""
+import argparse
+import pickle
+import sys
+import time
+from base64 import b64encode
+
+from juniper_cfg import serializer
+from juniper_cfg.serializer import JunoxSerializer
+
+REFERENCE_SIZE = len(b64encode(b"JXR" + b"0" * 32))
+
+
+def mac_table(entries):
+    return {"mac_table": [
+        {"vlan": f"vlan-{i % 200}", "mac": ":".join(f"{(i >> s) & 0xff:02x}" for s in (40, 32, 24, 16, 8, 0)),
+         "interface": f"ge-0/0/{i % 48}.0"}
+        for i in range(entries)
+    ]}
+
+
+def interface_list(ports):
+    #EthPortTable.items(): [(name, [(field, value)...])...]
+    return {"interface_list": [
+        (f"ge-0/0/{i}", [("oper", "up"), ("admin", "up"), ("description", f"access port {i}"),
+                         ("mtu", "1514"), ("link_mode", "Full-duplex"), ("macaddr", f"2c:6b:f5:00:{i >> 8:02x}:{i & 255:02x}"),
+                         ("rx_bytes", str(i * 1000)), ("tx_bytes", str(i * 2000))])
+        for i in range(ports)
+    ]}
+
+
+def stored_size(value, dumps, redis_conn):
+    started = time.perf_counter()
+    field = b64encode(dumps(value))
+    elapsed = time.perf_counter() - started
+    if redis_conn is None:
+        return len(field), elapsed
+    key = f"bench:result:{time.time_ns()}"
+    redis_conn.xadd(key, {"type": 1, "return_value": field}, maxlen=10)
+    size = redis_conn.memory_usage(key, samples=0)
+    redis_conn.delete(key)
+    return size, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--macs", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--ports", type=int, nargs="+", default=[48, 500])
+    parser.add_argument("--redis-url", help="measure MEMORY USAGE on this Redis instead of len()")
+    args = parser.parse_args()
+
+    redis_conn = None
+    if args.redis_url:
+        from redis import Redis
+        redis_conn = Redis.from_url(args.redis_url)
+
+    inline_max = serializer.RESULT_INLINE_MAX
+    #Measure compression alone, offloading is accounted for below without touching Postgres
+    serializer.RESULT_INLINE_MAX = sys.maxsize
+
+    payloads = [(f"mac_table {n}", mac_table(n)) for n in args.macs]
+    payloads += [(f"interfaces {n}", interface_list(n)) for n in args.ports]
+
+    print(f"{'payload':<18} {'default B':>11} {'junox B':>11} {'saved':>7} {'offloaded B':>12} "
+          f"{'dumps ms':>9} {'loads ms':>9}")
+    total_default = total_junox = 0
+    for name, value in payloads:
+        default, _ = stored_size(value, lambda v: pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL), redis_conn)
+        junox, dumps_s = stored_size(value, JunoxSerializer.dumps, redis_conn)
+        encoded = JunoxSerializer.dumps(value)
+        started = time.perf_counter()
+        JunoxSerializer.loads(encoded)
+        loads_s = time.perf_counter() - started
+
+        offloaded = REFERENCE_SIZE if len(encoded) > inline_max else junox
+        total_default += default
+        total_junox += offloaded
+        print(f"{name:<18} {default:>11} {junox:>11} {1 - junox / default:>6.0%} {offloaded:>12} "
+              f"{dumps_s * 1000:>9.1f} {loads_s * 1000:>9.1f}")
+
+    print(f"Redis bytes for all payloads: {total_default} -> {total_junox} "
+          f"({1 - total_junox / total_default:.0%} saved, inline max {inline_max} B)")
+
+
+if __name__ == "__main__":
+    main()
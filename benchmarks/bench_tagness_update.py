@@ -0,0 +1,83 @@
+"""
+Interface tagness update: one UPDATE per interface (old svc_update_db_interface_tagness)
+vs the single UPDATE ... FROM (VALUES ...) of apiutils.interface_tagness_update.
+Needs DATABASE_URL pointing at a migrated database. Everything runs inside a
+transaction that is rolled back, the database is left untouched.
+
+    PYTHONPATH=.. python benchmarks/bench_tagness_update.py --interfaces 48 500 1000
+"""
+import argparse
+import time
+
+from sqlalchemy import event, insert, update
+
+from juniper_cfg.apiutils import interface_tagness_update
+from juniper_cfg.database import SessionLocal, engine
+from juniper_cfg.models import DeviceNet, EthInterfaces
+
+
+class RoundTrips:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+def per_row(db, device_id, interface_list):
+    for iface in interface_list:
+        db.execute(
+            update(EthInterfaces)
+            .where(EthInterfaces.device_id == device_id,
+                   EthInterfaces.interface_name == iface["interface_name"])
+            .values(interface_tagness=iface["interface_tagness"])
+        )
+
+
+def set_based(db, device_id, interface_list):
+    db.execute(interface_tagness_update(device_id, interface_list))
+
+
+def run(interfaces, repeat):
+    db = SessionLocal()
+    try:
+        device = DeviceNet(hostname=f"bench-{time.time_ns()}"[:50], ip_address="192.0.2.1", type="switch",
+                           os_version="bench", model="bench")
+        db.add(device)
+        db.flush()
+        db.execute(insert(EthInterfaces), [
+            {"device_id": device.id, "interface_name": f"ge-0/0/{i}", "oper_status": "up",
+             "admin_status": "up", "mac_address": "00:00:00:00:00:00"}
+            for i in range(interfaces)
+        ])
+
+        for name, method in (("per-row", per_row), ("set-based", set_based)):
+            trips = RoundTrips()
+            event.listen(engine, "before_cursor_execute", trips)
+            started = time.perf_counter()
+            for round_ in range(repeat):
+                tagness = "tagged" if round_ % 2 else "untagged"
+                method(db, device.id, [{"interface_name": f"ge-0/0/{i}", "interface_tagness": tagness}
+                                       for i in range(interfaces)])
+            elapsed = (time.perf_counter() - started) / repeat
+            event.remove(engine, "before_cursor_execute", trips)
+            per_1000 = elapsed * 1000 / interfaces
+            print(f"{name:<10} {interfaces:>10} {trips.count // repeat:>11} {elapsed * 1000:>10.1f} {per_1000 * 1000:>14.1f}")
+    finally:
+        db.rollback()
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--interfaces", type=int, nargs="+", default=[48, 500, 1000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'method':<10} {'interfaces':>10} {'round-trips':>11} {'ms':>10} {'ms/1000 ifaces':>14}")
+    for interfaces in args.interfaces:
+        run(interfaces, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Latency of an unrelated endpoint while /token is hit by a login burst.
+Run it against a live API (uvicorn juniper_cfg.main:app) with a real user:
+
+    python benchmarks/load_login_burst.py --url http://127.0.0.1:8000 \\
+        --username admin --password lab123 --logins 200 --concurrency 50
+
+It first measures /health alone, then again while the logins are in flight,
+and prints p50/p99 of both. With bcrypt on the event loop the p99 under burst
+is roughly (concurrent logins x bcrypt time); with the executor it stays flat.
+Plain asyncio streams, no HTTP client dependency.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from urllib.parse import urlencode, urlsplit
+
+
+async def request(host, port, method, path, body=b"", headers=None):
+    reader, writer = await asyncio.open_connection(host, port)
+    lines = [f"{method} {path} HTTP/1.1", f"Host: {host}", "Connection: close",
+             f"Content-Length: {len(body)}"]
+    lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    await reader.read()
+    writer.close()
+    return int(status_line.split()[1])
+
+
+async def probe(host, port, path, interval, stop, latencies):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await request(host, port, "GET", path)
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(interval)
+
+
+async def login_burst(host, port, username, password, logins, concurrency):
+    body = urlencode({"username": username, "password": password}).encode()
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = []
+
+    async def one():
+        async with semaphore:
+            statuses.append(await request(host, port, "POST", "/api/v1/token", body, headers))
+
+    await asyncio.gather(*(one() for _ in range(logins)))
+    return statuses
+
+
+def percentiles(latencies):
+    ordered = sorted(latencies)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    return statistics.median(ordered) * 1000, p99 * 1000
+
+
+async def main(args):
+    url = urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+
+    idle = []
+    stop = asyncio.Event()
+    task = asyncio.create_task(probe(host, port, args.probe, args.interval, stop, idle))
+    await asyncio.sleep(args.baseline)
+    stop.set()
+    await task
+
+    busy = []
+    stop = asyncio.Event()
+    task = asyncio.create_task(probe(host, port, args.probe, args.interval, stop, busy))
+    started = time.perf_counter()
+    statuses = await login_burst(host, port, args.username, args.password, args.logins, args.concurrency)
+    burst = time.perf_counter() - started
+    stop.set()
+    await task
+
+    ok = sum(1 for status in statuses if status == 200)
+    print(f"logins: {ok}/{len(statuses)} ok in {burst:.2f}s ({len(statuses) / burst:.1f}/s)")
+    for name, latencies in (("idle", idle), ("login burst", busy)):
+        p50, p99 = percentiles(latencies)
+        print(f"{args.probe} during {name:<12} n={len(latencies):<5} p50={p50:8.1f}ms p99={p99:8.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--probe", default="/health")
+    parser.add_argument("--interval", type=float, default=0.02)
+    parser.add_argument("--baseline", type=float, default=3.0, help="seconds of probing before the burst")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,87 @@
+import io
+import logging
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Histogram
+
+from juniper_cfg.database import engine
+
+logger = logging.getLogger("BulkCopy")
+
+COPY_DURATION = Histogram('db_copy_duration_seconds', 'Time spent replacing a device table with COPY', ['table'])
+
+
+def _copy_value(value):
+    #COPY text format: \N is NULL, backslash/tab/newline must be escaped
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_rows(cursor, table: str, columns: tuple, rows):
+    """
+    Streams rows (tuples in the order of columns) into table with COPY FROM STDIN.
+    Returns the number of rows written.
+    """
+    buffer = io.StringIO()
+    count = 0
+    for row in rows:
+        buffer.write("\t".join(_copy_value(value) for value in row))
+        buffer.write("\n")
+        count += 1
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+    return count
+
+
+@contextmanager
+def device_transaction(device_id: int):
+    """
+    Yields a cursor in a transaction that holds a transaction level advisory
+    lock on the device, so two syncs of the same device queue up instead of
+    interleaving. The devices row itself is only held FOR KEY SHARE: the sync
+    may stream from the device for a long time, status updates of the row
+    must not wait for it (deleting the device does).
+    Commits on success, rolls back on any error.
+    """
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (device_id,))
+            cursor.execute("SELECT id FROM devices WHERE id = %s FOR KEY SHARE", (device_id,))
+            if cursor.fetchone() is None:
+                raise ValueError(f"Device {device_id} does not exist")
+            yield cursor
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def replace_device_rows(device_id: int, table: str, columns: tuple, chunks, prepare=None):
+    """
+    Replaces all rows of a device in table with the rows of chunks (an iterable
+    of lists of tuples, without device_id). Delete and COPY run in one transaction,
+    so readers see either the old or the new table, never a half written one.
+    prepare(cursor) runs inside the transaction before the first chunk is consumed
+    and may return a function applied to every chunk (e.g. name -> id lookups).
+    """
+    started = time.perf_counter()
+    with device_transaction(device_id) as cursor:
+        transform = prepare(cursor) if prepare else None
+        cursor.execute(f"DELETE FROM {table} WHERE device_id = %s", (device_id,))
+        count = 0
+        for chunk in chunks:
+            if transform:
+                chunk = transform(chunk)
+            count += copy_rows(cursor, table, (*columns, "device_id"), (
+                (*row, device_id) for row in chunk
+            ))
+
+    elapsed = time.perf_counter() - started
+    COPY_DURATION.labels(table=table).observe(elapsed)
+    logger.info(f"Replaced {table} of device {device_id} with {count} rows in {elapsed:.3f}s")
+    return count
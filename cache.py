@@ -0,0 +1,135 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+from prometheus_client import Counter
+from redis import Redis
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+
+load_dotenv()
+
+logger = logging.getLogger("Cache")
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+
+CACHE_REQUESTS = Counter('cache_requests_total', 'Cache lookups', ['cache', 'tier', 'result'])
+
+#Returned by TTLCache.get on a miss, None is a legit cached value
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Small thread-safe in-process cache: LRU bounded by maxsize, entries expire after ttl seconds.
+    Lookups are counted in cache_requests_total{cache=name, tier="local"}.
+    """
+
+    def __init__(self, name: str, ttl: float, maxsize: int = 10000):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] > time.monotonic():
+                self._data.move_to_end(key)
+                CACHE_REQUESTS.labels(cache=self.name, tier="local", result="hit").inc()
+                return item[0]
+            if item is not None:
+                del self._data[key]
+        CACHE_REQUESTS.labels(cache=self.name, tier="local", result="miss").inc()
+        return MISSING
+
+    def set(self, key, value, ttl: float = None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (ttl or self.ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class InvalidationBus:
+    """
+    Tells every API and worker process to drop local cache entries.
+    publish(cache, keys) goes out on one Redis channel; each process runs a single
+    listener thread that hands the keys to the handler registered for that cache.
+    When the listener loses Redis it may have missed messages, so on reconnect
+    every handler is called with keys=None meaning "drop everything".
+    """
+    CHANNEL = "cache_invalidate"
+
+    def __init__(self, redis_conn):
+        self.r = redis_conn
+        self._handlers = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, cache: str, handler):
+        self._handlers[cache] = handler
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, name="cache-invalidation", daemon=True)
+                self._thread.start()
+
+    def publish(self, cache: str, keys: list = None):
+        #Our own process gets it through the listener as well, but don't wait for that
+        self._dispatch(cache, keys)
+        try:
+            self.r.publish(self.CHANNEL, json.dumps({"cache": cache, "keys": keys}))
+        except RedisError as e:
+            logger.warning(f"Could not publish invalidation of {cache}: {e}")
+
+    def _dispatch(self, cache, keys):
+        handler = self._handlers.get(cache)
+        if handler:
+            handler(keys)
+
+    def _listen(self):
+        while True:
+            pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.CHANNEL)
+                #(Re)connected: anything cached while we were away may be stale
+                for cache in list(self._handlers):
+                    self._dispatch(cache, None)
+                while True:
+                    #get_message with a timeout (instead of listen) lets redis-py run its
+                    #health check pings, a silently dead connection would block forever
+                    message = pubsub.get_message(timeout=30)
+                    if message is None or message["type"] != "message":
+                        continue
+                    data = json.loads(message["data"])
+                    self._dispatch(data["cache"], data["keys"])
+            except Exception as e:
+                logger.warning(f"Cache invalidation listener lost Redis ({e}), reconnecting")
+                pubsub.close()
+                time.sleep(5)
+
+
+#Second tier shared by the caches of this process. Short timeouts: when Redis is
+#slow or down a lookup falls through to the DB instead of hanging the request.
+cache_redis = Redis(host=REDIS_HOST, port=REDIS_PORT, socket_timeout=1, socket_connect_timeout=1)
+cache_redis_async = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, socket_timeout=1, socket_connect_timeout=1)
+#The listener blocks on its connection, it must not share the short socket timeout
+invalidation_bus = InvalidationBus(Redis(host=REDIS_HOST, port=REDIS_PORT, health_check_interval=30))
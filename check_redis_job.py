@@ -1,12 +1,13 @@
 from redis import Redis
 from rq.job import Job
+from juniper_cfg.serializer import JunoxSerializer
 
 # 1. Connect to the same Redis you used for enqueuing
 redis_conn = Redis(host='localhost', port=6379)
 
 # 2. Fetch the job using its unique ID
 job_id = "e0cd7894-b1fb-4b09-b9b6-72bdea395180"
-job = Job.fetch(job_id, connection=redis_conn)
+job = Job.fetch(job_id, connection=redis_conn, serializer=JunoxSerializer)
 
 # 3. Access the data
 if job.is_finished:
@@ -0,0 +1,204 @@
+import asyncio
+import atexit
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+from jnpr.junos.op.ethport import EthPortTable
+from prometheus_client import Counter, Histogram
+from sqlalchemy import select
+
+from juniper_cfg.database import SessionLocal
+from juniper_cfg.devlock import device_locks
+from juniper_cfg.devpool import DeviceSessionPool
+from juniper_cfg.models import DeviceNet
+from juniper_cfg.services import svc_update_db_interface_tagness
+from juniper_cfg.tasks import (DEVICE_USER, DEVICE_PASSWORD, collect_switching_interfaces,
+                               collect_vlans, sync_interfaces_to_db, sync_vlans_to_db,
+                               sync_mac_table_to_db, sync_arp_table_to_db, collect_routes_to_db)
+from juniper_cfg.xmlstream import rpc_reply_raw, iter_mac_chunks, iter_chunks, iter_arp_entries, MAC_CHUNK_SIZE
+
+load_dotenv()
+
+logger = logging.getLogger("FleetCollector")
+
+#How many devices are talked to at the same time from one process
+FLEET_CONCURRENCY = int(os.getenv("FLEET_CONCURRENCY", "200"))
+#Budget for all the collectors of one device, connect included
+FLEET_DEVICE_TIMEOUT = int(os.getenv("FLEET_DEVICE_TIMEOUT", "120"))
+#RQ timeout of the whole fleet_collect_job
+FLEET_JOB_TIMEOUT = int(os.getenv("FLEET_JOB_TIMEOUT", "3600"))
+
+#Sessions of the collector are pooled separately so a fleet run doesn't evict the job sessions
+fleet_pool = DeviceSessionPool(max_sessions=FLEET_CONCURRENCY)
+atexit.register(fleet_pool.close_all)
+
+FLEET_DEVICES = Counter('fleet_collect_devices_total', 'Devices processed by the fleet collector', ['result'])
+FLEET_DEVICE_LATENCY = Histogram('fleet_collect_device_duration_seconds', 'Time spent collecting one device')
+
+
+def _read_interfaces(dev):
+    ports = EthPortTable(dev)
+    ports.get()
+    return ports.items()
+
+def _sync_tagness(device_id, interfaces_result):
+    with SessionLocal() as db:
+        svc_update_db_interface_tagness(db, device_id, interfaces_result)
+    return len(interfaces_result)
+
+def _read_mac_table(dev):
+    return rpc_reply_raw(dev, "get_ethernet_switching_table_information")
+
+def _sync_mac_table(device_id, raw):
+    return sync_mac_table_to_db(device_id, iter_mac_chunks(raw))["entries"]
+
+def _read_arp_table(dev):
+    return rpc_reply_raw(dev, "get_arp_table_information", no_resolve=True)
+
+def _sync_arp_table(device_id, raw):
+    return sync_arp_table_to_db(device_id, iter_chunks(iter_arp_entries(raw), MAC_CHUNK_SIZE))
+
+def _sync_vlans(device_id, vlans):
+    sync_vlans_to_db(device_id, vlans)
+    return len(vlans)
+
+# name -> (read over an open device, write to the DB). The sinks are the same
+# ones the RQ job chain uses (post_get_interfaces_job, post_fetch_vlans_job).
+COLLECTORS = {
+    "interfaces": (_read_interfaces, sync_interfaces_to_db),
+    "switching_interfaces": (collect_switching_interfaces, _sync_tagness),
+    "vlans": (collect_vlans, _sync_vlans),
+    "mac_table": (_read_mac_table, _sync_mac_table),
+    "arp_table": (_read_arp_table, _sync_arp_table),
+}
+
+# name -> fn(dev, device_id). These write while reading, with the session still
+# checked out, because their replies are too big to hold (full routing tables).
+STREAMING_COLLECTORS = {
+    "route_table": collect_routes_to_db,
+}
+
+
+def _release_late(semaphore):
+    def done(future):
+        if not future.cancelled():
+            future.exception()  # retrieved, the device already counts as timed out
+        semaphore.release()
+    return done
+
+
+class FleetCollector:
+    """
+    Runs read-only collectors against many devices from one process.
+    asyncio schedules the devices under a global semaphore and enforces the
+    per-device timeout; the blocking PyEZ/SQLAlchemy calls run in a thread
+    pool of the same size, so at most `concurrency` devices are in flight.
+    concurrency is capped by the session pool, the summary reports what was used.
+    """
+
+    def __init__(self, concurrency=FLEET_CONCURRENCY, device_timeout=FLEET_DEVICE_TIMEOUT, pool=fleet_pool):
+        self.concurrency = min(concurrency, pool.max_sessions)
+        if self.concurrency < concurrency:
+            logger.warning(f"Fleet concurrency {concurrency} capped to the {pool.max_sessions} pooled sessions")
+        self.device_timeout = device_timeout
+        self.pool = pool
+
+    async def collect(self, devices: list, collectors: list):
+        """
+        devices is a list of (device_id, device_ip). Returns a summary with
+        per-collector counts and the per-device errors.
+        """
+        unknown = [name for name in collectors if name not in COLLECTORS and name not in STREAMING_COLLECTORS]
+        if unknown:
+            raise ValueError(f"Unknown collectors: {unknown}")
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="fleet") as executor:
+            results = await asyncio.gather(*(
+                self._collect_device(semaphore, executor, device_id, device_ip, collectors)
+                for device_id, device_ip in devices
+            ))
+
+        summary = {
+            "devices": len(devices),
+            "succeeded": sum(1 for r in results if r["status"] == "Success"),
+            "failed": sum(1 for r in results if r["status"] == "Error"),
+            "timed_out": sum(1 for r in results if r["status"] == "Timeout"),
+            "rows": {name: sum(r["rows"].get(name, 0) for r in results) for name in collectors},
+            "errors": {r["device_id"]: r["error"] for r in results if r.get("error")},
+            "concurrency": self.concurrency,
+            "duration": round(time.perf_counter() - started, 3),
+        }
+        logger.info(f"Fleet collection of {collectors} finished: {len(devices)} devices in {summary['duration']}s")
+        return summary
+
+    async def _collect_device(self, semaphore, executor, device_id, device_ip, collectors):
+        loop = asyncio.get_running_loop()
+        await semaphore.acquire()
+        started = time.perf_counter()
+        future = loop.run_in_executor(executor, self._collect_device_sync, device_id, device_ip, collectors)
+        try:
+            rows = await asyncio.wait_for(asyncio.shield(future), timeout=self.device_timeout)
+            result = {"device_id": device_id, "status": "Success", "rows": rows}
+        except asyncio.TimeoutError:
+            #The thread keeps running until its own RPC timeout, we only stop waiting for it
+            result = {"device_id": device_id, "status": "Timeout", "rows": {},
+                      "error": f"timed out after {self.device_timeout}s"}
+        except Exception as e:
+            result = {"device_id": device_id, "status": "Error", "rows": {}, "error": str(e)}
+
+        #The slot is free once the thread is, not before: a device started on a
+        #busy executor would only queue for a thread and time out without an RPC
+        if future.done():
+            semaphore.release()
+        else:
+            future.add_done_callback(_release_late(semaphore))
+
+        FLEET_DEVICE_LATENCY.observe(time.perf_counter() - started)
+        FLEET_DEVICES.labels(result=result["status"].lower()).inc()
+        return result
+
+    def _collect_device_sync(self, device_id, device_ip, collectors):
+        rows = {}
+        #Read lock: other reads of the device go on, a configuration commit waits for us
+        with device_locks.hold(device_ip, "read", wait=self.device_timeout, lease=2 * self.device_timeout), \
+                self.pool.session(device_ip, DEVICE_USER, DEVICE_PASSWORD,
+                                  conn_open_timeout=self.device_timeout) as dev:
+            dev.timeout = self.device_timeout
+            raw = {name: COLLECTORS[name][0](dev) for name in collectors if name in COLLECTORS}
+            for name in collectors:
+                if name in STREAMING_COLLECTORS:
+                    rows[name] = STREAMING_COLLECTORS[name](dev, device_id) or 0
+        #DB writes happen after the session went back to the pool
+        for name, data in raw.items():
+            rows[name] = COLLECTORS[name][1](device_id, data) or 0
+        return rows
+
+
+def load_fleet(device_ids: list = None):
+    """
+    [(device_id, device_ip)] for the given ids, or the whole inventory.
+    """
+    stmt = select(DeviceNet.id, DeviceNet.ip_address)
+    if device_ids:
+        stmt = stmt.where(DeviceNet.id.in_(device_ids))
+    with SessionLocal() as session:
+        return [tuple(row) for row in session.execute(stmt).all()]
+
+
+def fleet_collect_job(collectors: list, device_ids: list = None, concurrency: int = None):
+    """
+    RQ TASK: runs the collectors against the fleet from this single worker process.
+    """
+    devices = load_fleet(device_ids)
+    collector = FleetCollector(concurrency=concurrency or FLEET_CONCURRENCY)
+    summary = asyncio.run(collector.collect(devices, collectors))
+    return {
+        "status": "Success",
+        "job_type": "fleet_collect",
+        **summary
+    }
@@ -1,17 +1,38 @@
 import os
+import time
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, DeclarativeBase
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import sessionmaker, scoped_session, DeclarativeBase
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from dotenv import load_dotenv
 from typing import AsyncGenerator
+from prometheus_client import Gauge, Histogram
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+DB_POOL_CHECKOUT_WAIT = Histogram('db_pool_checkout_wait_seconds', 'Time spent waiting for a connection from the sync pool',
+                                  buckets=(.001, .005, .01, .05, .1, .5, 1, 5, 10, 30))
+#Read at scrape time, so worker processes export it too (the API used to set it in /metrics)
+DB_POOL_CHECKEDOUT = Gauge('db_pool_checkedout_connections', 'Connections currently being used')
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that records how long each checkout waited, including the
+    connect when the pool had to open a new connection.
+    """
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
 # --- SYNC SETUP WITH POOLING (For your RQ Workers) ---
 engine = create_engine(
     DATABASE_URL,
+    poolclass=TimedQueuePool,
     pool_size=10,           # Keep 10 connections open at all times
     max_overflow=20,        # If all 10 are busy, allow up to 20 temporary extra ones
     pool_timeout=30,        # Wait 30 seconds for a connection before failing
@@ -19,6 +40,13 @@ engine = create_engine(
     pool_pre_ping=True      # Check if the connection is alive before using it (VITAL)
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DB_POOL_CHECKEDOUT.set_function(lambda: engine.pool.checkedout())
+
+# Session of the running job. Everything that used to share the one long lived
+# APIUtils session gets this instead; JunoxWorker calls JobSession.remove() after
+# every job, which rolls back whatever is left, closes the session and drops its
+# identity map, so the next job starts clean.
+JobSession = scoped_session(SessionLocal)
 
 def get_db():
     db = SessionLocal()
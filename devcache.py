@@ -0,0 +1,242 @@
+import json
+import logging
+import os
+
+from dotenv import load_dotenv
+from redis.exceptions import RedisError
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from juniper_cfg.cache import (CACHE_REQUESTS, MISSING, TTLCache, cache_redis, cache_redis_async,
+                               invalidation_bus)
+from juniper_cfg.database import AsyncSessionLocal, SessionLocal
+from juniper_cfg.models import DeviceNet
+
+load_dotenv()
+
+logger = logging.getLogger("DeviceCache")
+
+DEVICE_CACHE_TTL = int(os.getenv("DEVICE_CACHE_TTL", "300"))
+DEVICE_CACHE_REDIS_TTL = int(os.getenv("DEVICE_CACHE_REDIS_TTL", "3600"))
+
+#("id", 12), ("ip", "10.0.0.1") and ("hostname", "ex-01") -> {"id": 12, "ip_address": "10.0.0.1", "hostname": "ex-01"}
+#Only devices that exist are cached, a miss always goes to the DB so a device
+#provisioned a second ago is found right away.
+_local = TTLCache("device", DEVICE_CACHE_TTL)
+
+#Bumped by every invalidation, in Redis and in this process. A reader only caches
+#the row it loaded if no invalidation happened since it started, otherwise it could
+#put back an entry that was loaded before the change and dropped after it.
+GENERATION_KEY = "devcache_generation"
+_local_generation = 0
+
+#KEYS[1] the generation key, KEYS[2..] the entries. ARGV: generation seen before
+#the DB load, the entry, its TTL
+_STORE = """
+if (redis.call('GET', KEYS[1]) or '0') ~= ARGV[1] then
+    return 0
+end
+for i = 2, #KEYS do
+    redis.call('SET', KEYS[i], ARGV[2], 'EX', ARGV[3])
+end
+return 1
+"""
+_store = cache_redis.register_script(_STORE)
+_store_async = cache_redis_async.register_script(_STORE)
+
+
+def _redis_key(kind, value):
+    return f"devcache:{kind}:{value}"
+
+
+#lookup kind -> (column, key of the cached dict)
+KINDS = {
+    "id": (DeviceNet.id, "id"),
+    "ip": (DeviceNet.ip_address, "ip_address"),
+    "hostname": (DeviceNet.hostname, "hostname"),
+}
+
+
+def _lookup_stmt(kind, value):
+    column = KINDS[kind][0]
+    return select(DeviceNet.id, DeviceNet.ip_address, DeviceNet.hostname).where(column == value).limit(1)
+
+
+def _as_ref(row):
+    return {"id": row.id, "ip_address": row.ip_address, "hostname": row.hostname} if row else None
+
+
+def _remember_local(ref, generation=None):
+    if generation is not None and generation != _local_generation:
+        return
+    for kind, (_, field) in KINDS.items():
+        _local.set((kind, ref[field]), ref)
+
+
+def _store_args(ref, generation):
+    keys = [GENERATION_KEY] + [_redis_key(kind, ref[field]) for kind, (_, field) in KINDS.items()]
+    return keys, [generation, json.dumps(ref), DEVICE_CACHE_REDIS_TTL]
+
+
+def _count_redis(found):
+    CACHE_REQUESTS.labels(cache="device", tier="redis", result="hit" if found else "miss").inc()
+
+
+def get_device_ref_sync(kind: str, value, db=None):
+    """
+    {"id", "ip_address", "hostname"} of a device by "id", "ip" or "hostname",
+    None if it doesn't exist.
+    Process cache first, then Redis, then the DB (db if given, else a new session).
+    """
+    ref = _local.get((kind, value))
+    if ref is not MISSING:
+        return ref
+
+    local_generation = _local_generation
+    generation = None
+    try:
+        raw, generation = cache_redis.mget(_redis_key(kind, value), GENERATION_KEY)
+        generation = generation or b"0"
+        _count_redis(raw is not None)
+        if raw is not None:
+            ref = json.loads(raw)
+            _remember_local(ref, local_generation)
+            return ref
+    except RedisError as e:
+        logger.warning(f"Device cache Redis lookup failed: {e}")
+
+    if db is None:
+        with SessionLocal() as session:
+            ref = _as_ref(session.execute(_lookup_stmt(kind, value)).first())
+    else:
+        ref = _as_ref(db.execute(_lookup_stmt(kind, value)).first())
+
+    if ref is not None:
+        _remember_local(ref, local_generation)
+        if generation is not None:
+            try:
+                keys, args = _store_args(ref, generation)
+                _store(keys=keys, args=args)
+            except RedisError as e:
+                logger.warning(f"Device cache Redis store failed: {e}")
+    return ref
+
+
+async def get_device_ref_async(kind: str, value, db=None):
+    """
+    Async twin of get_device_ref_sync for the API (async Redis client and AsyncSession).
+    """
+    ref = _local.get((kind, value))
+    if ref is not MISSING:
+        return ref
+
+    local_generation = _local_generation
+    generation = None
+    try:
+        raw, generation = await cache_redis_async.mget(_redis_key(kind, value), GENERATION_KEY)
+        generation = generation or b"0"
+        _count_redis(raw is not None)
+        if raw is not None:
+            ref = json.loads(raw)
+            _remember_local(ref, local_generation)
+            return ref
+    except RedisError as e:
+        logger.warning(f"Device cache Redis lookup failed: {e}")
+
+    if db is None:
+        async with AsyncSessionLocal() as session:
+            ref = _as_ref((await session.execute(_lookup_stmt(kind, value))).first())
+    else:
+        ref = _as_ref((await db.execute(_lookup_stmt(kind, value))).first())
+
+    if ref is not None:
+        _remember_local(ref, local_generation)
+        if generation is not None:
+            try:
+                keys, args = _store_args(ref, generation)
+                await _store_async(keys=keys, args=args)
+            except RedisError as e:
+                logger.warning(f"Device cache Redis store failed: {e}")
+    return ref
+
+
+def invalidate_devices(keys: list = None):
+    """
+    Drops [(kind, value)...] from Redis and from the process cache of every
+    API/worker process. keys=None drops the whole device cache.
+    """
+    try:
+        if keys is None:
+            redis_keys = list(cache_redis.scan_iter(match="devcache:*", count=1000))
+        else:
+            redis_keys = [_redis_key(kind, value) for kind, value in keys]
+        with cache_redis.pipeline() as pipe:
+            pipe.incr(GENERATION_KEY)
+            if redis_keys:
+                pipe.delete(*redis_keys)
+            pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Device cache Redis invalidation failed: {e}")
+    invalidation_bus.publish("device", [list(key) for key in keys] if keys is not None else None)
+
+
+def _on_invalidate(keys):
+    global _local_generation
+    _local_generation += 1
+    if keys is None:
+        _local.clear()
+    else:
+        _local.delete(*(tuple(key) for key in keys))
+
+
+invalidation_bus.subscribe("device", _on_invalidate)
+
+
+# --- invalidation on devices changes ---
+# Changed devices are collected during the flush and invalidated after the commit:
+# invalidating at flush time would let a concurrent reader cache the old row again.
+
+def _mark_dirty(session, keys):
+    session.info.setdefault("devcache_dirty", set()).update(keys)
+
+
+@event.listens_for(DeviceNet, "after_update")
+@event.listens_for(DeviceNet, "after_delete")
+def _device_changed(mapper, connection, target):
+    session = inspect(target).session
+    if session is None:
+        return
+    state = inspect(target)
+    keys = {("id", target.id)}
+    for kind, (_, field) in KINDS.items():
+        if kind == "id":
+            continue
+        keys.add((kind, getattr(target, field)))
+        #the IP/hostname it had before this update
+        keys.update((kind, old) for old in state.attrs[field].history.deleted)
+    _mark_dirty(session, keys)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _bulk_device_change(orm_execute_state):
+    #update(DeviceNet)/delete(DeviceNet) statements skip the mapper events, we can't
+    #tell which rows they touch
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and \
+            any(mapper.class_ is DeviceNet for mapper in orm_execute_state.all_mappers):
+        orm_execute_state.session.info["devcache_dirty_all"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_invalidations(session):
+    dirty_all = session.info.pop("devcache_dirty_all", False)
+    dirty = session.info.pop("devcache_dirty", None)
+    if dirty_all:
+        invalidate_devices(None)
+    elif dirty:
+        invalidate_devices(sorted(dirty, key=str))
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_invalidations(session):
+    session.info.pop("devcache_dirty_all", None)
+    session.info.pop("devcache_dirty", None)
@@ -0,0 +1,229 @@
+import functools
+import logging
+import math
+import os
+import random
+import time
+import uuid
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+from prometheus_client import Counter, Histogram
+from rq import get_current_job
+from rq.job import Retry
+
+from juniper_cfg.ratelimit import SessionRateLimited, defer_rate_limits
+from juniper_cfg.services import redis_conn
+
+load_dotenv()
+
+logger = logging.getLogger("DeviceLock")
+
+#How long hold() waits for a device by default (workflow steps, fleet collection)
+DEVICE_LOCK_WAIT = float(os.getenv("DEVICE_LOCK_WAIT", "120"))
+#How long a job waits before giving the worker back and retrying later
+DEVICE_LOCK_JOB_WAIT = float(os.getenv("DEVICE_LOCK_JOB_WAIT", "5"))
+DEVICE_LOCK_RETRIES = int(os.getenv("DEVICE_LOCK_RETRIES", "20"))
+DEVICE_LOCK_RETRY_INTERVAL = int(os.getenv("DEVICE_LOCK_RETRY_INTERVAL", "5"))
+#Lease of a holder outside RQ jobs, jobs hold the lock for their own timeout.
+#A crashed holder blocks the device at most this long.
+DEVICE_LOCK_LEASE = int(os.getenv("DEVICE_LOCK_LEASE", "600"))
+#A writer waiting for readers to drain keeps new readers out this long per attempt
+WRITER_CLAIM_MS = 2000
+#A writer job that gives up keeps its claim until its retry runs, plus this much
+#for the scheduler to pick it up
+WRITER_CLAIM_SLACK = 10
+
+LOCK_WAIT = Histogram('device_lock_wait_seconds', 'Time spent waiting for a device lock', ['mode', 'result'],
+                      buckets=(.005, .01, .05, .1, .5, 1, 5, 10, 30, 60, 120, 300))
+LOCK_RETRIES = Counter('device_lock_retries_total', 'Jobs rescheduled because their device was locked', ['mode'])
+
+#Keys per device: devlock:{ip}:writer holds the writer token, devlock:{ip}:readers
+#is a sorted set of reader tokens scored by lease expiry (ms, Redis clock) so a
+#crashed reader drops out by itself, devlock:{ip}:claim is the waiting writer.
+
+_ACQUIRE_READ = """
+local t = redis.call('TIME')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+local lease = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+if redis.call('EXISTS', KEYS[1]) == 1 or redis.call('EXISTS', KEYS[3]) == 1 then
+    return 0
+end
+redis.call('ZADD', KEYS[2], now + lease, ARGV[1])
+if redis.call('PTTL', KEYS[2]) < lease then
+    redis.call('PEXPIRE', KEYS[2], lease)
+end
+return 1
+"""
+
+#Readers draining block the writer, which then claims the device so no new
+#reader gets in before it. One writer claims at a time.
+_ACQUIRE_WRITE = """
+local t = redis.call('TIME')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local claim = redis.call('GET', KEYS[3])
+if claim and claim ~= ARGV[1] then
+    return 0
+end
+if redis.call('ZCARD', KEYS[2]) > 0 then
+    redis.call('SET', KEYS[3], ARGV[1], 'PX', ARGV[3])
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+redis.call('DEL', KEYS[3])
+return 1
+"""
+
+#Deletes the writer (or claim) key only if it still holds our token
+_RELEASE_WRITE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+#Extends the claim only if it still holds our token
+_EXTEND_CLAIM = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class DeviceBusy(Exception):
+    #Workflow steps holding a device are rescheduled after retry_after seconds (run_step)
+    def __init__(self, message, retry_after: float = DEVICE_LOCK_RETRY_INTERVAL):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeviceLock:
+    """
+    Per-device reader/writer lock in Redis: any number of readers (collection
+    jobs) or one writer (configuration commit) per device. A waiting writer
+    keeps new readers out so commits aren't starved by back to back polls.
+    """
+
+    def __init__(self, redis_conn, wait=DEVICE_LOCK_WAIT, lease=DEVICE_LOCK_LEASE):
+        self.r = redis_conn
+        self.wait = wait
+        self.lease = lease
+        self._acquire_read = redis_conn.register_script(_ACQUIRE_READ)
+        self._acquire_write = redis_conn.register_script(_ACQUIRE_WRITE)
+        self._release_write = redis_conn.register_script(_RELEASE_WRITE)
+        self._extend_claim = redis_conn.register_script(_EXTEND_CLAIM)
+
+    @staticmethod
+    def _keys(device_ip):
+        return [f"devlock:{device_ip}:writer", f"devlock:{device_ip}:readers", f"devlock:{device_ip}:claim"]
+
+    def _acquire(self, device_ip, mode, token, lease):
+        script = self._acquire_write if mode == "write" else self._acquire_read
+        return script(keys=self._keys(device_ip), args=[token, int(lease * 1000), WRITER_CLAIM_MS]) == 1
+
+    def _release(self, device_ip, mode, token):
+        writer, readers, _ = self._keys(device_ip)
+        if mode == "write":
+            self._release_write(keys=[writer], args=[token])
+        else:
+            self.r.zrem(readers, token)
+
+    def _drop_claim(self, device_ip, token):
+        self._release_write(keys=[self._keys(device_ip)[2]], args=[token])
+
+    @contextmanager
+    def hold(self, device_ip: str, mode: str = "read", wait: float = None, lease: float = None,
+             token: str = None):
+        """
+        Holds the device in mode "read" or "write", waiting up to wait seconds.
+        Raises DeviceBusy if it couldn't be had in time. A writer that comes
+        back later with the same token (a retried job) keeps its claim on the
+        device, the caller drops it (_drop_claim) if it doesn't come back.
+        """
+        wait = self.wait if wait is None else wait
+        lease = lease or self.lease
+        keep_claim = token is not None
+        token = token or uuid.uuid4().hex
+        started = time.perf_counter()
+        delay = 0.02
+        while not self._acquire(device_ip, mode, token, lease):
+            waited = time.perf_counter() - started
+            if waited >= wait:
+                if mode == "write" and not keep_claim:
+                    #Giving up, let the readers back in
+                    self._drop_claim(device_ip, token)
+                LOCK_WAIT.labels(mode=mode, result="busy").observe(waited)
+                raise DeviceBusy(f"Device {device_ip} is locked, no {mode} lock after {waited:.1f}s")
+            time.sleep(min(delay, wait - waited))
+            delay = min(delay * 2, 0.5)
+        LOCK_WAIT.labels(mode=mode, result="acquired").observe(time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self._release(device_ip, mode, token)
+
+    def job(self, mode: str, ip_of=None, on_give_up=None):
+        """
+        Decorator for RQ jobs whose first argument is the device (its IP, or
+        whatever ip_of turns into one). The job runs holding the device; when it
+        stays locked past DEVICE_LOCK_JOB_WAIT, or its NETCONF session budget is
+        spent, the job returns Retry so the worker moves on (the rescheduling
+        needs rq worker --with-scheduler). A writer job keeps its claim on the
+        device across its retries, readers don't slip in between two attempts.
+        on_give_up(device_ip, job) runs when the retries are spent, before the
+        job fails.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                device_ip = ip_of(args[0]) if ip_of else args[0]
+                job = get_current_job()
+                lease = job.timeout if job is not None and job.timeout and job.timeout > 0 else None
+                token = f"job:{job.id}" if job is not None and mode == "write" else None
+                try:
+                    with self.hold(device_ip, mode, wait=DEVICE_LOCK_JOB_WAIT, lease=lease, token=token):
+                        with defer_rate_limits(DEVICE_LOCK_JOB_WAIT) as deferral:
+                            try:
+                                result = func(*args, **kwargs)
+                            except Exception:
+                                if deferral.retry_after is None:
+                                    raise
+                                result = None
+                        #The jobs turn errors into results or other exceptions, a refused
+                        #session open is only seen here
+                        if deferral.retry_after is not None:
+                            raise SessionRateLimited(f"NETCONF session budget exhausted for {device_ip}",
+                                                     retry_after=deferral.retry_after)
+                        return result
+                except (DeviceBusy, SessionRateLimited) as e:
+                    if job is None:
+                        raise
+                    #RQ doesn't count retries scheduled with an interval, keep count ourselves
+                    attempts = job.meta.get("lock_retries", 0)
+                    if attempts >= DEVICE_LOCK_RETRIES:
+                        if token:
+                            self._drop_claim(device_ip, token)
+                        if on_give_up:
+                            on_give_up(device_ip, job)
+                        raise
+                    job.meta["lock_retries"] = attempts + 1
+                    job.save_meta()
+                    LOCK_RETRIES.labels(mode=mode).inc()
+                    logger.info(f"{e}, job {job.id} retried ({attempts + 1}/{DEVICE_LOCK_RETRIES})")
+                    interval = max(DEVICE_LOCK_RETRY_INTERVAL, math.ceil(getattr(e, "retry_after", 0)))
+                    interval += random.randint(0, DEVICE_LOCK_RETRY_INTERVAL)
+                    if token:
+                        self._extend_claim(keys=[self._keys(device_ip)[2]],
+                                           args=[token, (interval + WRITER_CLAIM_SLACK) * 1000])
+                    return Retry(max=DEVICE_LOCK_RETRIES, interval=interval)
+            return wrapper
+        return decorator
+
+
+device_locks = DeviceLock(redis_conn)
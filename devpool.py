@@ -0,0 +1,275 @@
+import atexit
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+from jnpr.junos import Device
+from jnpr.junos.exception import RpcError, RpcTimeoutError
+from prometheus_client import Counter, Gauge, Histogram
+
+from juniper_cfg.ratelimit import session_limiter
+
+load_dotenv()
+
+logger = logging.getLogger("DevicePool")
+
+#Pool tuning. These are per worker process, not per fleet.
+NETCONF_POOL_MAX_SESSIONS = int(os.getenv("NETCONF_POOL_MAX_SESSIONS", "50"))
+NETCONF_POOL_IDLE_TIMEOUT = int(os.getenv("NETCONF_POOL_IDLE_TIMEOUT", "300"))
+#Idle sessions older than this get a cheap RPC before reuse (half-open TCP can't be seen otherwise)
+NETCONF_POOL_PROBE_AFTER = int(os.getenv("NETCONF_POOL_PROBE_AFTER", "30"))
+NETCONF_POOL_CHECKOUT_TIMEOUT = int(os.getenv("NETCONF_POOL_CHECKOUT_TIMEOUT", "60"))
+
+# Metrics. Registered in the default registry so /metrics picks them up
+# in whichever process imports this module.
+POOL_CHECKOUTS = Counter('netconf_pool_checkouts_total', 'NETCONF session checkouts', ['result'])
+POOL_HANDSHAKE = Histogram('netconf_handshake_duration_seconds', 'Time spent opening a NETCONF session')
+POOL_HANDSHAKE_SAVED = Counter('netconf_handshake_seconds_saved_total', 'Estimated handshake time saved by reusing sessions')
+POOL_SESSIONS = Gauge('netconf_pool_sessions', 'NETCONF sessions held by the pool', ['state'])
+
+
+class _PooledSession:
+    def __init__(self, key, dev, handshake_time):
+        self.key = key
+        self.dev = dev
+        self.handshake_time = handshake_time
+        self.last_used = time.monotonic()
+
+
+class DeviceSessionPool:
+    """
+    Keeps NETCONF sessions open between RQ jobs so a job only pays the
+    SSH + NETCONF handshake when the pool has no live session for the device.
+    Sessions are keyed by (host, user, password hash) so a checkout with other
+    credentials never gets a session opened with the right ones. Only useful
+    when the worker does not fork per job (rq.worker.SimpleWorker), otherwise
+    the pool dies with the horse.
+    Every handshake first takes a token from open_limiter (see ratelimit).
+    """
+
+    def __init__(self, max_sessions=NETCONF_POOL_MAX_SESSIONS,
+                 idle_timeout=NETCONF_POOL_IDLE_TIMEOUT,
+                 probe_after=NETCONF_POOL_PROBE_AFTER,
+                 checkout_timeout=NETCONF_POOL_CHECKOUT_TIMEOUT,
+                 open_limiter=session_limiter):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.probe_after = probe_after
+        self.checkout_timeout = checkout_timeout
+        self.open_limiter = open_limiter
+
+        self._idle = OrderedDict()  # key -> [_PooledSession], oldest key first (LRU)
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+        self._hits = 0
+        self._misses = 0
+        self._handshake_total = 0.0
+        self._handshake_saved = 0.0
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+    @contextmanager
+    def session(self, device_ip: str, user: str, password: str, **device_kwargs):
+        """
+        Checks out an open jnpr Device for device_ip.
+        with device_pool.session(ip, DEVICE_USER, DEVICE_PASSWORD) as dev:
+            dev.rpc.get_vlan_information()
+        The session goes back to the pool unless the block failed with anything
+        but an RPC error the device answered. A timeout (ncclient's, RQ's job
+        timeout) can leave an RPC in flight, that session can't be reused.
+        """
+        entry = self._checkout((device_ip, user, self._secret(password)), password, device_kwargs)
+        broken = False
+        try:
+            yield entry.dev
+        except RpcError as e:
+            broken = isinstance(e, RpcTimeoutError)
+            raise
+        except BaseException:
+            broken = True
+            raise
+        finally:
+            self._checkin(entry, broken)
+
+    def discard(self, device_ip: str, user: str = None):
+        """
+        Closes idle sessions of a device, e.g. after its credentials or IP changed.
+        """
+        with self._cond:
+            for key in [k for k in self._idle if k[0] == device_ip and (user is None or k[1] == user)]:
+                for entry in self._idle.pop(key):
+                    self._close(entry)
+            self._update_gauges()
+            self._cond.notify_all()
+
+    def close_all(self):
+        with self._cond:
+            for entries in self._idle.values():
+                for entry in entries:
+                    self._close(entry)
+            self._idle.clear()
+            self._update_gauges()
+
+    def stats(self):
+        with self._cond:
+            checkouts = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / checkouts, 3) if checkouts else 0.0,
+                "idle_sessions": sum(len(v) for v in self._idle.values()),
+                "in_use_sessions": self._in_use,
+                "handshake_seconds_total": round(self._handshake_total, 3),
+                "handshake_seconds_saved": round(self._handshake_saved, 3),
+            }
+
+    # ------------------------------------------------------------------
+    # Internals
+    # ------------------------------------------------------------------
+    def _checkout(self, key, password, device_kwargs):
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._cond:
+            self._evict_idle()
+            while True:
+                entry = self._pop_idle(key)
+                if entry is not None:
+                    self._in_use += 1
+                    break
+                if self._total() < self.max_sessions or self._evict_lru():
+                    entry = None
+                    self._in_use += 1
+                    break
+                #Everything is checked out by other threads, wait for a release
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No NETCONF session slot free for {key[0]} after {self.checkout_timeout}s")
+                self._cond.wait(remaining)
+            self._update_gauges()
+
+        #Liveness check and handshake happen outside the lock, they do network I/O
+        try:
+            if entry is not None:
+                if self._is_alive(entry):
+                    self._record_hit(entry)
+                    return entry
+                POOL_CHECKOUTS.labels(result="stale").inc()
+                self._close(entry)
+            return self._open(key, password, device_kwargs)
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._update_gauges()
+                self._cond.notify_all()
+            raise
+
+    def _checkin(self, entry, broken):
+        with self._cond:
+            self._in_use -= 1
+            if broken or not entry.dev.connected:
+                self._close(entry)
+            else:
+                entry.last_used = time.monotonic()
+                self._idle.setdefault(entry.key, []).append(entry)
+                self._idle.move_to_end(entry.key)
+            self._update_gauges()
+            self._cond.notify_all()
+
+    @staticmethod
+    def _secret(password):
+        return hashlib.sha256((password or "").encode()).digest()
+
+    def _open(self, key, password, device_kwargs):
+        host, user, _ = key
+        if self.open_limiter is not None:
+            self.open_limiter.acquire(host)
+        start = time.perf_counter()
+        dev = Device(host=host, user=user, password=password, **device_kwargs)
+        dev.open()
+        elapsed = time.perf_counter() - start
+
+        POOL_HANDSHAKE.observe(elapsed)
+        POOL_CHECKOUTS.labels(result="miss").inc()
+        with self._cond:
+            self._misses += 1
+            self._handshake_total += elapsed
+        logger.debug(f"Opened NETCONF session to {host} in {elapsed:.2f}s")
+        return _PooledSession(key, dev, elapsed)
+
+    def _record_hit(self, entry):
+        POOL_CHECKOUTS.labels(result="hit").inc()
+        POOL_HANDSHAKE_SAVED.inc(entry.handshake_time)
+        with self._cond:
+            self._hits += 1
+            self._handshake_saved += entry.handshake_time
+
+    def _is_alive(self, entry):
+        dev = entry.dev
+        if not dev.connected or dev._conn is None or not dev._conn.connected:
+            return False
+        if time.monotonic() - entry.last_used < self.probe_after:
+            return True
+        try:
+            dev.rpc.get_system_uptime_information()
+            return True
+        except Exception as e:
+            logger.info(f"Pooled session to {entry.key[0]} failed liveness probe: {e}")
+            return False
+
+    def _pop_idle(self, key):
+        entries = self._idle.get(key)
+        if not entries:
+            return None
+        entry = entries.pop()
+        if not entries:
+            del self._idle[key]
+        return entry
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        for key in list(self._idle):
+            alive = []
+            for entry in self._idle[key]:
+                if now - entry.last_used > self.idle_timeout:
+                    self._close(entry)
+                else:
+                    alive.append(entry)
+            if alive:
+                self._idle[key] = alive
+            else:
+                del self._idle[key]
+
+    def _evict_lru(self):
+        """Closes the least recently used idle session to make room. False if nothing is idle."""
+        if not self._idle:
+            return False
+        key = next(iter(self._idle))
+        entries = self._idle[key]
+        self._close(entries.pop(0))
+        if not entries:
+            del self._idle[key]
+        return True
+
+    def _total(self):
+        return self._in_use + sum(len(v) for v in self._idle.values())
+
+    def _update_gauges(self):
+        POOL_SESSIONS.labels(state="idle").set(sum(len(v) for v in self._idle.values()))
+        POOL_SESSIONS.labels(state="in_use").set(self._in_use)
+
+    @staticmethod
+    def _close(entry):
+        try:
+            entry.dev.close()
+        except Exception as e:
+            logger.debug(f"Ignoring error while closing session to {entry.key[0]}: {e}")
+
+
+device_pool = DeviceSessionPool()
+atexit.register(device_pool.close_all)
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import logging
+import os
+
+from dotenv import load_dotenv
+from redis.exceptions import RedisError
+from sqlalchemy import event, func, select, tuple_
+from sqlalchemy.orm import Session
+
+from juniper_cfg.cache import MISSING, TTLCache, cache_redis, cache_redis_async, invalidation_bus
+from juniper_cfg.models import DeviceNet
+
+load_dotenv()
+
+logger = logging.getLogger("InventoryStats")
+
+#Upper bound on how stale the dashboard numbers get. Changes made through the ORM
+#drop the cache right away, core updates (e.g. sync_status) wait for the TTL.
+INVENTORY_STATS_TTL = int(os.getenv("INVENTORY_STATS_TTL", "30"))
+
+REDIS_KEY = "invstats"
+_local = TTLCache("inventory_stats", INVENTORY_STATS_TTL, maxsize=1)
+#One computation per process at a time, concurrent misses wait for it
+_compute_lock = asyncio.Lock()
+
+#Grouping columns, a row of the stats query is grouped by a subset of them
+COLUMNS = {
+    "sync_status": DeviceNet.sync_status,
+    "type": DeviceNet.type,
+    "model": DeviceNet.model,
+    "vendor": DeviceNet.vendor,
+    "os_version": DeviceNet.os_version,
+}
+#Columns of stats["global"]
+GLOBAL_COLUMNS = ("type", "model", "vendor")
+
+
+def stats_stmt():
+    """
+    Every number of the inventory dashboard in one scan of devices:
+    total, by sync status, by type, by model, by vendor and OS by vendor.
+    grouping(col) is 0 when the row is grouped by col, it tells a real NULL
+    from a column the grouping set leaves out. type, model and vendor are
+    counted with count(col) as the endpoint always did, their NULL group
+    ("Unknown") counts 0.
+    """
+    return (
+        select(*COLUMNS.values(),
+               *(func.grouping(column).label(f"g_{name}") for name, column in COLUMNS.items()),
+               func.count().label("devices"),
+               *(func.count(COLUMNS[name]).label(f"n_{name}") for name in GLOBAL_COLUMNS))
+        .group_by(func.grouping_sets(
+            tuple_(),
+            tuple_(DeviceNet.sync_status),
+            tuple_(DeviceNet.type),
+            tuple_(DeviceNet.model),
+            tuple_(DeviceNet.vendor),
+            tuple_(DeviceNet.vendor, DeviceNet.os_version),
+        ))
+    )
+
+
+def fold_stats(rows):
+    """
+    Rows of stats_stmt -> the /devices/inventory/stats response.
+    """
+    stats = {"total_devices": 0, "global": {name: {} for name in GLOBAL_COLUMNS}, "os_by_vendor": {}}
+    status_map = {}
+    for row in rows:
+        grouped = tuple(name for name in COLUMNS if getattr(row, f"g_{name}") == 0)
+        if grouped == ():
+            stats["total_devices"] = row.devices
+        elif grouped == ("sync_status",):
+            status_map[row.sync_status] = row.devices
+        elif grouped == ("vendor", "os_version"):
+            stats["os_by_vendor"].setdefault(row.vendor or "Unknown", {})[row.os_version or "Unknown"] = row.devices
+        else:
+            (name,) = grouped
+            stats["global"][name][getattr(row, name) or "Unknown"] = getattr(row, f"n_{name}")
+
+    stats["operational_count"] = status_map.get("synced", 0)
+    stats["failed_count"] = status_map.get("failed", 0)
+    stats["pending_count"] = status_map.get("pending", 0)
+    return stats
+
+
+async def compute_inventory_stats(db):
+    return fold_stats((await db.execute(stats_stmt())).all())
+
+
+async def get_inventory_stats(db):
+    """
+    Inventory stats from the process cache, then Redis, then one query.
+    """
+    stats = _local.get(REDIS_KEY)
+    if stats is not MISSING:
+        return stats
+
+    async with _compute_lock:
+        stats = _local.get(REDIS_KEY)
+        if stats is not MISSING:
+            return stats
+        try:
+            raw = await cache_redis_async.get(REDIS_KEY)
+            if raw is not None:
+                stats = json.loads(raw)
+                _local.set(REDIS_KEY, stats)
+                return stats
+        except RedisError as e:
+            logger.warning(f"Inventory stats Redis lookup failed: {e}")
+
+        stats = await compute_inventory_stats(db)
+        _local.set(REDIS_KEY, stats)
+        try:
+            await cache_redis_async.set(REDIS_KEY, json.dumps(stats), ex=INVENTORY_STATS_TTL)
+        except RedisError as e:
+            logger.warning(f"Inventory stats Redis store failed: {e}")
+        return stats
+
+
+def invalidate_inventory_stats():
+    try:
+        cache_redis.delete(REDIS_KEY)
+    except RedisError as e:
+        logger.warning(f"Inventory stats Redis invalidation failed: {e}")
+    invalidation_bus.publish("inventory_stats")
+
+
+invalidation_bus.subscribe("inventory_stats", lambda keys: _local.clear())
+
+
+# --- invalidation on devices changes ---
+# Same scheme as devcache: remember during the flush, drop after the commit.
+# Inserts count here too, a new device changes every total.
+
+@event.listens_for(DeviceNet, "after_insert")
+@event.listens_for(DeviceNet, "after_update")
+@event.listens_for(DeviceNet, "after_delete")
+def _device_changed(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info["invstats_dirty"] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _bulk_device_change(orm_execute_state):
+    if (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete) and \
+            any(mapper.class_ is DeviceNet for mapper in orm_execute_state.all_mappers):
+        orm_execute_state.session.info["invstats_dirty"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_invalidation(session):
+    if session.info.pop("invstats_dirty", False):
+        invalidate_inventory_stats()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_invalidation(session):
+    session.info.pop("invstats_dirty", None)
@@ -0,0 +1,349 @@
+import json
+import os
+import time
+
+from dotenv import load_dotenv
+from rq import Queue
+from rq.defaults import DEFAULT_FAILURE_TTL
+from rq.job import Job, JobStatus
+from rq.results import Result
+from rq.scheduler import RQScheduler
+from rq.utils import current_timestamp
+
+from juniper_cfg.serializer import JunoxSerializer, payload_ttl
+
+load_dotenv()
+
+#Seconds a job stays listed, older entries are trimmed whenever a job is indexed
+JOB_INDEX_RETENTION = int(os.getenv("JOB_INDEX_RETENTION", str(7 * 24 * 3600)))
+#Result TTL of jobs enqueued without one, and per job function overrides:
+#JOB_RESULT_TTLS="get_interfaces_job=3600,fetch_vlans_job=900"
+DEFAULT_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "500"))
+RESULT_TTLS = {
+    name.strip(): int(ttl)
+    for name, _, ttl in (item.partition("=") for item in os.getenv("JOB_RESULT_TTLS", "").split(",") if item.strip())
+}
+#How many index entries are read per round trip while filling a page
+SCAN_CHUNK = 200
+
+INDEX_KEY = "jobindex:all"
+#State transitions are published here as {"event": "status", "job_id", "status", ...},
+#next to the notifications the jobs send themselves
+JOB_CHANNEL = "job_notifications"
+STATUSES = [status.value for status in JobStatus]
+
+#Filters usable in list_jobs, most selective first: the first one given drives the scan
+FILTERS = ("target", "task_type", "status")
+
+#The index is a sorted set of job ids scored by created_at (jobindex:all) plus one
+#sorted set per filter value, e.g. jobindex:task_type:fetch_mac_table_job. The
+#jobindex:meta:{id} hash remembers which sets a job is in so it can be dropped.
+
+
+def _filter_key(field, value):
+    return f"jobindex:{field}:{value}"
+
+
+def _meta_key(job_id):
+    return f"jobindex:meta:{job_id}"
+
+
+def job_fields(job: Job) -> dict:
+    #Workflow steps all run workflow.run_step, list them as "<workflow>.<step>" and
+    #take their target (device id or IP) from the meta, their first argument is the workflow id
+    task_type = job.meta.get("workflow_step") or (job.func_name.split('.')[-1] if job.func_name else "Unknown")
+    target = job.meta.get("target") or (job.args[0] if job.args else "N/A")
+    return {
+        "task_type": task_type,
+        "target": str(target),
+        "queue": job.origin or "",
+    }
+
+
+def _score(job: Job) -> float:
+    return job.created_at.timestamp() if job.created_at else time.time()
+
+
+def index_job(job: Job, pipeline=None):
+    """
+    Adds a job to the index with its current status.
+    """
+    pipe = pipeline if pipeline is not None else job.connection.pipeline()
+    fields = job_fields(job)
+    status = job.get_status(refresh=False) or JobStatus.QUEUED
+    score = _score(job)
+    oldest = time.time() - JOB_INDEX_RETENTION
+
+    keys = [INDEX_KEY, _filter_key("task_type", fields["task_type"]), _filter_key("target", fields["target"])]
+    for key in keys:
+        pipe.zadd(key, {job.id: score})
+        pipe.zremrangebyscore(key, "-inf", oldest)
+    _set_status(pipe, job.id, status, score, oldest)
+    pipe.hset(_meta_key(job.id), mapping=fields)
+    pipe.expire(_meta_key(job.id), JOB_INDEX_RETENTION)
+    _publish_status(pipe, job, status, fields)
+    if pipeline is None:
+        pipe.execute()
+
+
+def update_job_status(job: Job, status=None):
+    """
+    Moves a job to its new status set (the job's own status when not given)
+    and announces the transition on JOB_CHANNEL.
+    """
+    status = status or job.get_status(refresh=False)
+    with job.connection.pipeline() as pipe:
+        _set_status(pipe, job.id, status, _score(job), time.time() - JOB_INDEX_RETENTION)
+        _publish_status(pipe, job, status, job_fields(job))
+        pipe.execute()
+
+
+def _publish_status(pipe, job, status, fields):
+    pipe.publish(JOB_CHANNEL, json.dumps({"event": "status", "job_id": job.id,
+                                          "status": getattr(status, "value", status), **fields}))
+
+
+def _set_status(pipe, job_id, status, score, oldest):
+    status = getattr(status, "value", status)
+    for other in STATUSES:
+        if other != status:
+            pipe.zrem(_filter_key("status", other), job_id)
+    pipe.zadd(_filter_key("status", status), {job_id: score})
+    pipe.zremrangebyscore(_filter_key("status", status), "-inf", oldest)
+
+
+def drop_jobs(connection, job_ids: list):
+    """
+    Removes jobs (e.g. expired from RQ) from every index set.
+    """
+    if not job_ids:
+        return
+    with connection.pipeline() as pipe:
+        for job_id in job_ids:
+            pipe.hmget(_meta_key(job_id), "task_type", "target")
+        metas = pipe.execute()
+    with connection.pipeline() as pipe:
+        for job_id, (task_type, target) in zip(job_ids, metas):
+            pipe.zrem(INDEX_KEY, job_id)
+            for status in STATUSES:
+                pipe.zrem(_filter_key("status", status), job_id)
+            if task_type:
+                pipe.zrem(_filter_key("task_type", task_type.decode()), job_id)
+            if target:
+                pipe.zrem(_filter_key("target", target.decode()), job_id)
+            pipe.delete(_meta_key(job_id))
+        pipe.execute()
+
+
+def encode_cursor(score, job_id):
+    return f"{score!r}:{job_id}"
+
+
+def decode_cursor(cursor):
+    score, _, job_id = cursor.partition(":")
+    return float(score), job_id
+
+
+def scan_job_ids(connection, limit: int, cursor: str = None, **filters):
+    """
+    Newest first ids of the jobs matching all filters (target, task_type, status),
+    at most limit of them, starting after cursor.
+    Returns (ids, next cursor or None).
+    """
+    keys = [_filter_key(field, filters[field]) for field in FILTERS if filters.get(field)]
+    driver, others = (keys[0], keys[1:]) if keys else (INDEX_KEY, [])
+
+    max_score, after_id = decode_cursor(cursor) if cursor else ("+inf", None)
+    ids = []
+    last = None
+    offset = 0
+    while len(ids) < limit:
+        raw = connection.zrevrangebyscore(driver, max_score, "-inf", start=offset, num=SCAN_CHUNK, withscores=True)
+        if not raw:
+            return ids, None
+        #Ties on the cursor score come back in reverse id order, skip those already returned
+        chunk = [(member, score) for member, score in raw
+                 if after_id is None or not (score == max_score and member.decode() >= after_id)]
+        if not chunk:
+            offset += len(raw)
+            continue
+
+        candidates = [member.decode() for member, _ in chunk]
+        if others:
+            with connection.pipeline() as pipe:
+                for key in others:
+                    pipe.zmscore(key, candidates)
+                found = pipe.execute()
+            matches = [all(scores[i] is not None for scores in found) for i in range(len(candidates))]
+        else:
+            matches = [True] * len(candidates)
+
+        for job_id, (_, score), match in zip(candidates, chunk, matches):
+            last = (score, job_id)
+            if match:
+                ids.append(job_id)
+                if len(ids) == limit:
+                    break
+        if len(ids) < limit and len(raw) < SCAN_CHUNK:
+            return ids, None
+        max_score, after_id = last
+        offset = 0
+    return ids, encode_cursor(*last)
+
+
+def fetch_jobs(connection, job_ids: list):
+    """
+    Jobs and their latest results in two pipelined round trips.
+    Returns [(job, result or None)...] for the jobs that still exist, in order;
+    ids whose job expired from RQ are dropped from the index.
+    """
+    jobs = Job.fetch_many(job_ids, connection=connection, serializer=JunoxSerializer)
+    missing = [job_id for job_id, job in zip(job_ids, jobs) if job is None]
+    jobs = [job for job in jobs if job is not None]
+    drop_jobs(connection, missing)
+
+    with connection.pipeline() as pipe:
+        for job in jobs:
+            pipe.xrevrange(Result.get_key(job.id), "+", "-", count=1)
+        latest = pipe.execute()
+
+    hydrated = []
+    for job, entries in zip(jobs, latest):
+        result = None
+        if entries:
+            result_id, payload = entries[0]
+            result = Result.restore(job.id, result_id.decode(), payload, connection=connection,
+                                    serializer=job.serializer)
+        hydrated.append((job, result))
+    return hydrated
+
+
+def fetch_job_statuses(connection, job_ids: list):
+    """
+    {job_id: (status or None if the job doesn't exist, latest Result or None)}
+    for many jobs in a single pipelined round trip.
+    """
+    with connection.pipeline(transaction=False) as pipe:
+        for job_id in job_ids:
+            pipe.hget(Job.key_for(job_id), "status")
+            pipe.xrevrange(Result.get_key(job_id), "+", "-", count=1)
+        replies = pipe.execute()
+
+    statuses = {}
+    for i, job_id in enumerate(job_ids):
+        status, entries = replies[2 * i], replies[2 * i + 1]
+        result = None
+        if status is not None and entries:
+            result_id, payload = entries[0]
+            result = Result.restore(job_id, result_id.decode(), payload, connection=connection,
+                                    serializer=JunoxSerializer)
+        statuses[job_id] = (status.decode() if status is not None else None, result)
+    return statuses
+
+
+def list_jobs(connection, limit: int = 50, cursor: str = None, **filters):
+    """
+    A page of jobs, newest first: ([(job, result)...], next cursor or None).
+    Jobs that expired from RQ are skipped, a page may then hold fewer than limit.
+    """
+    job_ids, next_cursor = scan_job_ids(connection, limit, cursor, **filters)
+    return fetch_jobs(connection, job_ids), next_cursor
+
+
+def backfill(queues: list, batch: int = 500):
+    """
+    One-off: indexes the jobs already in the queues and their registries,
+    e.g. python -c "from juniper_cfg.services import *; from juniper_cfg.jobindex import backfill; backfill([q, system_q, user_q])"
+    """
+    for queue in queues:
+        registries = [queue.started_job_registry, queue.finished_job_registry, queue.failed_job_registry,
+                      queue.deferred_job_registry, queue.scheduled_job_registry]
+        job_ids = set(queue.job_ids)
+        for registry in registries:
+            job_ids.update(registry.get_job_ids())
+        job_ids = list(job_ids)
+        for i in range(0, len(job_ids), batch):
+            with queue.connection.pipeline() as pipe:
+                for job in Job.fetch_many(job_ids[i:i + batch], connection=queue.connection,
+                                          serializer=queue.serializer):
+                    if job is not None:
+                        index_job(job, pipeline=pipe)
+                pipe.execute()
+
+
+def result_ttl_for(func_name: str) -> int:
+    return RESULT_TTLS.get(func_name.split('.')[-1], DEFAULT_RESULT_TTL) if func_name else DEFAULT_RESULT_TTL
+
+
+class IndexedQueue(Queue):
+    """
+    RQ queue for junox jobs: JunoxSerializer by default, result TTL by job type
+    (RESULT_TTLS) and every job it enqueues or schedules added to the job index.
+    Every way into the queue ends in _enqueue_job: enqueue(), Job.create +
+    enqueue_job, dependents of a finished job and retries, as long as the worker
+    runs with --queue-class juniper_cfg.jobindex.IndexedQueue.
+    """
+
+    def __init__(self, name="default", *args, **kwargs):
+        kwargs.setdefault("serializer", JunoxSerializer)
+        super().__init__(name, *args, **kwargs)
+
+    def _prepare(self, job):
+        #Jobs built with Job.create get RQ's default serializer, it can't read ours
+        job.serializer = self.serializer
+        if job.result_ttl is None:
+            job.result_ttl = result_ttl_for(job.func_name)
+        #Serialize the job data now, arguments offloaded to job_blobs live as long as the job
+        #(a failed one is kept for its failure TTL). Data already serialized stays as it is.
+        ttls = (job.result_ttl, job.failure_ttl or DEFAULT_FAILURE_TTL)
+        with payload_ttl(-1 if -1 in ttls else max(ttls)):
+            job.data
+
+    def enqueue_job(self, job, pipeline=None, at_front=False):
+        self._prepare(job)
+        job = super().enqueue_job(job, pipeline=pipeline, at_front=at_front)
+        if job.get_status(refresh=False) == JobStatus.DEFERRED:
+            #Waits for the jobs it depends on, _enqueue_job indexes it again once they finished
+            index_job(job, pipeline=pipeline)
+        return job
+
+    def _enqueue_job(self, job, pipeline=None, at_front=False):
+        self._prepare(job)
+        job = super()._enqueue_job(job, pipeline=pipeline, at_front=at_front)
+        index_job(job, pipeline=pipeline)
+        return job
+
+    def schedule_job(self, job, datetime, pipeline=None):
+        #enqueue_at/enqueue_in and retries with an interval, IndexedScheduler enqueues them later
+        self._prepare(job)
+        job = super().schedule_job(job, datetime, pipeline=pipeline)
+        index_job(job, pipeline=pipeline)
+        return job
+
+
+class IndexedScheduler(RQScheduler):
+    """
+    RQ scheduler that enqueues due jobs through IndexedQueue. RQ's own builds a
+    plain Queue, the index would keep the jobs as scheduled until they start.
+    """
+
+    def enqueue_scheduled_jobs(self):
+        self._status = self.Status.WORKING
+
+        if not self._scheduled_job_registries and self._acquired_locks:
+            self.prepare_registries()
+
+        for registry in self._scheduled_job_registries:
+            job_ids = registry.get_jobs_to_schedule(current_timestamp())
+            if not job_ids:
+                continue
+
+            queue = IndexedQueue(registry.name, connection=self.connection, serializer=self.serializer)
+            with self.connection.pipeline() as pipeline:
+                for job in Job.fetch_many(job_ids, connection=self.connection, serializer=self.serializer):
+                    if job is not None:
+                        queue._enqueue_job(job, pipeline=pipeline, at_front=bool(job.enqueue_at_front))
+                for job_id in job_ids:
+                    registry.remove(job_id, pipeline=pipeline)
+                pipeline.execute()
+        self._status = self.Status.STARTED
@@ -0,0 +1,85 @@
+import json
+import os
+import re
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+#Lines kept per session (approximate, trimming is done in whole nodes by Redis)
+LOG_STREAM_MAXLEN = int(os.getenv("LOG_STREAM_MAXLEN", "2000"))
+#Seconds a session's stream survives after its last line
+LOG_STREAM_TTL = int(os.getenv("LOG_STREAM_TTL", "3600"))
+REPLAY_PAGE_SIZE = 500
+
+#XADD, trim, refresh the TTL and notify live listeners in one round trip. Running
+#it as a script also keeps the PUBLISH order identical to the stream order.
+_APPEND_LUA = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'm', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('PUBLISH', ARGV[4], cjson.encode({id = id, message = ARGV[3]}))
+return id
+"""
+
+_STREAM_ID = re.compile(r"^(\d+)-(\d+)$")
+_scripts = {}
+
+
+def log_channel(session_id) -> str:
+    return f"logs_{session_id}"
+
+
+def log_stream_key(session_id) -> str:
+    return f"logstream:{session_id}"
+
+
+def append_log(redis_conn, session_id, message: str):
+    """
+    Appends a line to the session's log stream and publishes it on logs_{session_id}
+    as {"id": <stream id>, "message": ...}. Returns the stream id.
+    """
+    script = _scripts.get(id(redis_conn))
+    if script is None:
+        script = _scripts[id(redis_conn)] = redis_conn.register_script(_APPEND_LUA)
+    stream_id = script(keys=[log_stream_key(session_id)],
+                       args=[LOG_STREAM_MAXLEN, LOG_STREAM_TTL, message, log_channel(session_id)])
+    return stream_id.decode() if isinstance(stream_id, bytes) else stream_id
+
+
+def parse_stream_id(stream_id):
+    """
+    "1718000000000-3" -> (1718000000000, 3), comparable; None if it isn't a stream id.
+    """
+    match = _STREAM_ID.match(stream_id or "")
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def decode_live(data):
+    """
+    Payload published by append_log -> (stream id, message).
+    Plain text from an older publisher comes back as (None, text).
+    """
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    try:
+        payload = json.loads(data)
+        return payload["id"], payload["message"]
+    except (ValueError, TypeError, KeyError):
+        return None, data
+
+
+async def replay_log(redis_async, session_id, after: str = "0"):
+    """
+    Yields (stream id, message) stored for the session after the id `after`
+    ("0" = from the beginning), oldest first, in pages of REPLAY_PAGE_SIZE.
+    redis_async must decode responses.
+    """
+    key = log_stream_key(session_id)
+    start = "-" if after in (None, "", "0", "0-0") else f"({after}"
+    while True:
+        entries = await redis_async.xrange(key, min=start, max="+", count=REPLAY_PAGE_SIZE)
+        for stream_id, fields in entries:
+            yield stream_id, fields.get("m", "")
+        if len(entries) < REPLAY_PAGE_SIZE:
+            return
+        start = f"({entries[-1][0]}"
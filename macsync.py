@@ -0,0 +1,140 @@
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+from prometheus_client import Counter, Histogram
+
+from juniper_cfg.bulkcopy import copy_rows, device_transaction
+
+load_dotenv()
+
+logger = logging.getLogger("MacSync")
+
+#last_seen of an unchanged entry is only rewritten when it is older than this,
+#otherwise every poll would rewrite every row just to bump a timestamp
+MAC_LAST_SEEN_RESOLUTION = int(os.getenv("MAC_LAST_SEEN_RESOLUTION", "900"))
+
+MAC_DELTA_ROWS = Counter('mac_sync_rows_total', 'MAC table rows written by delta sync', ['change'])
+MAC_SYNC_DURATION = Histogram('mac_sync_duration_seconds', 'Time spent syncing the MAC table of one device')
+
+_CREATE_STAGE = """
+CREATE TEMP TABLE mac_stage (
+    address varchar(17),
+    vlan_id integer,
+    interface varchar(50)
+) ON COMMIT DROP
+"""
+
+#Same MAC/VLAN on another interface: the host moved ports
+_UPDATE_MOVED = """
+UPDATE mac_table m
+SET interface = s.interface, last_seen = now()
+FROM mac_stage s
+WHERE m.device_id = %(device_id)s
+  AND m.address = s.address AND m.vlan_id = s.vlan_id
+  AND m.interface IS DISTINCT FROM s.interface
+"""
+
+_TOUCH_UNCHANGED = """
+UPDATE mac_table m
+SET last_seen = now()
+FROM mac_stage s
+WHERE m.device_id = %(device_id)s
+  AND m.address = s.address AND m.vlan_id = s.vlan_id
+  AND m.interface = s.interface
+  AND m.last_seen < now() - make_interval(secs => %(resolution)s)
+"""
+
+#Runs before the delete so a MAC that changed VLAN keeps the first_seen of its old row,
+#those are counted as moves rather than new hosts. Only rows leaving with this poll
+#count as the old row: a MAC showing up on a second VLAN is a new entry.
+_INSERT_NEW = """
+WITH inserted AS (
+    INSERT INTO mac_table (address, vlan_id, interface, device_id, first_seen, last_seen)
+    SELECT s.address, s.vlan_id, s.interface, %(device_id)s,
+           COALESCE((SELECT min(m.first_seen) FROM mac_table m
+                     WHERE m.device_id = %(device_id)s AND m.address = s.address
+                       AND NOT EXISTS (SELECT 1 FROM mac_stage g
+                                       WHERE g.address = m.address AND g.vlan_id = m.vlan_id)), now()),
+           now()
+    FROM mac_stage s
+    WHERE NOT EXISTS (SELECT 1 FROM mac_table m
+                      WHERE m.device_id = %(device_id)s
+                        AND m.address = s.address AND m.vlan_id = s.vlan_id)
+    ON CONFLICT ON CONSTRAINT uq_mac_device_address_vlan DO NOTHING
+    RETURNING first_seen
+)
+SELECT count(*), count(*) FILTER (WHERE first_seen < now()) FROM inserted
+"""
+
+_DELETE_GONE = """
+DELETE FROM mac_table m
+WHERE m.device_id = %(device_id)s
+  AND NOT EXISTS (SELECT 1 FROM mac_stage s
+                  WHERE s.address = m.address AND s.vlan_id = m.vlan_id)
+"""
+
+
+def sync_mac_table_delta(device_id: int, mac_chunks, resolution=MAC_LAST_SEEN_RESOLUTION):
+    """
+    Brings mac_table of the device in line with the polled table, writing only what changed.
+    The poll is COPYed into a temp table and diffed against the stored rows with
+    set based statements, all in one transaction:
+      - moved: same MAC and VLAN on another interface, or a MAC that changed VLAN
+      - added: MAC/VLAN not stored yet (first_seen = now)
+      - removed: stored MAC/VLAN missing from the poll (the old row of a VLAN move too)
+      - refreshed: unchanged rows whose last_seen was older than `resolution` seconds
+    mac_chunks are lists of {"mac", "vlan", "interface"} dicts; VLAN names are resolved
+    against the VLANs of the device. Entries on VLANs the device isn't known to have
+    are skipped (counted and logged) until a VLAN sync brings them in.
+    """
+    started = time.perf_counter()
+    params = {"device_id": device_id, "resolution": resolution}
+    unknown_vlans = {}
+
+    def resolved(chunk):
+        for entry in chunk:
+            vlan_id = vlan_ids.get(entry["vlan"])
+            if vlan_id is None:
+                unknown_vlans[entry["vlan"]] = unknown_vlans.get(entry["vlan"], 0) + 1
+                continue
+            yield entry["mac"], vlan_id, entry["interface"]
+
+    with device_transaction(device_id) as cursor:
+        cursor.execute("SELECT vlan_name, vlan_id FROM vlans WHERE device_id = %s", (device_id,))
+        vlan_ids = dict(cursor.fetchall())
+
+        cursor.execute(_CREATE_STAGE)
+        entries = 0
+        for chunk in mac_chunks:
+            entries += copy_rows(cursor, "mac_stage", ("address", "vlan_id", "interface"), resolved(chunk))
+        cursor.execute("CREATE INDEX ON mac_stage (address, vlan_id)")
+        cursor.execute("ANALYZE mac_stage")
+
+        cursor.execute(_UPDATE_MOVED, params)
+        moved_port = cursor.rowcount
+        cursor.execute(_TOUCH_UNCHANGED, params)
+        refreshed = cursor.rowcount
+        cursor.execute(_INSERT_NEW, params)
+        inserted, moved_vlan = cursor.fetchone()
+        cursor.execute(_DELETE_GONE, params)
+        removed = cursor.rowcount
+
+    if unknown_vlans:
+        logger.warning(f"MAC table of device {device_id}: {sum(unknown_vlans.values())} entries on "
+                       f"unknown VLANs skipped: {sorted(unknown_vlans)}")
+    delta = {
+        "entries": entries,
+        "skipped": sum(unknown_vlans.values()),
+        "added": inserted - moved_vlan,
+        "removed": removed,
+        "moved": moved_port + moved_vlan,
+        "refreshed": refreshed,
+    }
+    for change in ("added", "removed", "moved", "refreshed"):
+        MAC_DELTA_ROWS.labels(change=change).inc(delta[change])
+    elapsed = time.perf_counter() - started
+    MAC_SYNC_DURATION.observe(elapsed)
+    logger.info(f"MAC table of device {device_id} synced in {elapsed:.3f}s: {delta}")
+    return delta
@@ -1,13 +1,13 @@
 from fastapi import FastAPI, Depends
 from juniper_cfg.routers import auth_routes,device_routes,vlan_routes,other_routes,interface_routes
-from juniper_cfg.auth import get_current_user
+from juniper_cfg.auth import get_current_user_async
 
 #WebSocket
 import asyncio
-import redis.asyncio as aioredis
 from fastapi import WebSocket, WebSocketDisconnect
-from dotenv import load_dotenv
-import os
+import json
+from juniper_cfg.wshub import log_hub, job_hub
+from juniper_cfg.logstream import log_channel, replay_log, decode_live, parse_stream_id
 
 #Prometeus Grafana
 from fastapi import FastAPI
@@ -17,12 +17,6 @@ from prometheus_client import Gauge
 from juniper_cfg.database import engine  # Import your pooled engine
 
 
-# WebSocket
-load_dotenv()
-REDIS_HOST = os.getenv("REDIS_HOST")
-REDIS_PORT = os.getenv("REDIS_PORT")
-redis_client = aioredis.from_url(f"redis://{REDIS_HOST}:{REDIS_PORT}", decode_responses=True)
-
 app = FastAPI(
     title="JunoX API",
     version="0.1.0",
@@ -34,25 +28,25 @@ app.include_router(auth_routes.router, prefix="/api/v1")
 # 2. Protected routes: AUTH
 app.include_router(
     device_routes.router,
-    dependencies=[Depends(get_current_user)],
+    dependencies=[Depends(get_current_user_async)],
     prefix="/api/v1"
 )
 
 app.include_router(
     interface_routes.router,
-    dependencies=[Depends(get_current_user)],
+    dependencies=[Depends(get_current_user_async)],
     prefix="/api/v1"
 )
 
 app.include_router(
     vlan_routes.router,
-    dependencies=[Depends(get_current_user)],
+    dependencies=[Depends(get_current_user_async)],
     prefix="/api/v1"
 )
 
 app.include_router(
     other_routes.router,
-    dependencies=[Depends(get_current_user)],
+    dependencies=[Depends(get_current_user_async)],
     prefix="/api/v1"
 )
 
@@ -76,7 +70,7 @@ JOBS_PROCESSED = Counter('eda_jobs_total', 'Total number of EDA jobs processed',
 JOB_LATENCY = Histogram('eda_job_duration_seconds', 'Time spent processing job', ['job_type'])
 # 1. Define Gauges (Gauges can go up AND down, perfect for pools)
 DB_POOL_SIZE = Gauge('db_pool_checkedin_connections', 'Connections currently in the pool')
-DB_POOL_CHECKEDOUT = Gauge('db_pool_checkedout_connections', 'Connections currently being used')
+# db_pool_checkedout_connections lives in database.py
 
 # 2. The Metrics Endpoint for Prometheus to "Scrape"
 @app.get("/metrics")
@@ -90,40 +84,73 @@ def metrics():
     # Extract numbers from the status string (SQLAlchemy specific)
     # Usually: "Pool size: 10  Connections in pool: 5 Current Overflow: 0"
     DB_POOL_SIZE.set(engine.pool.checkedin())
-    DB_POOL_CHECKEDOUT.set(engine.pool.checkedout())
 
     return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 
 
+@app.on_event("shutdown")
+async def close_hubs():
+    await log_hub.close()
+    await job_hub.close()
+
+
 @app.websocket("/ws/logs/{session_id}")
-async def websocket_endpoint(websocket: WebSocket, session_id: str):
+async def websocket_endpoint(websocket: WebSocket, session_id: str, last_id: str = "0", ids: bool = False):
+    """
+    Streams the provisioning log of a session.
+    last_id: "0" replays the session from the start, a stream id resumes after
+    that line, "$" sends only new lines.
+    ids: send {"id": ..., "message": ...} frames so the client can resume with last_id.
+    """
     await websocket.accept()
-    key = f"logs_{session_id}"
-    
-    try:
+    # Messages come from the process-wide log hub, not from a pubsub of our own.
+    # Subscribe before replaying so nothing falls between the two.
+    subscription = log_hub.subscribe(log_channel(session_id))
+    sent = parse_stream_id(last_id)
+
+    async def send(stream_id, message):
+        nonlocal sent
+        position = parse_stream_id(stream_id)
+        if position is not None:
+            # Lines published during the replay arrive twice, keep the first
+            if sent is not None and position <= sent:
+                return
+            sent = position
+        await websocket.send_text(json.dumps({"id": stream_id, "message": message}) if ids else message)
+
+    async def forward():
         # 1. Immediate acknowledgement
         await websocket.send_text("--- 📡 Established link to background worker ---")
-
-        # 2. Listen to Redis PubSub
-        async with redis_client.pubsub() as pubsub:
-            await pubsub.subscribe(key)
-            
-            while True:
-                # Listen for messages from the Worker
-                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
-                
-                if message:
-                    data = message["data"]
-                    # Handle both byte and string data safely
-                    decoded_data = data.decode('utf-8') if isinstance(data, bytes) else data
-                    await websocket.send_text(decoded_data)
-                
-                # Keep the connection alive and loop responsive
-                await asyncio.sleep(0.01)
-
+        # 2. What was logged before we connected
+        if last_id != "$":
+            async for stream_id, message in replay_log(log_hub.r, session_id, last_id):
+                await send(stream_id, message)
+        # 3. Relay what the worker publishes, drop the client if it fell behind
+        while True:
+            data = await subscription.queue.get()
+            if subscription.overflowed:
+                await websocket.close(code=1013, reason="Client too slow, reconnect")
+                return
+            await send(*decode_live(data))
+
+    async def wait_disconnect():
+        # Notices a closed client even when no logs are flowing
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    tasks = [asyncio.create_task(forward()), asyncio.create_task(wait_disconnect())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+        print(f"User closed session {session_id}")
     except WebSocketDisconnect:
         print(f"User closed session {session_id}")
     except Exception as e:
-        print(f"WebSocket Error: {e}")
\ No newline at end of file
+        print(f"WebSocket Error: {e}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        log_hub.unsubscribe(subscription)
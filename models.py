@@ -1,4 +1,4 @@
-from sqlalchemy import DateTime, String, ForeignKey, Integer, BigInteger, Boolean,UniqueConstraint,Column,Text
+from sqlalchemy import func, DateTime, String, ForeignKey, Integer, BigInteger, Boolean,UniqueConstraint,Column,Text,LargeBinary
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from .database import Base
 from typing import List
@@ -18,6 +18,7 @@ class DeviceNet(Base):
     serialnumber: Mapped[str] = mapped_column(String(20) , nullable=False ,server_default="XXXXXX")
     sync_status: Mapped[str] = mapped_column(String(20), server_default="pending", nullable=False)
     last_synced: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    last_sync_attempt: Mapped[datetime] = mapped_column(DateTime, nullable=True) #set by failed syncs too
     region: Mapped[str] = mapped_column(String(15), nullable=False,server_default="region")
     site: Mapped[str] = mapped_column(String(15), nullable=False,server_default="site")
  
@@ -59,12 +60,19 @@ class EthInterfaces(Base):
 class MacTable(Base):
     __tablename__ = "mac_table"
     id: Mapped[int] = mapped_column(primary_key=True)
-    address: Mapped[str] = mapped_column(String(17))
+    address: Mapped[str] = mapped_column(String(17), index=True) #fleet wide MAC lookups
     vlan_id: Mapped[int] = mapped_column(Integer)
     interface: Mapped[str] = mapped_column(String(50))
+    first_seen: Mapped[datetime] = mapped_column(DateTime, server_default=func.now(), nullable=True)
+    last_seen: Mapped[datetime] = mapped_column(DateTime, server_default=func.now(), nullable=True)
     device_id: Mapped[int] = mapped_column(ForeignKey("devices.id", ondelete="CASCADE"))
     device: Mapped["DeviceNet"] = relationship(back_populates="mac_entries")
 
+    #one row per MAC and VLAN on a device, also the index of the delta sync (see macsync)
+    __table_args__ = (
+        UniqueConstraint("device_id", "address", "vlan_id", name="uq_mac_device_address_vlan"),
+    )
+
 class VLANs(Base):
     __tablename__ = "vlans"
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -72,6 +80,11 @@ class VLANs(Base):
     vlan_name: Mapped[str] = mapped_column(String(50))
     device_id: Mapped[int] = mapped_column(ForeignKey("devices.id", ondelete="CASCADE"))
     device: Mapped["DeviceNet"] = relationship(back_populates="vlans")
+
+    #a vlan exists once per device, the VLAN sync upserts against this
+    __table_args__ = (
+        UniqueConstraint("device_id", "vlan_id", name="uq_device_vlan"),
+    )
     
 class VlanCatalog(Base):
     __tablename__ = "vlan_catalog"
@@ -88,7 +101,7 @@ class ArpTable(Base):
     ip_address: Mapped[str] = mapped_column(String(15))
     mac_address: Mapped[str] = mapped_column(String(17))
     interface: Mapped[str] = mapped_column(String(50))
-    device_id: Mapped[int] = mapped_column(ForeignKey("devices.id", ondelete="CASCADE"))
+    device_id: Mapped[int] = mapped_column(ForeignKey("devices.id", ondelete="CASCADE"), index=True)
     device: Mapped["DeviceNet"] = relationship(back_populates="arp_entries")
 
 class RoutingTable(Base):
@@ -101,7 +114,7 @@ class RoutingTable(Base):
     age: Mapped[str] = mapped_column(String(20), nullable=True)
 
     # Link to the device
-    device_id: Mapped[int] = mapped_column(ForeignKey("devices.id", ondelete="CASCADE"))
+    device_id: Mapped[int] = mapped_column(ForeignKey("devices.id", ondelete="CASCADE"), index=True)
     device: Mapped["DeviceNet"] = relationship(back_populates="routing_entries")
 
 
@@ -111,4 +124,17 @@ class User(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     username: Mapped[str] = mapped_column(String(50), unique=True, index=True)
     hashed_password: Mapped[str] = mapped_column(String(255))
-    is_active: Mapped[bool] = mapped_column(Boolean, default=True)    
\ No newline at end of file
+    is_active: Mapped[bool] = mapped_column(Boolean, default=True)    
+
+
+class JobBlob(Base):
+    """
+    RQ job data/results too big to keep in Redis (see serializer.JunoxSerializer),
+    Redis holds the id only.
+    """
+    __tablename__ = "job_blobs"
+
+    id: Mapped[str] = mapped_column(String(32), primary_key=True)
+    payload: Mapped[bytes] = mapped_column(LargeBinary)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+    expires_at: Mapped[datetime] = mapped_column(DateTime, index=True)
@@ -0,0 +1,147 @@
+import time
+import uuid
+
+from rq import Callback
+from rq.job import Job
+
+from juniper_cfg.services import system_q, redis_conn
+from juniper_cfg.tasks import provision_device_job, provision_device_single_session_job
+
+#Batch bookkeeping lives in Redis next to the jobs themselves
+BATCH_TTL = 7 * 24 * 3600
+
+PROVISION_JOBS = {
+    "chain": provision_device_job,
+    "single_session": provision_device_single_session_job,
+}
+
+
+def _batch_key(batch_id):
+    return f"provision_batch:{batch_id}"
+
+def _lane_key(batch_id, site):
+    return f"provision_batch:{batch_id}:lane:{site}"
+
+
+def create_provision_batch(targets: list, username: str, password: str,
+                           mode: str = "single_session", concurrency: int = 10,
+                           session_id: str = None, skipped: list = None):
+    """
+    targets is a list of {"device_ip": ..., "site": ..., "region": ...}.
+    Every target gets its job created up front, but only `concurrency` jobs
+    per site are enqueued. The rest wait in a per-site lane and are enqueued
+    by the completion callbacks, one for every job that finishes.
+    """
+    batch_id = str(uuid.uuid4())
+    job_func = PROVISION_JOBS[mode]
+    lanes = {}
+    jobs = []
+
+    for target in targets:
+        job = Job.create(
+            job_func,
+            args=(target["device_ip"], username, password, session_id),
+            connection=redis_conn,
+            serializer=system_q.serializer,
+            on_success=Callback(batch_job_succeeded),
+            on_failure=Callback(batch_job_failed),
+        )
+        job.meta = {
+            "session_id": session_id,
+            "run_chain": True,
+            "batch_id": batch_id,
+            "site": target.get("site"),
+            "region": target.get("region"),
+        }
+        jobs.append(job)
+        lanes.setdefault(target.get("site") or "default", []).append(job.id)
+
+    batch_key = _batch_key(batch_id)
+    with redis_conn.pipeline() as pipe:
+        for job in jobs:
+            job.save(pipeline=pipe)
+        pipe.hset(batch_key, mapping={
+            "total": len(targets),
+            "enqueued": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "skipped": len(skipped or []),
+            "concurrency": concurrency,
+            "mode": mode,
+            "created_at": int(time.time()),
+        })
+        pipe.expire(batch_key, BATCH_TTL)
+        for site, job_ids in lanes.items():
+            pipe.rpush(_lane_key(batch_id, site), *job_ids)
+            pipe.expire(_lane_key(batch_id, site), BATCH_TTL)
+            pipe.rpush(f"{batch_key}:jobs", *job_ids)
+        pipe.expire(f"{batch_key}:jobs", BATCH_TTL)
+        pipe.execute()
+
+    #Fill every lane up to the concurrency cap
+    for site in lanes:
+        for _ in range(concurrency):
+            if not _enqueue_next(batch_id, site):
+                break
+
+    return {
+        "batch_id": batch_id,
+        "total": len(targets),
+        "sites": {site: len(job_ids) for site, job_ids in lanes.items()},
+    }
+
+
+def get_batch_progress(batch_id: str):
+    """
+    Aggregated progress of a batch or None if it doesn't exist (or expired).
+    """
+    data = redis_conn.hgetall(_batch_key(batch_id))
+    if not data:
+        return None
+    data = {k.decode(): v.decode() for k, v in data.items()}
+    counts = {key: int(data[key]) for key in ("total", "enqueued", "succeeded", "failed", "skipped", "concurrency")}
+    done = counts["succeeded"] + counts["failed"]
+    return {
+        "batch_id": batch_id,
+        "mode": data.get("mode"),
+        **counts,
+        "running": counts["enqueued"] - done,
+        "pending": counts["total"] - counts["enqueued"],
+        #A batch whose targets were all skipped has nothing to wait for
+        "completed": done >= counts["total"],
+        "job_ids": [job_id.decode() for job_id in redis_conn.lrange(f"{_batch_key(batch_id)}:jobs", 0, -1)],
+    }
+
+
+def _enqueue_next(batch_id, site):
+    job_id = redis_conn.lpop(_lane_key(batch_id, site))
+    if job_id is None:
+        return False
+    job = Job.fetch(job_id.decode(), connection=redis_conn, serializer=system_q.serializer)
+    system_q.enqueue_job(job)
+    redis_conn.hincrby(_batch_key(batch_id), "enqueued", 1)
+    return True
+
+
+def _job_done(job, succeeded):
+    batch_id = job.meta.get("batch_id")
+    if not batch_id:
+        return
+    redis_conn.hincrby(_batch_key(batch_id), "succeeded" if succeeded else "failed", 1)
+    _enqueue_next(batch_id, job.meta.get("site") or "default")
+
+
+def batch_job_succeeded(job, connection, result, *args, **kwargs):
+    """
+    RQ on_success callback. Provisioning jobs report most errors as a result
+    dict instead of raising, so the result decides what we count.
+    """
+    failed = isinstance(result, dict) and result.get("status") == "Error"
+    _job_done(job, succeeded=not failed)
+
+
+def batch_job_failed(job, connection, type, value, traceback):
+    """
+    RQ on_failure callback.
+    """
+    _job_done(job, succeeded=False)
@@ -0,0 +1,188 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from dotenv import load_dotenv
+from prometheus_client import Counter, Histogram
+from rq import get_current_job
+from sqlalchemy import select
+
+from juniper_cfg.cache import MISSING, TTLCache
+from juniper_cfg.database import engine
+from juniper_cfg.models import DeviceNet
+from juniper_cfg.services import redis_conn
+
+load_dotenv()
+
+logger = logging.getLogger("SessionRateLimit")
+
+#NETCONF session opens allowed per minute and burst, per device, per site and per
+#region, across all worker processes. A rate of 0 turns that limit off.
+NETCONF_OPENS_PER_DEVICE = float(os.getenv("NETCONF_OPENS_PER_DEVICE", "6"))
+NETCONF_BURST_PER_DEVICE = int(os.getenv("NETCONF_BURST_PER_DEVICE", "3"))
+NETCONF_OPENS_PER_SITE = float(os.getenv("NETCONF_OPENS_PER_SITE", "60"))
+NETCONF_BURST_PER_SITE = int(os.getenv("NETCONF_BURST_PER_SITE", "10"))
+NETCONF_OPENS_PER_REGION = float(os.getenv("NETCONF_OPENS_PER_REGION", "600"))
+NETCONF_BURST_PER_REGION = int(os.getenv("NETCONF_BURST_PER_REGION", "50"))
+#How long an open waits for budget outside a deferrable job before it fails
+NETCONF_RATE_WAIT = float(os.getenv("NETCONF_RATE_WAIT", "30"))
+#Site/region of a device are looked up once per this many seconds per process
+DEVICE_SCOPE_TTL = int(os.getenv("DEVICE_SCOPE_TTL", "300"))
+
+SESSION_OPENS = Counter('netconf_session_opens_total', 'NETCONF session opens through the rate limiter',
+                        ['result'])
+RATE_LIMITED = Counter('netconf_rate_limited_total', 'Session opens refused for lack of budget', ['scope'])
+RATE_LIMIT_WAIT = Histogram('netconf_rate_limit_wait_seconds', 'Time a session open waited for budget',
+                            buckets=(.01, .1, .5, 1, 2, 5, 10, 30, 60))
+
+#Takes one token from every bucket or from none: returns {0, 0} when granted,
+#else {ms until all buckets have a token, index of the emptiest bucket}.
+#Buckets are hashes {tokens, ts}, refilled by elapsed time on the Redis clock.
+_TAKE = """
+local t = redis.call('TIME')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+local levels = {}
+local wait, scope = 0, 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1])
+    local burst = tonumber(ARGV[2 * i])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < 1 then
+        local need = math.ceil((1 - tokens) / rate)
+        if need > wait then
+            wait, scope = need, i
+        end
+    end
+end
+if wait > 0 then
+    return {wait, scope}
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', levels[i] - 1, 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(tonumber(ARGV[2 * i]) / tonumber(ARGV[2 * i - 1])))
+end
+return {0, 0}
+"""
+
+
+class SessionRateLimited(Exception):
+    def __init__(self, message, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Deferral:
+    def __init__(self, wait):
+        self.wait = wait
+        self.retry_after = None
+
+
+_deferral = ContextVar("netconf_rate_deferral", default=None)
+
+
+@contextmanager
+def defer_rate_limits(wait: float):
+    """
+    Inside the block a session open over budget gives up after wait seconds
+    and the deferral remembers when to try again, even if the caller turned
+    the SessionRateLimited into an error result.
+    """
+    deferral = _Deferral(wait)
+    token = _deferral.set(deferral)
+    try:
+        yield deferral
+    finally:
+        _deferral.reset(token)
+
+
+_scopes = TTLCache("device_scope", DEVICE_SCOPE_TTL)
+
+
+def device_scope(device_ip: str):
+    """
+    (site, region) of a device, (None, None) for devices not in the inventory yet.
+    """
+    scope = _scopes.get(device_ip)
+    if scope is MISSING:
+        stmt = select(DeviceNet.site, DeviceNet.region).where(DeviceNet.ip_address == device_ip).limit(1)
+        with engine.connect() as conn:
+            row = conn.execute(stmt).first()
+        scope = (row.site, row.region) if row else (None, None)
+        _scopes.set(device_ip, scope)
+    return scope
+
+
+class SessionRateLimiter:
+    """
+    Token buckets on NETCONF session opens per device, per site and per region,
+    shared by every process through Redis. Only opens count: a session reused
+    from the pool costs nothing.
+    """
+
+    def __init__(self, redis_conn, wait=NETCONF_RATE_WAIT):
+        self.r = redis_conn
+        self.wait = wait
+        self._take = redis_conn.register_script(_TAKE)
+        self.limits = {
+            "device": (NETCONF_OPENS_PER_DEVICE, NETCONF_BURST_PER_DEVICE),
+            "site": (NETCONF_OPENS_PER_SITE, NETCONF_BURST_PER_SITE),
+            "region": (NETCONF_OPENS_PER_REGION, NETCONF_BURST_PER_REGION),
+        }
+
+    def _buckets(self, device_ip):
+        site, region = device_scope(device_ip)
+        job = get_current_job()
+        if job is not None:
+            #A device being provisioned isn't in the inventory yet, bulk provisioning
+            #passes its site/region in the job meta
+            site = site or job.meta.get("site")
+            region = region or job.meta.get("region")
+        names = {"device": device_ip, "site": site, "region": region}
+        buckets = []
+        for scope, (per_minute, burst) in self.limits.items():
+            if per_minute > 0 and names[scope]:
+                buckets.append((scope, f"netconf_rate:{scope}:{names[scope]}", per_minute / 60000, max(burst, 1)))
+        return buckets
+
+    def acquire(self, device_ip: str):
+        """
+        Takes a session open from the device's buckets, waiting for the budget
+        up to self.wait (or the wait of the surrounding defer_rate_limits).
+        Raises SessionRateLimited when that's not enough.
+        """
+        buckets = self._buckets(device_ip)
+        if not buckets:
+            return
+        keys = [key for _, key, _, _ in buckets]
+        args = [value for _, _, rate, burst in buckets for value in (rate, burst)]
+        deferral = _deferral.get()
+        wait = deferral.wait if deferral is not None else self.wait
+
+        started = time.perf_counter()
+        slept = False
+        while True:
+            wait_ms, index = self._take(keys=keys, args=args)
+            waited = time.perf_counter() - started
+            if wait_ms == 0:
+                SESSION_OPENS.labels(result="waited" if slept else "granted").inc()
+                RATE_LIMIT_WAIT.observe(waited)
+                return
+            scope = buckets[index - 1][0]
+            if waited + wait_ms / 1000 > wait:
+                SESSION_OPENS.labels(result="limited").inc()
+                RATE_LIMITED.labels(scope=scope).inc()
+                if deferral is not None:
+                    deferral.retry_after = wait_ms / 1000
+                raise SessionRateLimited(f"NETCONF session budget of {scope} exhausted for {device_ip}, "
+                                         f"next open in {wait_ms / 1000:.1f}s", retry_after=wait_ms / 1000)
+            time.sleep(wait_ms / 1000)
+            slept = True
+
+
+session_limiter = SessionRateLimiter(redis_conn)
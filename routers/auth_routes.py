@@ -10,6 +10,8 @@ from juniper_cfg.database import *
 from juniper_cfg.services import *
 from rq.job import Job
 from juniper_cfg.tasks import *
+from juniper_cfg.scheduler import request_device_sync
+import asyncio
 
 router = APIRouter(tags=["Authentication"])
 
@@ -25,7 +27,8 @@ async def login(
     user = result.scalar_one_or_none()
     
     # 2. Check password
-    if not user or not auth.verify_password(form_data.password, user.hashed_password):
+    # bcrypt runs in the auth executor, not on the event loop
+    if not user or not await auth.verify_password_async(form_data.password, user.hashed_password):
         raise HTTPException(status_code=400, detail="Incorrect username or password")
     
     # 3. Create Token: Sync logic
@@ -88,8 +91,10 @@ async def eda_dispatcher(payload: dict):
         raise HTTPException(status_code=404, detail="Device not found")
     
     if task_type == "sync_request":
-        job = Job.create(func=sync_device_config_job, args=(device_id,), connection=system_q.connection)
-        system_q.enqueue_job(job)
+        # Skipped when a sync of the device is already queued or running (scheduler or earlier webhook)
+        job = await asyncio.to_thread(request_device_sync, device_id, source="eda")
+        if job is None:
+            return {"status": "skipped", "detail": "Sync already in flight"}
         
     
     print("--------ANSIBLE WEBHOOKS HEADERS---------")
@@ -101,7 +106,7 @@ async def eda_dispatcher(payload: dict):
     return {"status": "success"}
 
 @router.get("/ping")
-async def ping(current_user: models.User = Depends(auth.get_current_user)):
+async def ping(current_user: models.User = Depends(auth.get_current_user_async)):
     # If get_current_user is async, FastAPI awaits it before entering here.
     return {"message": "pong"}
     
\ No newline at end of file
@@ -1,8 +1,8 @@
-from fastapi import APIRouter,HTTPException,Depends,Form,Request
+from fastapi import APIRouter,HTTPException,Depends,Form,Request,Query
 from sqlalchemy.orm import Session
 from sqlalchemy import func, select
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List
+from typing import List, Optional
 from juniper_cfg.database import get_async_db,get_db
 from juniper_cfg import auth, models
 from juniper_cfg.schemas import *
@@ -13,6 +13,10 @@ from redis import Redis
 from rq import Queue
 from rq.job import Job
 from juniper_cfg.tasks import *
+from juniper_cfg.provision_batch import create_provision_batch, get_batch_progress
+from juniper_cfg.collector import fleet_collect_job, fleet_pool, FLEET_JOB_TIMEOUT
+from juniper_cfg import invstats
+import asyncio
 
 router = APIRouter(
     prefix="/devices",
@@ -24,7 +28,7 @@ import time
 @router.get("/", response_model=List[DeviceResponse])
 async def get_devices(
     db: AsyncSession = Depends(get_async_db), # Use the async session
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: models.User = Depends(auth.get_current_user_async)
 ):
     """
     Returns the list of network devices from database (Non-blocking)
@@ -48,7 +52,93 @@ async def get_devices(
     return devices
 
 
-@router.post("/provision/{device_hostname}", 
+def _parse_bulk_targets(payload: BulkProvisionRequest):
+    """
+    Merges targets and csv lines into [{"target": ..., "site": ..., "region": ...}].
+    """
+    rows = [{"target": target.strip(), "site": payload.site, "region": payload.region}
+            for target in payload.targets if target.strip()]
+
+    for line in (payload.csv or "").splitlines():
+        fields = [field.strip() for field in line.split(",")]
+        if not fields[0] or fields[0].lower() in ("hostname", "target", "ip"): #blank line or header
+            continue
+        rows.append({
+            "target": fields[0],
+            "site": (fields[1] if len(fields) > 1 and fields[1] else payload.site),
+            "region": (fields[2] if len(fields) > 2 and fields[2] else payload.region),
+        })
+    return rows
+
+
+async def _resolve_target(target: str):
+    if ut.identify_address_type(target) == "Hostname":
+        #DNS lookup blocks, keep it off the event loop
+        return await asyncio.to_thread(ut.resolve_hostname, target)
+    return target
+
+
+@router.post("/provision/bulk",
+             response_model=BulkProvisionResponse,
+             status_code=status.HTTP_202_ACCEPTED
+)
+async def provision_devices_bulk(payload: BulkProvisionRequest,
+                                 request: Request,
+                                 db: AsyncSession = Depends(get_async_db)
+                                 ):
+    """
+    Provisions many devices with one request. Targets already in the DB are
+    skipped (one query for the whole list) and at most `concurrency` jobs run
+    per site at a time. Progress is aggregated under the returned batch id.
+    """
+    rows = _parse_bulk_targets(payload)
+    if not rows:
+        raise HTTPException(status_code=400, detail="No targets given")
+
+    resolved = await asyncio.gather(*(_resolve_target(row["target"]) for row in rows))
+
+    unresolved = []
+    targets = {}
+    for row, device_ip in zip(rows, resolved):
+        if device_ip == "Resolution failed":
+            unresolved.append(row["target"])
+            continue
+        #first occurrence of an IP wins
+        targets.setdefault(device_ip, {"device_ip": device_ip, "site": row["site"], "region": row["region"]})
+
+    existing = await svc_get_existing_device_ips_async(db, list(targets))
+    new_targets = [target for device_ip, target in targets.items() if device_ip not in existing]
+
+    batch = create_provision_batch(
+        new_targets,
+        payload.username,
+        payload.password,
+        mode=payload.mode,
+        concurrency=payload.concurrency,
+        session_id=payload.session_id,
+        skipped=sorted(existing),
+    )
+
+    return {
+        **batch,
+        "skipped_existing": sorted(existing),
+        "unresolved": unresolved,
+        "monitor_url": str(request.url_for("get_provision_batch", batch_id=batch["batch_id"])),
+    }
+
+
+@router.get("/provision/batch/{batch_id}", name="get_provision_batch")
+async def get_provision_batch(batch_id: str):
+    """
+    Aggregated progress of a bulk provisioning batch.
+    """
+    progress = get_batch_progress(batch_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return progress
+
+
+@router.post("/provision/{device_hostname}",
              response_model=JobResponse,
              status_code=status.HTTP_202_ACCEPTED 
              #This is a super cool response to my lovely Django. Hey baby, I got your request
@@ -71,18 +161,37 @@ async def provision_device(device_hostname: str,
     
     #this is from JS frontend during device registration
     session_id = getattr(payload, "session_id", None)
-    session_channel = f"logs_{session_id}" if session_id else None
 
     #DB check so use await and async func.
     if await svc_is_device_exists_async(device_ip):
         error_msg = f"\x1b[31m--- [FAILED] Device already exists ---\x1b[0m"
-        r.expire(session_channel,1800)
-        r.publish(session_channel, error_msg)
+        if session_id:
+            log_to_ws(session_id, error_msg)
         raise HTTPException(status_code=400, detail="Device already exists")
     
 
+    #Logged before the enqueue so it lands ahead of the job's own lines in the stream
+    if session_id:
+        start_msg = "--- Provisioning job initiated ---"
+        log_to_ws(session_id, start_msg)
+
+    if payload.mode == "chain":
+        # Every step of the chain is a workflow job, the "device" step is the one to monitor first
+        params = {"device_ip": device_ip, "username": payload.username,
+                  "password": payload.password, "session_id": session_id}
+        workflow_id, job_ids = start_workflow(PROVISION, system_q, params,
+                                              meta={"session_id": session_id, "target": device_ip})
+        job_id = job_ids["device"]
+        return {
+            "job_id": job_id,
+            "status": "queued",
+            "monitor_url": str(request.url_for("get_job_status", job_id=job_id)),
+            "workflow_id": workflow_id,
+            "workflow_url": str(request.url_for("get_workflow_status", workflow_id=workflow_id)),
+        }
+
     job = Job.create(
-        provision_device_job, 
+        provision_device_single_session_job,
         args=(device_ip,payload.username,payload.password,session_id),
         connection=system_q.connection,
     )
@@ -95,10 +204,6 @@ async def provision_device(device_hostname: str,
 
     monitor_url = str(request.url_for("get_job_status", job_id=job_id))
     
-    if session_channel:
-        start_msg = "--- Provisioning job initiated ---"
-        r.publish(session_channel,start_msg)
-
     return {
         "job_id": job.get_id(),
         "status": "queued",
@@ -125,56 +230,93 @@ async def fetch_mac_table(
     }
 
 
+@router.get("/{device_id}/arp-table")
+async def fetch_arp_table(
+    device_id: int,
+    db: AsyncSession = Depends(get_async_db)
+):
+    device_ip = await svc_get_device_ip_by_id_async(db, device_id)
+
+    if not device_ip:
+         raise HTTPException(status_code=404, detail="Device not found")
 
-@router.get("/inventory/stats")
-async def get_inventory_stats(db: AsyncSession = Depends(get_async_db)):
-    # 1. Total Device Count (The 'Hero' Number)
-    total_stmt = select(func.count(DeviceNet.id))
-    total_res = await db.execute(total_stmt)
-    total_devices = total_res.scalar() or 0
-
-    # 2. Sync Status Breakdown (Operational vs Failed)
-    status_stmt = select(DeviceNet.sync_status, func.count(DeviceNet.id)).group_by(DeviceNet.sync_status)
-    status_res = await db.execute(status_stmt)
-    status_map = {row[0]: row[1] for row in status_res.all()}
-
-    # Initialize response with new summary keys
-    response_data = {
-        "total_devices": total_devices,
-        "operational_count": status_map.get("synced", 0),
-        "failed_count": status_map.get("failed", 0),
-        "pending_count": status_map.get("pending", 0),
-        "global": {}, 
-        "os_by_vendor": {}
+    job = q.enqueue(fetch_arp_table_job, device_ip, device_id)
+    return {
+        "job_id": job.get_id(),
+        "status": "queued",
+        "monitor_url": f"/job/{job.get_id()}"
     }
 
-    # --- Existing Logic Below ---
-    global_map = {
-        "type": DeviceNet.type,
-        "model": DeviceNet.model,
-        "vendor": DeviceNet.vendor
+
+@router.get("/{device_id}/route-table")
+async def fetch_route_table(
+    device_id: int,
+    db: AsyncSession = Depends(get_async_db)
+):
+    device_ip = await svc_get_device_ip_by_id_async(db, device_id)
+
+    if not device_ip:
+         raise HTTPException(status_code=404, detail="Device not found")
+
+    #Full tables take minutes, the default 180s RQ timeout is not enough
+    job = q.enqueue(fetch_route_table_job, device_ip, device_id, job_timeout=ROUTE_JOB_TIMEOUT)
+    return {
+        "job_id": job.get_id(),
+        "status": "queued",
+        "monitor_url": f"/job/{job.get_id()}"
     }
-    
-    # Fetch Global Stats
-    for key, column in global_map.items():
-        stmt = select(column, func.count(column)).group_by(column)
-        result = await db.execute(stmt)
-        response_data["global"][key] = { (row[0] or "Unknown"): row[1] for row in result.all() }
-
-    # OS Versions Grouped by Vendor
-    stmt_os = select(
-        DeviceNet.vendor, 
-        DeviceNet.os_version, 
-        func.count(DeviceNet.id)
-    ).group_by(DeviceNet.vendor, DeviceNet.os_version)
-    
-    result_os = await db.execute(stmt_os)
-    
-    for vendor, os_ver, count in result_os.all():
-        vendor_key = vendor or "Unknown"
-        os_key = os_ver or "Unknown"
-        if vendor_key not in response_data["os_by_vendor"]:
-            response_data["os_by_vendor"][vendor_key] = {}
-        response_data["os_by_vendor"][vendor_key][os_key] = count
-
-    return response_data
\ No newline at end of file
+
+
+@router.get("/mac/{address}", response_model=List[MacEntryResponse])
+async def find_mac(address: str, db: AsyncSession = Depends(get_async_db)):
+    """
+    Devices, VLANs and interfaces a MAC is seen on, with first_seen/last_seen.
+    """
+    return await svc_find_mac_async(db, address)
+
+
+@router.get("/{device_id}/mac-table/entries", response_model=List[MacEntryResponse])
+async def get_mac_entries(
+    device_id: int,
+    mac: Optional[str] = None,
+    vlan_id: Optional[int] = None,
+    interface: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    MAC table of the device as stored by the last fetch (fetch_mac_table_job or the fleet collector).
+    """
+    return await svc_get_mac_entries_async(db, device_id, mac, vlan_id, interface, limit, offset)
+
+
+@router.post("/collect", response_model=JobResponse, status_code=status.HTTP_202_ACCEPTED)
+async def collect_fleet(payload: FleetCollectRequest, request: Request):
+    """
+    Runs read-only collectors against many devices concurrently from one
+    worker (asyncio fleet collector) instead of one job per device per RPC.
+    """
+    if payload.concurrency and payload.concurrency > fleet_pool.max_sessions:
+        raise HTTPException(status_code=400,
+                            detail=f"concurrency is limited to {fleet_pool.max_sessions} (FLEET_CONCURRENCY)")
+    job = q.enqueue(
+        fleet_collect_job,
+        list(payload.collectors),
+        payload.device_ids,
+        payload.concurrency,
+        job_timeout=FLEET_JOB_TIMEOUT
+    )
+
+    return {
+        "job_id": job.get_id(),
+        "status": "queued",
+        "monitor_url": str(request.url_for("get_job_status", job_id=job.get_id()))
+    }
+
+
+@router.get("/inventory/stats")
+async def get_inventory_stats(db: AsyncSession = Depends(get_async_db)):
+    # Totals, sync status, type/model/vendor and OS by vendor in one GROUPING SETS
+    # query, cached for INVENTORY_STATS_TTL and dropped when devices change (see invstats)
+    return await invstats.get_inventory_stats(db)
\ No newline at end of file
@@ -1,15 +1,21 @@
-from fastapi import APIRouter,HTTPException, Depends,Header
+from fastapi import APIRouter,HTTPException, Depends,Header,Query,Request
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 from juniper_cfg.database import get_db
 from juniper_cfg import auth, models
 from juniper_cfg.schemas import *
 from juniper_cfg.services import q,apiut,ut
 
+import asyncio
+import json
+
 #redis
 #from redis import Redis
 #from rq import Queue
-from rq.registry import StartedJobRegistry, FinishedJobRegistry, FailedJobRegistry, DeferredJobRegistry
+from juniper_cfg.jobindex import list_jobs, job_fields, fetch_job_statuses, JOB_CHANNEL
+from juniper_cfg.wshub import job_hub
+from juniper_cfg.workflow import get_workflow
 from juniper_cfg.tasks import *
 
 router = APIRouter(
@@ -18,6 +24,9 @@ router = APIRouter(
 )
 
 
+#Seconds between SSE keepalive comments, also how quickly a gone client is noticed
+SSE_KEEPALIVE = 15
+
 # In production, move this to an environment variable (.env)
 EDA_API_KEY = "lab123"
 
@@ -65,58 +74,125 @@ async def get_job_status(job_id: str):
     return response_data
 
 
+@router.get("/workflow/{workflow_id}", name="get_workflow_status")
+async def get_workflow_status(workflow_id: str):
+    """
+    Status of a workflow and of each of its steps, with per-step durations.
+    """
+    workflow = get_workflow(q.connection, workflow_id)
+    if workflow is None:
+        raise HTTPException(status_code=404, detail="Workflow not found")
+    return workflow
+
+
+@router.post("/jobs/status", response_model=List[JobStatusResponse])
+async def get_jobs_status(payload: JobStatusBatchRequest):
+    """
+    Status of many jobs in one Redis round trip, in the order asked.
+    Unknown (or expired) jobs come back with status "not_found".
+    """
+    statuses = fetch_job_statuses(q.connection, payload.job_ids)
+
+    response = []
+    for job_id in payload.job_ids:
+        status, result = statuses[job_id]
+        item = {"job_id": job_id, "status": status or "not_found", "result": None, "error": None}
+        if status == "failed":
+            item["status"] = "error"
+            item["error"] = result.exc_string if result is not None else None
+        elif result is not None:
+            item["result"] = result.return_value
+        response.append(item)
+    return response
+
+
+@router.get("/jobs/events")
+async def job_events(request: Request, job_ids: Optional[str] = None):
+    """
+    Server-Sent Events stream of job state transitions (queued, started,
+    finished, failed...), instead of polling /job/{job_id}.
+    job_ids: comma separated ids to follow; their current state is sent first.
+    Without it every transition and every other job_notifications message is sent.
+    """
+    wanted = set(filter(None, (job_ids or "").split(",")))
+
+    def sse(event, data):
+        return f"event: {event}\ndata: {data}\n\n"
+
+    async def stream():
+        subscription = job_hub.subscribe(JOB_CHANNEL)
+        try:
+            # Subscribed before the snapshot, so no transition is missed in between
+            if wanted:
+                for job_id, (status, _) in fetch_job_statuses(q.connection, list(wanted)).items():
+                    yield sse("status", json.dumps({"event": "status", "job_id": job_id,
+                                                    "status": status or "not_found"}))
+            while True:
+                try:
+                    data = await asyncio.wait_for(subscription.queue.get(), timeout=SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                # Fell behind: end the stream, EventSource reconnects and gets a fresh snapshot
+                if subscription.overflowed:
+                    return
+                try:
+                    message = json.loads(data)
+                except ValueError:
+                    message = None
+                if isinstance(message, dict) and message.get("event") == "status":
+                    if not wanted or message["job_id"] in wanted:
+                        yield sse("status", data)
+                elif not wanted:
+                    yield sse("notification", data)
+        finally:
+            job_hub.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @router.get("/jobs/all")
-async def get_all_jobs():
+async def get_all_jobs(
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    task_type: Optional[str] = None,
+    status: Optional[str] = None,
+    target: Optional[str] = None,
+):
     """
-    Aggregates jobs from all RQ registries asynchronously.
+    Jobs of all queues, newest first, one page at a time from the job index.
+    Pass next_cursor back as cursor for the following page.
+    status filters on the RQ status (queued, started, finished, failed, deferred, scheduled...).
     """
+    jobs, next_cursor = list_jobs(q.connection, limit=limit, cursor=cursor,
+                                  task_type=task_type, status=status, target=target)
+
+    # Mapping friendly statuses
+    status_map = {
+        "queued": "running",
+        "started": "running",
+        "finished": "completed",
+        "failed": "failed"
+    }
+
     all_jobs = []
-    
-    # 1. Define registries to check
-    registries = [
-        StartedJobRegistry(queue=q),
-        FinishedJobRegistry(queue=q),
-        FailedJobRegistry(queue=q),
-        DeferredJobRegistry(queue=q)
-    ]
-    
-    # 2. Get Job IDs (These are fast memory reads from Redis)
-    job_ids = set(q.job_ids) 
-    for registry in registries:
-        job_ids.update(registry.get_job_ids())
-    
-    # 3. Fetch details for each job
-    for job_id in job_ids:
-        # fetch_job is a network call. In an async loop, this is non-blocking.
-        job = q.fetch_job(job_id)
-        
-        if job:
-            status = job.get_status()
-            
-            # Mapping friendly statuses
-            status_map = {
-                "queued": "running",
-                "started": "running",
-                "finished": "completed",
-                "failed": "failed"
-            }
-            display_status = status_map.get(status, status)
-
-            all_jobs.append({
-                "id": job_id,
-                # Safe splitting in case func_name is None
-                "task_type": job.func_name.split('.')[-1] if job.func_name else "Unknown",
-                "target": job.args[0] if job.args else "N/A",
-                "status": display_status,
-                # Format datetime safely
-                "created_at": job.created_at.strftime('%Y-%m-%d %H:%M:%S') if job.created_at else "N/A",
-                "ended_at": job.ended_at.strftime('%Y-%m-%d %H:%M:%S') if job.ended_at else "N/A",
-                "result": job.result
-            })
-            
-    # Sort by creation time (newest first)
-    # Note: We check if 'created_at' is "N/A" to avoid sorting errors
-    all_jobs.sort(key=lambda x: x['created_at'], reverse=True)
-    
-    return all_jobs
+    for job, result in jobs:
+        job_status = job.get_status(refresh=False)
+        display_status = status_map.get(job_status, job_status)
+        fields = job_fields(job)
+        all_jobs.append({
+            "id": job.id,
+            "queue": fields["queue"],
+            "task_type": fields["task_type"],
+            "target": fields["target"],
+            "status": display_status,
+            # Format datetime safely
+            "created_at": job.created_at.strftime('%Y-%m-%d %H:%M:%S') if job.created_at else "N/A",
+            "ended_at": job.ended_at.strftime('%Y-%m-%d %H:%M:%S') if job.ended_at else "N/A",
+            "result": result.return_value if result is not None else None
+        })
 
+    return {"jobs": all_jobs, "next_cursor": next_cursor}
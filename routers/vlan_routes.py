@@ -37,7 +37,8 @@ async def create_vlan(
          raise HTTPException(status_code=404, detail="Device not found")
 
     # 2. Enqueue the configuration job
-    job = q.enqueue(
+    job = enqueue_config_job(
+        q,
         create_vlan_job, 
         device_ip, 
         vlan_id, 
@@ -115,7 +116,8 @@ async def set_access_interface_vlan(
          raise HTTPException(status_code=404, detail="Device not found")
 
     # 3. Enqueue the worker job
-    job = q.enqueue(
+    job = enqueue_config_job(
+        q,
         set_interface_vlan_job, 
         device_ip, 
         interface_name, 
@@ -163,7 +165,8 @@ async def set_trunk_interface_vlan(
          raise HTTPException(status_code=404, detail="Device not found")
 
     # 3. Enqueue the Trunk Configuration job
-    job = q.enqueue(
+    job = enqueue_config_job(
+        q,
         set_trunk_interface_vlan_job, 
         device_ip, 
         interface_name, 
@@ -0,0 +1,184 @@
+import logging
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+from prometheus_client import Counter, start_http_server
+from sqlalchemy import func, or_, select, update
+
+from juniper_cfg.database import engine
+from juniper_cfg.models import DeviceNet
+from juniper_cfg.services import redis_conn, system_q
+from juniper_cfg.workflow import fail_stale_workflows
+
+load_dotenv()
+
+logger = logging.getLogger("FleetScheduler")
+
+#Every device is synced again once its last sync is older than this
+FLEET_SYNC_INTERVAL = int(os.getenv("FLEET_SYNC_INTERVAL", "3600"))
+#How often the scheduler looks for due devices, their syncs are spread over one tick
+FLEET_SYNC_TICK = int(os.getenv("FLEET_SYNC_TICK", "60"))
+#Max device syncs started per site and minute, devices without a site share "default"
+SITE_SYNC_RATE = int(os.getenv("SITE_SYNC_RATE", "10"))
+#A device stays "in flight" this long after its sync was due, unless the sync finishes first
+SYNC_INFLIGHT_TTL = int(os.getenv("SYNC_INFLIGHT_TTL", "1800"))
+SCHEDULER_METRICS_PORT = os.getenv("SCHEDULER_METRICS_PORT")
+
+SYNC_REQUESTS = Counter('fleet_sync_requests_total', 'Device syncs requested', ['source', 'result'])
+
+#Only one scheduler process plans the ticks, the others stand by
+LEADER_KEY = "fleet_sync:leader"
+
+
+def _inflight_key(device_id):
+    return f"sync_inflight:{device_id}"
+
+
+def set_sync_status(device_ids: list, status: str, synced: bool = False, attempted: bool = False):
+    """
+    Writes devices.sync_status, the outcome of the last sync (pending until the
+    first one, then synced or failed), last_synced too when synced and
+    last_sync_attempt when synced or attempted. A sync in flight shows in the
+    sync_inflight:{device_id} key, not here, so the dashboard counts still add up.
+    Core update on purpose: a bulk ORM update on DeviceNet would drop the whole
+    device cache, the cached fields don't change.
+    """
+    values = {"sync_status": status}
+    now = datetime.utcnow()
+    if synced:
+        values["last_synced"] = now
+    if synced or attempted:
+        values["last_sync_attempt"] = now
+    with engine.begin() as conn:
+        conn.execute(update(DeviceNet.__table__).where(DeviceNet.__table__.c.id.in_(device_ids)).values(**values))
+
+
+def request_device_sync(device_id: int, delay: float = 0, source: str = "api"):
+    """
+    Enqueues sync_device_config_job for a device (after delay seconds), unless
+    a sync of it is already queued or running. Returns the job, None if skipped.
+    A delayed job needs a worker started with --with-scheduler.
+    """
+    if not redis_conn.set(_inflight_key(device_id), source, nx=True, ex=int(delay) + SYNC_INFLIGHT_TTL):
+        SYNC_REQUESTS.labels(source=source, result="in_flight").inc()
+        return None
+
+    #By name, tasks imports this module for the end of sync hook
+    job_func = "juniper_cfg.tasks.sync_device_config_job"
+    if delay > 0:
+        job = system_q.enqueue_in(timedelta(seconds=delay), job_func, device_id)
+    else:
+        job = system_q.enqueue(job_func, device_id)
+    SYNC_REQUESTS.labels(source=source, result="queued").inc()
+    return job
+
+
+def device_sync_finished(workflow_id: str, status: str, params: dict):
+    """
+    on_finish of the DEVICE_SYNC workflow: records the outcome on the device
+    and lets the next sync of it through. A failed sync counts as an attempt,
+    the scheduler tries that device again one interval later.
+    """
+    device_id = params.get("device_id")
+    if device_id is None:
+        return
+    if status == "finished":
+        set_sync_status([device_id], "synced", synced=True)
+    else:
+        set_sync_status([device_id], "failed", attempted=True)
+    redis_conn.delete(_inflight_key(device_id))
+
+
+def site_budget():
+    return max(1, SITE_SYNC_RATE * FLEET_SYNC_TICK // 60)
+
+
+def due_devices(budget: int):
+    """
+    {site: [device_id...]} of the devices due for a sync, least recently
+    attempted first and never-attempted before anything else, at most budget
+    per site plus as many again to make up for devices already in flight.
+    A device whose sync failed isn't due again before an interval has passed,
+    so unreachable devices don't take the slots of the healthy ones every tick.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=FLEET_SYNC_INTERVAL)
+    rank = func.row_number().over(
+        partition_by=DeviceNet.site,
+        order_by=(DeviceNet.last_sync_attempt.asc().nulls_first(), DeviceNet.id),
+    ).label("rank")
+    due = (
+        select(DeviceNet.id, DeviceNet.site, rank)
+        .where(or_(DeviceNet.last_synced.is_(None), DeviceNet.last_synced < cutoff))
+        .where(or_(DeviceNet.last_sync_attempt.is_(None), DeviceNet.last_sync_attempt < cutoff))
+        .subquery()
+    )
+    stmt = select(due.c.id, due.c.site).where(due.c.rank <= 2 * budget).order_by(due.c.site, due.c.rank)
+    sites = {}
+    with engine.connect() as conn:
+        for device_id, site in conn.execute(stmt):
+            sites.setdefault(site or "default", []).append(device_id)
+    return sites
+
+
+def plan_tick():
+    """
+    One scheduler tick: the due devices of every site are requested with
+    delays spread over the tick, slot by slot with random jitter inside each
+    slot, so a site never gets more than its budget per tick and sites don't
+    all hit the workers at second 0. Returns how many syncs were requested.
+    """
+    budget = site_budget()
+    slot = FLEET_SYNC_TICK / budget
+    requested = 0
+    for site, device_ids in due_devices(budget).items():
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for device_id in device_ids:
+                pipe.exists(_inflight_key(device_id))
+            in_flight = pipe.execute()
+        idle = [device_id for device_id, busy in zip(device_ids, in_flight) if not busy][:budget]
+        for k, device_id in enumerate(idle):
+            if request_device_sync(device_id, delay=k * slot + random.uniform(0, slot), source="scheduler"):
+                requested += 1
+        if idle:
+            logger.info(f"Site {site}: {len(idle)} device syncs planned")
+    return requested
+
+
+def run():
+    """
+    Scheduler loop, python -m juniper_cfg.scheduler. Safe to run more than
+    once: only the process holding LEADER_KEY plans a tick.
+    """
+    if SCHEDULER_METRICS_PORT:
+        start_http_server(int(SCHEDULER_METRICS_PORT))
+    instance = f"{os.uname().nodename}:{os.getpid()}"
+    logger.info(f"Fleet sync scheduler {instance}: every {FLEET_SYNC_INTERVAL}s, "
+                f"tick {FLEET_SYNC_TICK}s, {SITE_SYNC_RATE} devices/min per site")
+    while True:
+        started = time.monotonic()
+        #The lease outlives a tick so a slow tick doesn't hand over mid-plan
+        leader = redis_conn.get(LEADER_KEY)
+        if leader is None:
+            redis_conn.set(LEADER_KEY, instance, nx=True, ex=2 * FLEET_SYNC_TICK)
+        elif leader.decode() == instance:
+            redis_conn.expire(LEADER_KEY, 2 * FLEET_SYNC_TICK)
+        if (redis_conn.get(LEADER_KEY) or b"").decode() == instance:
+            try:
+                requested = plan_tick()
+                logger.info(f"Tick: {requested} device syncs requested")
+                #A sync whose step worker died would hold its device's in-flight slot
+                stale = fail_stale_workflows(redis_conn)
+                if stale:
+                    logger.warning(f"Tick: {stale} stale workflows failed")
+            except Exception as e:
+                logger.error(f"Tick failed: {e}")
+        time.sleep(max(0, FLEET_SYNC_TICK - (time.monotonic() - started)))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL") or "INFO",
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    run()
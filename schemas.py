@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, ConfigDict
-from typing import Optional,Any
+from typing import Optional,Any,Literal,List
 from datetime import datetime
 # This defines the JSON structure for the API response
 class DeviceResponse(BaseModel):
@@ -25,11 +25,52 @@ class DeviceProvisionRequest(BaseModel):
     username: str = Field(..., example="admin")
     password: str = Field(..., example="Juniper123")
     session_id: Optional[str] = None # I use this for websocket connection
+    # chain: ping + netconf check + job chain, single_session: everything over one NETCONF session
+    mode: Literal["chain", "single_session"] = "chain"
+
+class BulkProvisionRequest(BaseModel):
+    username: str = Field(..., example="admin")
+    password: str = Field(..., example="Juniper123")
+    # Either a list of hostnames/IPs or CSV lines of "target,site,region" (site/region optional)
+    targets: List[str] = []
+    csv: Optional[str] = Field(None, example="ex-acc-01,site-a,emea\n10.0.0.12,site-a,emea")
+    site: Optional[str] = None # default site for targets without one
+    region: Optional[str] = None
+    concurrency: int = Field(10, ge=1, le=100, description="Max jobs in flight per site")
+    mode: Literal["chain", "single_session"] = "single_session"
+    session_id: Optional[str] = None
+
+class BulkProvisionResponse(BaseModel):
+    batch_id: str
+    total: int
+    skipped_existing: List[str]
+    unresolved: List[str]
+    sites: dict
+    monitor_url: str
+
+class FleetCollectRequest(BaseModel):
+    collectors: List[Literal["interfaces", "switching_interfaces", "vlans", "mac_table",
+                             "arp_table", "route_table"]] = Field(..., min_length=1)
+    device_ids: Optional[List[int]] = None # None means the whole inventory
+    concurrency: Optional[int] = Field(None, ge=1, le=2000)
 
 class JobResponse(BaseModel):
     job_id: str
     status: str
     monitor_url: str
+    workflow_id: Optional[str] = None
+    workflow_url: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
+class MacEntryResponse(BaseModel):
+    device_id: int
+    address: str
+    vlan_id: int
+    interface: str
+    first_seen: Optional[datetime] = None
+    last_seen: Optional[datetime] = None
 
     class Config:
         from_attributes = True
@@ -40,6 +81,9 @@ class JobStatusResponse(BaseModel):
     result: Optional[Any] = None
     error: Optional[str] = None
 
+class JobStatusBatchRequest(BaseModel):
+    job_ids: List[str] = Field(..., min_length=1, max_length=1000)
+
 
 class VlanCatalogBase(BaseModel):
     vlan_id: int = Field(..., ge=1, le=4094)
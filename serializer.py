@@ -0,0 +1,115 @@
+import logging
+import os
+import pickle
+import uuid
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+from prometheus_client import Counter
+from sqlalchemy import delete, insert, select
+
+from juniper_cfg.database import engine
+from juniper_cfg.models import JobBlob
+
+load_dotenv()
+
+logger = logging.getLogger("JunoxSerializer")
+
+#Payloads smaller than this are stored as plain pickle, compressing them isn't worth it
+COMPRESS_MIN = int(os.getenv("JOB_COMPRESS_MIN", "1024"))
+#Compressed payloads above this go to Postgres (job_blobs), Redis only keeps a reference
+RESULT_INLINE_MAX = int(os.getenv("JOB_RESULT_INLINE_MAX", str(256 * 1024)))
+#How long an offloaded payload is kept at least. Payloads of a job or result are
+#kept as long as their job or result (see payload_ttl)
+BLOB_TTL = int(os.getenv("JOB_BLOB_TTL", str(24 * 3600)))
+#expires_at of payloads whose job or result never expires (TTL -1)
+_NEVER = datetime(9999, 12, 31)
+
+JOB_PAYLOADS = Counter('job_payloads_total', 'Job data/results serialized', ['form'])
+JOB_PAYLOAD_BYTES = Counter('job_payload_bytes_total', 'Bytes of serialized job data/results',
+                            ['stage'])
+
+#Plain pickles start with \x80 (protocol >= 2), which is also what RQ's default
+#serializer writes, so jobs and results stored before this serializer still load
+_COMPRESSED = b"JXZ"
+_REFERENCE = b"JXR"
+
+_payload_ttl = ContextVar("payload_ttl", default=None)
+
+
+class PayloadExpired(Exception):
+    pass
+
+
+@contextmanager
+def payload_ttl(seconds: int):
+    """
+    Payloads offloaded inside the block are kept at least seconds, -1 for good.
+    The serializer doesn't see the job it serializes for, so whoever saves the
+    job or its result says how long that lives (IndexedQueue, JunoxWorker).
+    """
+    token = _payload_ttl.set(seconds)
+    try:
+        yield
+    finally:
+        _payload_ttl.reset(token)
+
+
+def _store_blob(payload: bytes) -> str:
+    blob_id = uuid.uuid4().hex
+    now = datetime.utcnow()
+    ttl = _payload_ttl.get()
+    expires_at = _NEVER if ttl == -1 else now + timedelta(seconds=max(BLOB_TTL, ttl or 0))
+    with engine.begin() as conn:
+        conn.execute(delete(JobBlob).where(JobBlob.expires_at < now))
+        conn.execute(insert(JobBlob).values(id=blob_id, payload=payload, created_at=now, expires_at=expires_at))
+    return blob_id
+
+
+def _load_blob(blob_id: str):
+    with engine.connect() as conn:
+        return conn.execute(select(JobBlob.payload).where(JobBlob.id == blob_id)).scalar_one_or_none()
+
+
+class JunoxSerializer:
+    """
+    RQ serializer for junox queues (job data and results).
+    Pickle at the highest protocol, zlib compressed from COMPRESS_MIN bytes on,
+    and stored by reference in Postgres when still bigger than RESULT_INLINE_MAX,
+    so a full MAC table result doesn't sit in Redis memory.
+    Queues, workers and anything fetching jobs must use the same serializer.
+    """
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        JOB_PAYLOAD_BYTES.labels(stage="pickled").inc(len(data))
+        if len(data) < COMPRESS_MIN:
+            JOB_PAYLOADS.labels(form="plain").inc()
+            JOB_PAYLOAD_BYTES.labels(stage="stored").inc(len(data))
+            return data
+
+        data = _COMPRESSED + zlib.compress(data, 6)
+        if len(data) <= RESULT_INLINE_MAX:
+            JOB_PAYLOADS.labels(form="compressed").inc()
+            JOB_PAYLOAD_BYTES.labels(stage="stored").inc(len(data))
+            return data
+
+        reference = _REFERENCE + _store_blob(data).encode()
+        JOB_PAYLOADS.labels(form="reference").inc()
+        JOB_PAYLOAD_BYTES.labels(stage="stored").inc(len(reference))
+        return reference
+
+    @staticmethod
+    def loads(data: bytes):
+        if data.startswith(_REFERENCE):
+            blob_id = data[len(_REFERENCE):].decode()
+            data = _load_blob(blob_id)
+            if data is None:
+                raise PayloadExpired(f"Job payload {blob_id} is no longer in job_blobs")
+        if data.startswith(_COMPRESSED):
+            data = zlib.decompress(data[len(_COMPRESSED):])
+        return pickle.loads(data)
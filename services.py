@@ -1,9 +1,12 @@
 from redis import Redis
-from rq import Queue
+from juniper_cfg.jobindex import IndexedQueue
 from juniper_cfg.utils import Utils
-from juniper_cfg.apiutils import APIUtils
+from juniper_cfg.apiutils import APIUtils, interface_tagness_update
 from .models import *
 from juniper_cfg.database import SessionLocal,AsyncSessionLocal
+from juniper_cfg.devcache import get_device_ref_sync, get_device_ref_async
+#Imported for its devices listeners: API and workers both drop the cached inventory stats
+from juniper_cfg import invstats
 from sqlalchemy import select,update
 
 #ncclient imports
@@ -17,9 +20,10 @@ ut = Utils()
 
 # RQ Setup
 redis_conn = Redis(host='localhost', port=6379)
-q = Queue('generic', connection=redis_conn)
-system_q = Queue('system', connection=redis_conn)
-user_q = Queue('user', connection=redis_conn)
+# Indexed queues: every job is listed in the job index (see jobindex.py)
+q = IndexedQueue('generic', connection=redis_conn)
+system_q = IndexedQueue('system', connection=redis_conn)
+user_q = IndexedQueue('user', connection=redis_conn)
 
 
 def svc_update_db_interface_tagness(db: SessionLocal, device_id: int, interface_list: list):
@@ -29,16 +33,10 @@ def svc_update_db_interface_tagness(db: SessionLocal, device_id: int, interface_
     interface_list is a list of dictionary containing interface name and its tagness 
     and we update the existing interface list eth_interfaces
     interface_list = [{"interface_name": "ge-0/0/20", "interface_tagness": "tagged"}...]
+    A single UPDATE ... FROM (VALUES ...) statement, not one UPDATE per interface.
     """
-    for iface in interface_list:
-        stmt = (
-            update(EthInterfaces)
-            .where(
-                EthInterfaces.device_id == device_id,
-                EthInterfaces.interface_name == iface["interface_name"]
-            )
-            .values(interface_tagness=iface["interface_tagness"])
-        )
+    stmt = interface_tagness_update(device_id, interface_list)
+    if stmt is not None:
         db.execute(stmt)
 
     db.commit()    
@@ -102,48 +100,25 @@ async def svc_get_interfaces_list_async(db: AsyncSessionLocal, device_id: int):
 async def svc_get_device_ip_by_id_async(db: AsyncSessionLocal, device_id: int):
     """
     Takes device_id as input and returns the IP address of the device asynchronously.
+    Served from the device cache, the DB is only hit on a miss.
     """
-    # 1. Create the selection statement
-    stmt = select(DeviceNet.ip_address).where(DeviceNet.id == device_id)
-    
-    # 2. Execute the query and await the result
-    result = await db.execute(stmt)
-    
-    # 3. Use scalar_one_or_none to get just the IP address or None
-    device_ip = result.scalar_one_or_none()
-    
-    return device_ip
+    device = await get_device_ref_async("id", device_id, db)
+    return device["ip_address"] if device else None
 
 
 async def svc_get_device_id_by_ip_async(db: AsyncSessionLocal, device_ip: str):
     """
-    Takes device_ip as input and returns the device_id asynchronously.
+    Takes device_ip as input and returns the device_id asynchronously (device cache).
     """
-    # 1. Create the selection statement
-    stmt = select(DeviceNet.id).where(DeviceNet.ip_address == device_ip)
-    
-    # 2. Execute the query and await the result
-    result = await db.execute(stmt)
-    
-    # 3. Use scalar_one_or_none to get just the device_id or None
-    device_id = result.scalar_one_or_none()
-    
-    return device_id
+    device = await get_device_ref_async("ip", device_ip, db)
+    return device["id"] if device else None
 
 async def svc_get_device_id_by_hostname_async(db: AsyncSessionLocal, hostname: str):
     """
-    Takes hostname as input and returns the device_id asynchronously.
+    Takes hostname as input and returns the device_id asynchronously (device cache).
     """
-    # 1. Create the selection statement
-    stmt = select(DeviceNet.id).where(DeviceNet.hostname == hostname)
-    
-    # 2. Execute the query and await the result
-    result = await db.execute(stmt)
-    
-    # 3. Use scalar_one_or_none to get just the device_id or None
-    device_id = result.scalar_one_or_none()
-    
-    return device_id
+    device = await get_device_ref_async("hostname", hostname, db)
+    return device["id"] if device else None
 
 
 def svc_get_device_ip_by_id_sync(device_id: int, db=None):
@@ -151,43 +126,60 @@ def svc_get_device_ip_by_id_sync(device_id: int, db=None):
     Hybrid Utility:
     1. If db is passed, use it (FastAPI mode).
     2. If db is None, open a new session (Worker mode).
+    Either way the DB is only hit when the device cache misses.
     """
-    
-    # If no session is provided, we create one using a context manager
-    if db is None:
-        with SessionLocal() as session:
-            return _execute_ip_lookup(session, device_id)
-    
-    # If a session was provided, use it directly
-    return _execute_ip_lookup(db, device_id)
-
-def _execute_ip_lookup(session, device_id):
-    """Internal helper to keep the logic DRY (Don't Repeat Yourself)"""
-    stmt = select(DeviceNet.ip_address).where(DeviceNet.id == device_id)
-    result = session.execute(stmt)
-    return result.scalar_one_or_none()
+    device = get_device_ref_sync("id", device_id, db)
+    return device["ip_address"] if device else None
 
 
 async def svc_is_device_exists_async(device_ip: str):
     """
     Check if device already exists in database (Async Version)
+    Only existing devices are cached, so a False always comes from the DB.
     """
-    # Use the async context manager to handle the session
-    async with AsyncSessionLocal() as db:
-        try:
-            # 1. Prepare the query using the modern 'select' syntax
-            stmt = select(DeviceNet).filter(DeviceNet.ip_address == device_ip)
-            
-            # 2. AWAIT the execution of the query
-            result = await db.execute(stmt)
-            
-            # 3. Use scalar_one_or_none to get the object
-            device = result.scalar_one_or_none()
-            
-            return device is not None
-        except Exception as e:
-            # Note: with 'async with', the session closes automatically
-            raise e
+    return await get_device_ref_async("ip", device_ip) is not None
+
+async def svc_get_existing_device_ips_async(db: AsyncSessionLocal, device_ips: list):
+    """
+    Returns the subset of device_ips that already exist in devices, in one query.
+    """
+    if not device_ips:
+        return set()
+
+    stmt = select(DeviceNet.ip_address).where(DeviceNet.ip_address.in_(device_ips))
+    result = await db.execute(stmt)
+
+    return set(result.scalars().all())
+
+async def svc_get_mac_entries_async(db: AsyncSessionLocal, device_id: int, mac: str = None,
+                                    vlan_id: int = None, interface: str = None,
+                                    limit: int = 1000, offset: int = 0):
+    """
+    Stored MAC table of a device, optionally filtered by mac, vlan_id or interface.
+    """
+    stmt = select(MacTable).where(MacTable.device_id == device_id)
+    if mac:
+        stmt = stmt.where(MacTable.address == mac.lower())
+    if vlan_id is not None:
+        stmt = stmt.where(MacTable.vlan_id == vlan_id)
+    if interface:
+        stmt = stmt.where(MacTable.interface == interface)
+    stmt = stmt.order_by(MacTable.id).limit(limit).offset(offset)
+
+    result = await db.execute(stmt)
+    return result.scalars().all()
+
+async def svc_find_mac_async(db: AsyncSessionLocal, address: str):
+    """
+    Where a MAC is (or was last) seen across the fleet, oldest sighting first.
+    """
+    stmt = (
+        select(MacTable)
+        .where(MacTable.address == address.lower())
+        .order_by(MacTable.first_seen)
+    )
+    result = await db.execute(stmt)
+    return result.scalars().all()
 
 def svc_check_netconf_connectivity(device_ip: str, username: str, password: str):
     """
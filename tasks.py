@@ -1,12 +1,13 @@
 from juniper_cfg.services import svc_update_db_interface_tagness
-from jnpr.junos.exception import RpcError
+from jnpr.junos.exception import RpcError, ConnectAuthError, ConnectTimeoutError, ConnectRefusedError, ConnectUnknownHostError
 from jnpr.junos import Device
 from jnpr.junos.utils.config import Config
 from fastapi import FastAPI,HTTPException, status
 import redis
-from rq import get_current_job
+from rq import Callback, get_current_job
 from rq.job import Job
 import json
+import time
 from juniper_cfg import apiutils
 import logging
 from juniper_cfg import models 
@@ -22,6 +23,17 @@ from lxml import etree
 from sqlalchemy.dialects.postgresql import insert
 from juniper_cfg.database import *
 from juniper_cfg.services import *
+from juniper_cfg.devpool import device_pool
+from juniper_cfg.devlock import DEVICE_LOCK_JOB_WAIT, device_locks
+from juniper_cfg.ratelimit import SessionRateLimited, session_limiter
+from juniper_cfg.batcher import ConfigBatcher, CONFIG_JOB_TIMEOUT
+from juniper_cfg.xmlstream import (rpc_reply_raw, iter_mac_chunks, iter_chunks, iter_arp_entries,
+                                   iter_route_chunks, MAC_CHUNK_SIZE)
+from juniper_cfg.bulkcopy import replace_device_rows
+from juniper_cfg.macsync import sync_mac_table_delta
+from juniper_cfg.logstream import append_log
+from juniper_cfg.workflow import Workflow, Step, start_workflow
+from juniper_cfg.scheduler import device_sync_finished
 
 
 load_dotenv()
@@ -31,10 +43,16 @@ DEVICE_USER = os.getenv("DEVICE_USER")
 DEVICE_PASSWORD=os.getenv("DEVICE_PASSWORD")
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = os.getenv("REDIS_PORT")
+#Routing tables collected by fetch_route_table_job, e.g. "inet.0,inet6.0"
+ROUTE_TABLES = [table.strip() for table in os.getenv("ROUTE_TABLES", "inet.0").split(",") if table.strip()]
+#One RPC per /8 instead of the whole table in one reply, keep on for routers with full BGP tables
+ROUTE_SLICED = os.getenv("ROUTE_SLICED", "true").lower() == "true"
+ROUTE_JOB_TIMEOUT = int(os.getenv("ROUTE_JOB_TIMEOUT", "3600"))
 
 r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
 
 apiut = apiutils.APIUtils()
+config_batcher = ConfigBatcher(r)
 
 LOG_LEVEL = os.getenv("LOG_LEVEL")
 logging.basicConfig(level=LOG_LEVEL,
@@ -43,11 +61,143 @@ logger = logging.getLogger("RedisJobs")
 
 def log_to_ws(session_id, ws_message):
     """
-    Publishes a message to the WebSocket for a specific session.
+    Sends a message to the WebSocket for a specific session.
+    It is kept in the session's log stream too, so a socket that connects
+    late replays what it missed. Jobs started without a session log nothing.
     """
-    channel = f"logs_{session_id}"
-    r.publish(channel, ws_message)
+    if not session_id:
+        return
+    append_log(r, session_id, ws_message)
 
+def apply_location_meta(new_device, job):
+    """
+    Bulk provisioning passes the site/region of a device in the job meta.
+    """
+    if job is None:
+        return
+    if job.meta.get("site"):
+        new_device.site = job.meta["site"]
+    if job.meta.get("region"):
+        new_device.region = job.meta["region"]
+
+def collect_switching_interfaces(dev):
+    """
+    Reads interface tagness from an open device.
+    Returns [{"interface_name": "ge-0/0/20", "interface_tagness": "tagged"}...]
+    """
+    interfaces_result = []
+    try:
+        ##Junos 25.4R1.12(virtual EX)
+        all_interfaces = dev.rpc.get_ethernet_switching_interface_details()
+        for entry in all_interfaces.xpath('.//l2ng-l2ald-iff-interface-entry'):
+            interface_name = entry.findtext('l2iff-interface-name', default="N/A").strip()
+            interface_tagness = entry.findtext('l2iff-interface-vlan-member-tagness', default="N/A").strip()
+            if interface_name:
+                interfaces_result.append({
+                "interface_name": interface_name.removesuffix(".0"),
+                "interface_tagness": interface_tagness
+            })
+
+    except RpcError as e:
+        #Junos 12.3R6.6
+        all_interfaces = dev.rpc.get_ethernet_switching_interface_information()
+        for entry in all_interfaces.xpath('.//interface'):
+            interface_name = entry.findtext('interface-name', default="N/A").strip()
+            tagness = None
+            vlan_members = entry.xpath('.//interface-vlan-member')
+            for member in vlan_members:
+                tagness = member.findtext('interface-vlan-member-tagness')
+                break #we only need once we don't fetch vlans here.
+            interface_tagness = tagness
+
+            if interface_name:
+                interfaces_result.append({
+                "interface_name": interface_name.removesuffix(".0"),
+                "interface_tagness": interface_tagness
+            })
+
+    return interfaces_result
+
+def collect_vlans(dev):
+    """
+    Reads the configured vlans from an open device.
+    Returns [{'vlan_id': '100', 'vlan_name': 'auto-vlan'}...], vlan_id is a string as Junos returns it.
+    """
+    vlans_data = dev.rpc.get_vlan_information()
+
+    # Parse the XML into a Python List of Dictionaries
+    results = []
+    for entry in vlans_data.xpath('.//l2ng-l2ald-vlan-instance-group'):
+        results.append({
+            "vlan_id": entry.findtext('l2ng-l2rtb-vlan-tag', default="N/A").strip(),
+            "vlan_name": entry.findtext('l2ng-l2rtb-vlan-name', default="N/A").strip(),
+        })
+    return results
+
+def sync_interfaces_to_db(device_id, interface_raw_data):
+    """
+    Upserts EthPortTable items [(name, [(key, value)...])...] into eth_interfaces.
+    Returns the number of interfaces written.
+    """
+    data_to_upsert = []
+    for interface in interface_raw_data:
+        # interface[0] is the name, interface[1] is the dict of attributes
+        iface_name = interface[0]
+        iface_details = dict(interface[1])
+
+        data_to_upsert.append({
+            "device_id": device_id,
+            "interface_name": iface_name,
+            "oper_status": iface_details.get('oper'),
+            "admin_status": iface_details.get('admin'),
+            "description": iface_details.get('description'),
+            "mac_address": iface_details.get('macaddr')
+        })
+
+    if not data_to_upsert:
+        return 0
+
+    with SessionLocal() as session:
+        try:
+            stmt = insert(models.EthInterfaces).values(data_to_upsert)
+
+            # PostgreSQL UPSERT logic
+            upsert_stmt = stmt.on_conflict_do_update(
+                constraint="uq_device_interface",
+                set_={
+                    "oper_status": stmt.excluded.oper_status,
+                    "admin_status": stmt.excluded.admin_status,
+                    "description": stmt.excluded.description,
+                    "mac_address": stmt.excluded.mac_address,
+                }
+            )
+
+            session.execute(upsert_stmt)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+    return len(data_to_upsert)
+
+def sync_vlans_to_db(device_id, live_vlan_list):
+    """
+    Adds the vlans found on the device but missing in the DB.
+    The whole live list goes to the DB, ON CONFLICT on (device_id, vlan_id) does the diff.
+    We ignore (don't compare) the vlan names for simplicity for now. It can be added later.
+    """
+    #[{'vlan_id': '100', 'vlan_name': 'auto-vlan'}, {'vlan_id': '1000', 'vlan_name': 'auto-vlan-1000'}
+    #vlan id is string so we convert it to int, untagged ones (N/A) can't be stored
+    vlans = [
+        {'vlan_id': int(vlan['vlan_id']), 'vlan_name': vlan.get('vlan_name', 'auto-vlan-{}'.format(vlan['vlan_id']))}
+        for vlan in live_vlan_list if str(vlan['vlan_id']).isdigit()
+    ]
+
+    added = apiut.update_device_vlans_db(device_id, vlans)
+    logger.info(f"{added} new VLANs added for device {device_id}")
+    return True
+
+@device_locks.job("read", ip_of=svc_get_device_ip_by_id_sync)
 def get_interfaces_job(device_id: int):
     """
     Fetch interface list from the live device. This is show interface output.
@@ -56,32 +206,13 @@ def get_interfaces_job(device_id: int):
     """
 
     device_ip = svc_get_device_ip_by_id_sync(device_id)
-    current_job = get_current_job()
-    session_id = current_job.meta.get("session_id")
-    run_chain = current_job.meta.get("run_chain",False)
-    
+
     try:
-        dev = Device(host=device_ip, user=DEVICE_USER, password=DEVICE_PASSWORD)
-        dev.open()
-        ports = EthPortTable(dev)
-        ports.get()
-        dev.close()
+        with device_pool.session(device_ip, DEVICE_USER, DEVICE_PASSWORD) as dev:
+            ports = EthPortTable(dev)
+            ports.get()
         results = ports.items()
-        
-        if results and current_job and run_chain:
-          new_job = Job.create(
-            func=post_get_interfaces_job,
-            args=(device_id,results,),
-            connection=current_job.connection,
-          )
-          new_job.meta = {
-              "session_id": session_id,
-              "run_chain": run_chain
-          }
-          new_job.save_meta()
-          new_job.save()
-          system_q.enqueue_job(new_job)
-            
+
         return {"interface_list": results}
     
 
@@ -103,7 +234,8 @@ def post_get_interfaces_job(device_id,results=None,previous_job_id=None):
     current_job = get_current_job()
     #We either provide a job id or the results directly
     if previous_job_id:
-        previous_job = Job.fetch(previous_job_id, connection=current_job.connection)
+        previous_job = Job.fetch(previous_job_id, connection=current_job.connection,
+                                 serializer=current_job.serializer)
         if previous_job:
             interface_raw_data = previous_job.result.get("interface_list")
             print(f"\n\n\n{interface_raw_data}\n\n\n")
@@ -111,117 +243,30 @@ def post_get_interfaces_job(device_id,results=None,previous_job_id=None):
         interface_raw_data = results
 
     session_id = current_job.meta.get("session_id")
-    run_chain = current_job.meta.get("run_chain",False)
-
-
 
     if not interface_raw_data:
         return "No interfaces found to sync" 
 
-    data_to_upsert = []
-    for interface in interface_raw_data:
-        # interface[0] is the name, interface[1] is the dict of attributes
-        iface_name = interface[0]
-        iface_details = dict(interface[1])
-        
-        data_to_upsert.append({
-            "device_id": device_id,
-            "interface_name": iface_name,
-            "oper_status": iface_details.get('oper'),
-            "admin_status": iface_details.get('admin'),
-            "description": iface_details.get('description'),
-            "mac_address": iface_details.get('macaddr')
-        })
-
-    # Move the DB session OUTSIDE the loop for efficiency
-    with SessionLocal() as session:
-        try:
-            stmt = insert(models.EthInterfaces).values(data_to_upsert)
-
-            # PostgreSQL UPSERT logic
-            upsert_stmt = stmt.on_conflict_do_update(
-                constraint="uq_device_interface",
-                set_={
-                    "oper_status": stmt.excluded.oper_status,
-                    "admin_status": stmt.excluded.admin_status,
-                    "description": stmt.excluded.description,
-                    "mac_address": stmt.excluded.mac_address,
-                }
-            )
-
-            session.execute(upsert_stmt)
-            session.commit()
+    try:
+        sync_interfaces_to_db(device_id, interface_raw_data)
+    except Exception as e:
+        log_to_ws(session_id, f"DATABASE ERROR during sync: {e}")
+        raise
 
-            if run_chain and session_id:
-                
-                log_to_ws(session_id, "Step 5: Interfaces synced to DB ---")
-                #Now time to collect VLAN information from the device
-                new_job = Job.create(
-                    func=fetch_vlans_job,
-                    args=(device_id,),
-                    connection=current_job.connection,
-                )
-                new_job.meta = {
-                    "session_id": session_id,
-                    "run_chain": run_chain
-                }
-                new_job.save_meta()
-                new_job.save()
-                system_q.enqueue_job(new_job)
-                
-
-        except Exception as e:
-            session.rollback()
-            log_to_ws(session_id, f"DATABASE ERROR during sync: {e}")
-            raise
-      
-    
 
+@device_locks.job("read")
 def get_switching_interfaces_job(device_ip: str, device_id:int):
     """
     Fetch switching interfaces from the live device. This is not show interface output.
     """
 
     try:
-        dev = Device(host=device_ip, user=DEVICE_USER, password=DEVICE_PASSWORD)
-        dev.open()
+        with device_pool.session(device_ip, DEVICE_USER, DEVICE_PASSWORD) as dev:
+            interfaces_result = collect_switching_interfaces(dev)
 
-        try:
-            ##Junos 25.4R1.12(virtual EX)
-            all_interfaces = dev.rpc.get_ethernet_switching_interface_details()
-            interfaces_result = []
-            for entry in all_interfaces.xpath('.//l2ng-l2ald-iff-interface-entry'):
-                interface_name = entry.findtext('l2iff-interface-name', default="N/A").strip()
-                interface_tagness = entry.findtext('l2iff-interface-vlan-member-tagness', default="N/A").strip()
-                if interface_name:
-                    interfaces_result.append({
-                    "interface_name": interface_name.removesuffix(".0"),
-                    "interface_tagness": interface_tagness
-                    
-                })     
-        
-        except RpcError as e:
-            #Junos 12.3R6.6
-            all_interfaces = dev.rpc.get_ethernet_switching_interface_information()
-            interfaces_result = []
-            for entry in all_interfaces.xpath('.//interface'):
-                interface_name = entry.findtext('interface-name', default="N/A").strip()
-                vlan_members = entry.xpath('.//interface-vlan-member')
-                for member in vlan_members:
-                    tagness = member.findtext('interface-vlan-member-tagness')
-                    break #we only need once we don't fetch vlans here.
-                interface_tagness = tagness
-
-                if interface_name:
-                    interfaces_result.append({
-                    "interface_name": interface_name.removesuffix(".0"),
-                    "interface_tagness": interface_tagness
-                    
-                })    
-
-        dev.close()
         #Update interface tagness in the database blindly. It is not costing much.
-        svc_update_db_interface_tagness(db, device_id,interfaces_result)
+        with SessionLocal() as db:
+            svc_update_db_interface_tagness(db, device_id,interfaces_result)
         
         return {"interfaces": interfaces_result}
     except Exception as e:
@@ -231,35 +276,32 @@ def get_switching_interfaces_job(device_ip: str, device_id:int):
              "error": str(e)
         }
 
-    finally:
-        if dev:
-            dev.close()
+def sync_mac_table_to_db(device_id: int, mac_chunks):
+    """
+    Applies the polled MAC table to mac_table as a delta (adds, removes, moves),
+    keeping first_seen/last_seen. See macsync for the details.
+    """
+    return sync_mac_table_delta(device_id, mac_chunks)
 
+@device_locks.job("read")
 def fetch_mac_table_job(device_ip: str, device_id: int):
     try:
-        dev = Device(host=device_ip, user=DEVICE_USER, password=DEVICE_PASSWORD)
-        dev.open()
-        
-        mac_data = dev.rpc.get_ethernet_switching_table_information()
+        with device_pool.session(device_ip, DEVICE_USER, DEVICE_PASSWORD) as dev:
+            #Raw reply only, the big tree is never built (see xmlstream)
+            raw = rpc_reply_raw(dev, "get_ethernet_switching_table_information")
         
         logger.info(f"Fetched MAC table for device {device_ip}")
-        # Parse the XML into a Python List of Dictionaries
-        results = []
+        # Parse the reply incrementally and COPY it chunk by chunk, only the delta hits mac_table
         # vJunos typically uses 'l2ng' tags for Next-Gen Layer 2
-        for entry in mac_data.xpath('.//l2ng-mac-entry'):
-            results.append({
-                "vlan": entry.findtext('l2ng-l2-mac-vlan-name', default="N/A").strip(),
-                "mac": entry.findtext('l2ng-l2-mac-address', default="N/A").strip(),
-                "interface": entry.findtext('l2ng-l2-mac-logical-interface', default="N/A").strip(),
-            })
-            
-        dev.close()
+        mac_delta = sync_mac_table_to_db(device_id, iter_mac_chunks(raw))
+        del raw
         
         r.publish("job_notifications", "fetch_mac_table")
         return {
             "status": "Success",
             "device_id": device_id,
-            "mac_table" : results
+            "mac_entries": mac_delta["entries"],
+            "mac_delta": mac_delta
         }
     
     except Exception as e:
@@ -269,15 +311,86 @@ def fetch_mac_table_job(device_ip: str, device_id: int):
              "error": str(e)
         }
 
-    finally:
-        if dev:
-            dev.close()
 
+def sync_arp_table_to_db(device_id: int, arp_chunks):
+    """
+    Replaces the stored ARP table of the device, COPY chunk by chunk.
+    """
+    return replace_device_rows(device_id, "arp_table", ("ip_address", "mac_address", "interface"), (
+        [(entry["ip"], entry["mac"], entry["interface"]) for entry in chunk] for chunk in arp_chunks
+    ))
+
+def sync_routes_to_db(device_id: int, route_chunks):
+    """
+    Replaces the stored routing table of the device, COPY chunk by chunk.
+    route_chunks may be a generator still reading from the device, rows are
+    written as they arrive and committed together at the end.
+    """
+    return replace_device_rows(
+        device_id, "routing_table", ("destination", "next_hop", "protocol", "preference", "age"), (
+            [(route["destination"][:50], route["next_hop"][:50], route["protocol"][:20],
+              route["preference"], route["age"][:20] or None) for route in chunk]
+            for chunk in route_chunks
+        ))
+
+def collect_routes_to_db(dev, device_id: int):
+    return sync_routes_to_db(device_id, iter_route_chunks(dev, ROUTE_TABLES, sliced=ROUTE_SLICED))
+
+@device_locks.job("read")
+def fetch_arp_table_job(device_ip: str, device_id: int):
+    try:
+        with device_pool.session(device_ip, DEVICE_USER, DEVICE_PASSWORD) as dev:
+            raw = rpc_reply_raw(dev, "get_arp_table_information", no_resolve=True)
+
+        arp_count = sync_arp_table_to_db(device_id, iter_chunks(iter_arp_entries(raw), MAC_CHUNK_SIZE))
+        logger.info(f"Stored {arp_count} ARP entries for device {device_ip}")
+        r.publish("job_notifications", "fetch_arp_table")
+        return {
+            "status": "Success",
+            "device_id": device_id,
+            "arp_entries": arp_count
+        }
+
+    except Exception as e:
+        return {
+             "status": "Error",
+             "device_id": device_id,
+             "error": str(e)
+        }
+
+@device_locks.job("read")
+def fetch_route_table_job(device_ip: str, device_id: int):
+    """
+    Collects ROUTE_TABLES into routing_table. Slices are fetched and written while
+    the session is open, so memory stays at one slice no matter how big the table is.
+    """
+    try:
+        with device_pool.session(device_ip, DEVICE_USER, DEVICE_PASSWORD) as dev:
+            route_count = collect_routes_to_db(dev, device_id)
+
+        logger.info(f"Stored {route_count} routes for device {device_ip}")
+        r.publish("job_notifications", "fetch_route_table")
+        return {
+            "status": "Success",
+            "device_id": device_id,
+            "tables": ROUTE_TABLES,
+            "routes": route_count
+        }
 
+    except Exception as e:
+        return {
+             "status": "Error",
+             "device_id": device_id,
+             "error": str(e)
+        }
+
+
+@device_locks.job("read")
 def provision_device_job(device_ip: str, username: str, password: str, session_id=None):
     """
     This function provisions a device by fetching its facts and returns device_id.
     device_id is used in the chain to call other jobs.
+    Out of NETCONF session budget the job is retried later instead of failing.
     """
 
     # 1. Get the Job ID automatically from RQ
@@ -302,6 +415,8 @@ def provision_device_job(device_ip: str, username: str, password: str, session_i
     # Check device netconf connectivity
     log_to_ws(session_id, f"--- Checking Netconf Connectivity ---")
     
+    #The check opens a session of its own, it counts against the budget too
+    session_limiter.acquire(device_ip)
     if not svc_check_netconf_connectivity(device_ip, username, password):
         log_to_ws(session_id, f"\x1b[31m--- [FAILED] NETCONF ---\x1b[0m")
         return {
@@ -315,23 +430,25 @@ def provision_device_job(device_ip: str, username: str, password: str, session_i
     try:
         # Use Juniper Device class (imported as Device)
         log_to_ws(session_id, "Step 1: Establishing SSH connection...")
-        dev = Device(host=device_ip, user=username, password=password)
-        dev.open()
-     
+        #Session stays in the pool, chained jobs reuse it when username is DEVICE_USER.
+        #Facts are lazy in PyEZ so read them while we hold the session.
+        with device_pool.session(device_ip, username, password) as dev:
+            facts = {key: dev.facts[key] for key in ("hostname", "version", "model", "serialnumber")}
+
         # Use our DB Model class (DeviceNet)
         new_device = models.DeviceNet(
-            hostname=dev.facts['hostname'],
+            hostname=facts['hostname'],
             ip_address=device_ip,
             platform="NA",
             type="switch",           
-            os_version=dev.facts['version'], 
-            model=dev.facts['model'],           
+            os_version=facts['version'], 
+            model=facts['model'],           
             vendor="NA",
-            serialnumber=dev.facts['serialnumber'] # Note: fixed typo from serial_number to serialnumber based on models.py
+            serialnumber=facts['serialnumber'] # Note: fixed typo from serial_number to serialnumber based on models.py
         )
+        apply_location_meta(new_device, job)
         logger.info(f"Provisioned device {device_ip}")
         
-        dev.close()
         log_to_ws(session_id, "Step 2: Connection Successful.")
         #Dispatch the job to util function
         try:
@@ -340,18 +457,11 @@ def provision_device_job(device_ip: str, username: str, password: str, session_i
             if db_result:
                 log_to_ws(session_id, "Step 3: Device added to database.")
                 if run_chain: #because we can call this function from endpoint or from another job
-                    log_to_ws(session_id, "Step 4: Device interfaces are being fetched, please wait...")
-                    
-                    new_job = Job.create(
-                        func=get_interfaces_job,
-                        args=(int(device_id),),
-                        connection=system_q.connection
-                    )
-                    new_job.meta["run_chain"] = True
-                    new_job.meta["session_id"] = session_id
-                    new_job.save_meta()
-
-                    system_q.enqueue_job(new_job)
+                    log_to_ws(session_id, "Step 4: Device interfaces and VLANs are being fetched, please wait...")
+                    workflow_id, _ = start_workflow(DEVICE_SYNC, system_q, {"device_id": int(device_id)},
+                                                    meta={"session_id": session_id, "target": int(device_id)})
+                    job.meta["workflow_id"] = workflow_id
+                    job.save_meta()
             else:
                 log_to_ws(session_id, "Step 3: Device not added to database.")
         except Exception as e:
@@ -361,6 +471,8 @@ def provision_device_job(device_ip: str, username: str, password: str, session_i
         #log_to_ws(session_id, "\x1b[32m[COMPLETED] Provisioning completed successfully.\x1b[0m")
         return device_id
 
+    except SessionRateLimited:
+        raise
     except Exception as e:
         return {
              "status": "Error",
@@ -368,20 +480,104 @@ def provision_device_job(device_ip: str, username: str, password: str, session_i
              "error": str(e)
         }
 
-    finally:
-        if dev:
-            dev.close()
+@device_locks.job("read")
+def provision_device_single_session_job(device_ip: str, username: str, password: str, session_id=None):
+    """
+    Provisions a device over ONE NETCONF session instead of the ping + ncclient
+    check + Device.open() + chained jobs of provision_device_job.
+    Opening the session is the reachability and auth check, then facts, DB insert,
+    interfaces, switching interfaces and vlans are all read over the same session.
+    Every step reports its duration on the logs_{session_id} channel.
+    Out of NETCONF session budget the job is retried later instead of failing.
+    """
+    job = get_current_job()
+    if job:
+        session_id = job.meta.get("session_id", session_id)
+    timings = {}
+
+    def step(name, message, started):
+        elapsed = time.perf_counter() - started
+        timings[name] = round(elapsed, 3)
+        log_to_ws(session_id, f"{message} ({elapsed:.2f}s)")
+
+    def failed(error):
+        log_to_ws(session_id, f"\x1b[31m--- [FAILED] {error} ---\x1b[0m")
+        return {
+            "status": "Error",
+            "device_ip": device_ip,
+            "error": error,
+            "timings": timings
+        }
+
+    log_to_ws(session_id, "--- Opening NETCONF session (reachability + auth) ---")
+    started = time.perf_counter()
+    try:
+        with device_pool.session(device_ip, username, password) as dev:
+            step("connect", "\x1b[32m--- NETCONF [OK] ---\x1b[0m", started)
+
+            started = time.perf_counter()
+            facts = {key: dev.facts[key] for key in ("hostname", "version", "model", "serialnumber")}
+            step("facts", "Step 1: Device facts collected.", started)
+
+            started = time.perf_counter()
+            new_device = models.DeviceNet(
+                hostname=facts['hostname'],
+                ip_address=device_ip,
+                platform="NA",
+                type="switch",
+                os_version=facts['version'],
+                model=facts['model'],
+                vendor="NA",
+                serialnumber=facts['serialnumber']
+            )
+            apply_location_meta(new_device, job)
+            device_id = apiut.add_device_to_db(new_device).id
+            step("db_insert", "Step 2: Device added to database.", started)
+
+            started = time.perf_counter()
+            ports = EthPortTable(dev)
+            ports.get()
+            synced = sync_interfaces_to_db(device_id, ports.items())
+            step("interfaces", f"Step 3: {synced} interfaces synced to DB.", started)
+
+            started = time.perf_counter()
+            interfaces_result = collect_switching_interfaces(dev)
+            with SessionLocal() as db:
+                svc_update_db_interface_tagness(db, device_id, interfaces_result)
+            step("switching_interfaces", "Step 4: Interface tagness synced to DB.", started)
+
+            started = time.perf_counter()
+            sync_vlans_to_db(device_id, collect_vlans(dev))
+            step("vlans", "Step 5: VLANs synced to DB.", started)
+
+    except (ConnectTimeoutError, ConnectRefusedError, ConnectUnknownHostError) as e:
+        return failed(f"Device is not reachable by NETCONF: {e}")
+    except ConnectAuthError:
+        return failed("NETCONF authentication failed")
+    except SessionRateLimited as e:
+        log_to_ws(session_id, f"--- {e}, provisioning will be retried ---")
+        raise
+    except Exception as e:
+        return failed(str(e))
+
+    log_to_ws(session_id, f"\x1b[32m--- [COMPLETED] Provisioning completed in {sum(timings.values()):.2f}s ---\x1b[0m")
+    logger.info(f"Provisioned device {device_ip} over a single session: {timings}")
+    return {
+        "status": "Success",
+        "device_id": device_id,
+        "job_type": "provision_device_single_session",
+        "timings": timings
+    }
 
+@device_locks.job("read", ip_of=svc_get_device_ip_by_id_sync)
 def fetch_vlans_job(device_id: int):
     """
     RQ TASK: Fetches the list of configured vlans from the device.
     """
     device_ip = svc_get_device_ip_by_id_sync(device_id)
     try:
-        dev = Device(host=device_ip, user=DEVICE_USER, password=DEVICE_PASSWORD)
-        dev.open()
-        
-        vlans_data = dev.rpc.get_vlan_information()
+        with device_pool.session(device_ip, DEVICE_USER, DEVICE_PASSWORD) as dev:
+            vlans_data = dev.rpc.get_vlan_information()
 
         
         # Parse the XML into a Python List of Dictionaries
@@ -392,8 +588,6 @@ def fetch_vlans_job(device_id: int):
                 "vlan_name": entry.findtext('l2ng-l2rtb-vlan-name', default="N/A").strip(),
             })
         logger.info(f"Fetched VLANs for device {device_ip}")
-            
-        dev.close()
 
         #redis job id that is created for this task
         current_job = get_current_job()
@@ -405,24 +599,9 @@ def fetch_vlans_job(device_id: int):
         }
 
         session_id = current_job.meta.get("session_id")
-        run_chain = current_job.meta.get("run_chain",False)   
         if results:
             ws_message = f"Step 6: VLANs fetched successfully from the device"
             log_to_ws(session_id, ws_message) 
-            #now time to sync the vlans to DB
-            new_job = Job.create(
-                func=post_fetch_vlans_job,
-                args=(device_id,results,),
-                connection=current_job.connection,
-            )
-            new_job.meta = {
-                "session_id": session_id,
-                "run_chain": run_chain
-            }
-            new_job.save_meta()
-            new_job.save()
-            system_q.enqueue_job(new_job)
-
         else:
             ws_message = f"Step 6: VLANs fetching FAILED."
             log_to_ws(session_id, ws_message)
@@ -458,40 +637,8 @@ def post_fetch_vlans_job(device_id,results):
     We only add vlans to the device if they are not in the device. We can add a manual force-sync or diff 
     calculator to give more control to the user.
     """
-    device_ip = svc_get_device_ip_by_id_sync(device_id)
-
     logger.info("!!!!!POST RUN AFTER FETCH VLANS JOB!!!!!")
-    #[{'vlan_id': '100', 'vlan_name': 'auto-vlan'}, {'vlan_id': '1000', 'vlan_name': 'auto-vlan-1000'}
-    #we get this from the fetch_vlans_job: vlan id is string so we convert it to int
-    live_vlan_list = results
-    live_vlan_map = {int(vlan['vlan_id']): vlan.get('vlan_name', 'auto-vlan-{}'.format(vlan['vlan_id'])) for vlan in live_vlan_list}
-    
-    #Get all vlans from DB. Result is a list of dictionaries.
-    db_vlan_list = apiut.get_device_vlans(device_id) 
-    if db_vlan_list is None: #If there are no vlans in DB, this must be first run.
-        db_vlan_list = []
-        db_vlan_map = {} #so no vlan mapping i.e vlan_id: vlan_name
-    else:
-        db_vlan_map = {vlan.vlan_id: vlan.vlan_name for vlan in db_vlan_list}
-
-
-    #compare live and db vlans: juniper returns vlan_id as string it is a problem
-    live_vlan_ids = { int(vlan_id) for vlan_id in live_vlan_map.keys()}
-    db_vlan_ids = { int(vlan_id) for vlan_id in db_vlan_map.keys()}
-    vlan_id_diff = live_vlan_ids - db_vlan_ids
-        
-    
-    print(vlan_id_diff)
-
-    #Basic stuff add vlan to DB if it isn't available as we normally add vlans via UI
-    vlan_list_diff = [] #this is a list of dictionaries {'vlan_id': '100', 'vlan_name': 'auto-vlan'}
-    for vlan_id, vlan_name in live_vlan_map.items():
-        if vlan_id in vlan_id_diff:
-            vlan_list_diff.append({'vlan_id': vlan_id, 'vlan_name': vlan_name})
-
-
-    #Update DB with new vlans
-    update_db = apiut.update_device_vlans_db(device_id, vlan_list_diff)
+    update_db = sync_vlans_to_db(device_id, results)
     current_job = get_current_job()
     session_id = current_job.meta.get("session_id")
     run_chain = current_job.meta.get("run_chain",False)
@@ -501,24 +648,93 @@ def post_fetch_vlans_job(device_id,results):
     else:
         log_to_ws(session_id, "Step 7: VLANs update FAILED.")
 
+def access_vlan_commands(interface, vlan_id):
+    #set and del command might look stupid but if the config stanza is not available
+    #it returns a warning/error. We avoid it by this trick.
+    commands = f"""
+    set interfaces {interface} unit 0 family ethernet-switching interface-mode access
+    set interfaces {interface} unit 0 family ethernet-switching vlan members {vlan_id} 
+    del interfaces {interface} unit 0 family ethernet-switching vlan 
+    set interfaces {interface} unit 0 family ethernet-switching vlan members {vlan_id}
+    """
+    return commands, f"Automation: Set interface {interface} to VLAN {vlan_id}"
+
+def trunk_vlan_commands(interface_name, vlan_id):
+    commands = f"""
+    set interfaces {interface_name} unit 0 family ethernet-switching interface-mode trunk
+    set interfaces {interface_name} unit 0 family ethernet-switching vlan members {vlan_id}
+    """
+    return commands, f"Automation: set interface mode {interface_name} to trunk"
+
+def create_vlan_commands(vlan_id, vlan_name=None):
+    commands = f"""
+    set vlans auto-vlan-{vlan_id} vlan-id {vlan_id}
+    """
+    return commands, f"Automation: Created VLAN {vlan_id}"
+
+def apply_config_change(device_ip, commands, comment):
+    """
+    Hands the change to the per-device batcher and waits for its commit outcome.
+    The change is keyed by the current job id so a change already submitted by
+    enqueue_config_job is not queued twice.
+    """
+    job = get_current_job()
+    config_batcher.submit(device_ip, job.id, commands, comment)
+    try:
+        return config_batcher.apply(
+            device_ip,
+            job.id,
+            lambda: device_pool.session(device_ip, DEVICE_USER, DEVICE_PASSWORD)
+        )
+    except SessionRateLimited:
+        #The change went back to pending, the retried job waits for it again
+        raise
+    except Exception:
+        #The jobs turn this into an error result, the change must not go in later
+        withdraw_config_change(device_ip, job)
+        raise
+
+def withdraw_config_change(device_ip, job):
+    #The job won't wait for its change any more, a later leader mustn't commit it
+    if config_batcher.withdraw(device_ip, job.id):
+        logger.info(f"Withdrew the change of failed job {job.id} on {device_ip}")
+
+def config_job_failed(job, connection, type, value, traceback):
+    """
+    RQ on_failure callback of the configuration jobs: the job raised, timed out
+    or its worker died, so its change is taken back from the batcher.
+    """
+    withdraw_config_change(job.args[0], job)
+
+def enqueue_config_job(queue, func, device_ip, *args):
+    """
+    Enqueues a configuration job and submits its change to the batcher right
+    away, so changes for the same device queued close together end up in one commit
+    even if the workers pick their jobs up later. A job that ends failed withdraws
+    its change again.
+    """
+    job = Job.create(func, args=(device_ip, *args), connection=queue.connection, timeout=CONFIG_JOB_TIMEOUT,
+                     on_failure=Callback(config_job_failed))
+    commands, comment = CONFIG_COMMANDS[func.__name__](*args)
+    config_batcher.submit(device_ip, job.id, commands, comment)
+    queue.enqueue_job(job)
+    return job
+
+@device_locks.job("write", on_give_up=withdraw_config_change)
 def set_trunk_interface_vlan_job(device_ip,interface_name,vlan_id):
+    interface_mode = "trunk"
     try:
-        dev = Device(host=device_ip, user=DEVICE_USER, password=DEVICE_PASSWORD)
-        dev.open()
-        cu = Config(dev)
-        commands = f"""
-        set interfaces {interface_name} unit 0 family ethernet-switching interface-mode trunk
-        set interfaces {interface_name} unit 0 family ethernet-switching vlan members {vlan_id}
-        """        
-        cu.load(commands,format="set")
-        cu.commit(comment=f"Automation: set interface mode {interface_name} to {interface_mode}")
-        dev.close()
+        commands, comment = trunk_vlan_commands(interface_name, vlan_id)
+        outcome = apply_config_change(device_ip, commands, comment)
+        if outcome["status"] != "Success":
+            raise Exception(outcome["error"])
 
         return {
             "status": "Success",
             "interface_name": interface_name,
             "interface_mode": interface_mode,
             "job_type" : "set_trunk_interface_vlan",
+            "batch_size": outcome.get("batch_size"),
             "message": f"Interface {interface_name} successfully set to mode {interface_mode}."
         }    
     except Exception as e:
@@ -530,23 +746,14 @@ def set_trunk_interface_vlan_job(device_ip,interface_name,vlan_id):
     
     
 
+@device_locks.job("write", on_give_up=withdraw_config_change)
 def set_interface_vlan_job(device_ip, interface, vlan_id):
     try:
-        dev = Device(host=device_ip, user=DEVICE_USER, password=DEVICE_PASSWORD)
-        dev.open()
         logger.info(f"Set interface {interface} to VLAN {vlan_id} for device {device_ip}")
-        cu = Config(dev)
-        #set and del command might look stupid but if the config stanza is not available
-        #it returns a warning/error. We avoid it by this trick.
-        commands = f"""
-        set interfaces {interface} unit 0 family ethernet-switching interface-mode access
-        set interfaces {interface} unit 0 family ethernet-switching vlan members {vlan_id} 
-        del interfaces {interface} unit 0 family ethernet-switching vlan 
-        set interfaces {interface} unit 0 family ethernet-switching vlan members {vlan_id}
-        """
-        cu.load(commands,format="set")
-        cu.commit(comment=f"Automation: Set interface {interface} to VLAN {vlan_id}")
-        dev.close()
+        commands, comment = access_vlan_commands(interface, vlan_id)
+        outcome = apply_config_change(device_ip, commands, comment)
+        if outcome["status"] != "Success":
+            raise Exception(outcome["error"])
 
         job_id = get_current_job().get_id()      
         message = {
@@ -562,6 +769,7 @@ def set_interface_vlan_job(device_ip, interface, vlan_id):
             "status": "Success",
             "vlan_id": vlan_id,
             "job_type" : "set_interface_vlan",
+            "batch_size": outcome.get("batch_size"),
             "message": f"Interface {interface} successfully set to VLAN {vlan_id}."
         }    
     except Exception as e:
@@ -571,21 +779,17 @@ def set_interface_vlan_job(device_ip, interface, vlan_id):
              "error": str(e)
         }
 
+@device_locks.job("write", on_give_up=withdraw_config_change)
 def create_vlan_job(device_ip, vlan_id, vlan_name):
     """
        This function creates a VLAN on a Juniper device.
     """
 
-    dev = Device(host=device_ip, user=DEVICE_USER, password=DEVICE_PASSWORD)
     try:
-        dev.open()
-        cu = Config(dev)
-        commands = f"""
-        set vlans auto-vlan-{vlan_id} vlan-id {vlan_id}
-        """
-        cu.load(commands,format="set")
-        cu.commit(comment=f"Automation: Created VLAN {vlan_id}")
-        dev.close()
+        commands, comment = create_vlan_commands(vlan_id, vlan_name)
+        outcome = apply_config_change(device_ip, commands, comment)
+        if outcome["status"] != "Success":
+            raise Exception(outcome["error"])
 
         job_id = get_current_job().get_id()      
         message = {
@@ -601,43 +805,106 @@ def create_vlan_job(device_ip, vlan_id, vlan_name):
             "status": "Success",
             "vlan_id": vlan_id,
             "job_type" : "create_vlan",
+            "batch_size": outcome.get("batch_size"),
             "message": f"VLAN {vlan_id} successfully created."
         }    
 
-    except ConnectionError:
-        logger.error(f"Could not connect to device {device_ip}")
-        raise HTTPException(
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="Could not connect to the device"
-        )
-
     except Exception as e:
-        logger.error(f"An unexpected error occurred: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"An unexpected error occurred: {str(e)}"
-        )
+        logger.error(f"Creating VLAN {vlan_id} on {device_ip} failed: {e}")
+        return {
+             "status": "Error",
+             "device_ip": device_ip,
+             "error": str(e)
+        }
     
+#Command builders of the configuration jobs, used by enqueue_config_job
+CONFIG_COMMANDS = {
+    "set_interface_vlan_job": access_vlan_commands,
+    "set_trunk_interface_vlan_job": trunk_vlan_commands,
+    "create_vlan_job": create_vlan_commands,
+}
+
+# --- workflows ---
+# Steps take (params, inputs): params are the workflow parameters, inputs the
+# outputs of the steps they run after. They raise on error so the rest of the
+# workflow is canceled, outputs are stored once and read by key (see workflow.py).
+# A step finding its device locked gives the worker back, run_step defers it.
+
+def _workflow_device(params, inputs):
+    device_id = params.get("device_id") or inputs.get("device")
+    return device_id, svc_get_device_ip_by_id_sync(device_id)
+
+def wf_register_device(params, inputs):
+    #Undecorated: a step out of session budget is deferred by run_step, not by the device lock
+    result = provision_device_job.__wrapped__(params["device_ip"], params["username"], params["password"],
+                                              params.get("session_id"))
+    if isinstance(result, dict):
+        raise Exception(result["error"])
+    return result
+
+def wf_fetch_interfaces(params, inputs):
+    device_id, device_ip = _workflow_device(params, inputs)
+    with device_locks.hold(device_ip, "read", wait=DEVICE_LOCK_JOB_WAIT), device_pool.session(device_ip, DEVICE_USER, DEVICE_PASSWORD) as dev:
+        ports = EthPortTable(dev)
+        ports.get()
+    return ports.items()
+
+def wf_sync_interfaces(params, inputs):
+    device_id, _ = _workflow_device(params, inputs)
+    synced = sync_interfaces_to_db(device_id, inputs["interfaces"])
+    log_to_ws(params.get("session_id"), f"Step 5: {synced} interfaces synced to DB.")
+    return synced
+
+def wf_switching_interfaces(params, inputs):
+    device_id, device_ip = _workflow_device(params, inputs)
+    with device_locks.hold(device_ip, "read", wait=DEVICE_LOCK_JOB_WAIT), device_pool.session(device_ip, DEVICE_USER, DEVICE_PASSWORD) as dev:
+        interfaces_result = collect_switching_interfaces(dev)
+    with SessionLocal() as db:
+        svc_update_db_interface_tagness(db, device_id, interfaces_result)
+    log_to_ws(params.get("session_id"), "Step 6: Interface tagness synced to DB.")
+    return len(interfaces_result)
+
+def wf_fetch_vlans(params, inputs):
+    _, device_ip = _workflow_device(params, inputs)
+    with device_locks.hold(device_ip, "read", wait=DEVICE_LOCK_JOB_WAIT), device_pool.session(device_ip, DEVICE_USER, DEVICE_PASSWORD) as dev:
+        return collect_vlans(dev)
+
+def wf_sync_vlans(params, inputs):
+    device_id, _ = _workflow_device(params, inputs)
+    sync_vlans_to_db(device_id, inputs["vlans"])
+    log_to_ws(params.get("session_id"), "Step 7: VLANs updated in database.")
+    return len(inputs["vlans"])
+
+#Interfaces and VLANs of a device already in the DB, the two branches run in parallel.
+#The outcome ends up in devices.sync_status / last_synced.
+DEVICE_SYNC = Workflow("device_sync", [
+    Step("interfaces", wf_fetch_interfaces),
+    Step("sync_interfaces", wf_sync_interfaces, after=["interfaces"]),
+    Step("switching_interfaces", wf_switching_interfaces, after=["sync_interfaces"]),
+    Step("vlans", wf_fetch_vlans),
+    Step("sync_vlans", wf_sync_vlans, after=["vlans"]),
+], on_finish=device_sync_finished)
+
+#Register the device, then DEVICE_SYNC on it. Every step runs after "device"
+#so the new device_id is in its inputs.
+PROVISION = Workflow("provision", [Step("device", wf_register_device)] + [
+    Step(step.name, step.func, after=step.after + ("device",)) for step in DEVICE_SYNC.steps
+])
+
 def sync_device_config_job(device_id: int):
     """
     Worker function to sync device configuration.
-    We use depends_on to ensure that the jobs are executed in the correct order.
-    We pass the previous job id to the next job to ensure that the results are 
-    passed correctly.
-    job2 is waiting in deferred status in redis until job1 is completed.
-    job3 is waiting in deferred status in redis until job2 is completed.
-    """
-    job1 = system_q.enqueue(get_interfaces_job, device_id)
-    job2 = system_q.enqueue(post_get_interfaces_job, 
-                            device_id,
-                            previous_job_id=job1.id,
-                            depends_on=job1)
-    job3 = system_q.enqueue(fetch_vlans_job, device_id, depends_on=job2)
+    Starts the DEVICE_SYNC workflow: interfaces (fetch, DB sync, tagness) and
+    VLANs (fetch, DB sync) run as two parallel branches.
+    """
+    workflow_id, job_ids = start_workflow(DEVICE_SYNC, system_q, {"device_id": device_id},
+                                          meta={"target": device_id})
 
     print(f"Syncing device configuration for device_id: {device_id}")
 
     return {
-        "job_ids": [job1.id, job2.id, job3.id],
+        "workflow_id": workflow_id,
+        "job_ids": list(job_ids.values()),
         "status": "Success",
         "device_id": device_id,
         "job_type" : "sync_device_config",
@@ -0,0 +1,102 @@
+import logging
+import os
+
+from dotenv import load_dotenv
+from prometheus_client import start_http_server
+from redis.exceptions import RedisError
+from rq.defaults import DEFAULT_LOGGING_DATE_FORMAT, DEFAULT_LOGGING_FORMAT
+from rq.exceptions import InvalidJobOperation
+from rq.job import JobStatus
+from rq.serializers import DefaultSerializer, resolve_serializer
+from rq.worker import SimpleWorker
+
+from juniper_cfg.database import JobSession, engine
+from juniper_cfg.devpool import device_pool
+from juniper_cfg.jobindex import IndexedQueue, IndexedScheduler, update_job_status
+from juniper_cfg.serializer import JunoxSerializer, payload_ttl
+
+load_dotenv()
+
+logger = logging.getLogger("JunoxWorker")
+
+#Prometheus scrape port of the worker process (workers don't serve /metrics through FastAPI)
+WORKER_METRICS_PORT = os.getenv("WORKER_METRICS_PORT")
+
+
+class JunoxWorker(SimpleWorker):
+    """
+    RQ worker for junox jobs. It runs jobs in the worker process itself
+    (no fork per job) so state such as the NETCONF session pool survives
+    between jobs. Per job state does not: the job's DB session is removed
+    when the job (and its callbacks) finished.
+    rq worker -w juniper_cfg.worker.JunoxWorker --serializer juniper_cfg.serializer.JunoxSerializer \
+        --queue-class juniper_cfg.jobindex.IndexedQueue system generic user
+    Jobs are (de)serialized with JunoxSerializer unless --serializer names another
+    one. The rq CLI always passes its DefaultSerializer, that is replaced as well,
+    on the worker and on the queues the CLI built with it. The CLI also passes
+    its queue class, without --queue-class the dependents and retries the worker
+    enqueues skip the job index.
+    """
+
+    queue_class = IndexedQueue
+
+    def __init__(self, *args, **kwargs):
+        if resolve_serializer(kwargs.get("serializer")) is DefaultSerializer:
+            kwargs["serializer"] = JunoxSerializer
+            queues = args[0] if args else kwargs.get("queues")
+            for queue in queues if isinstance(queues, (list, tuple)) else []:
+                if not isinstance(queue, str) and queue.serializer is DefaultSerializer:
+                    queue.serializer = JunoxSerializer
+        super().__init__(*args, **kwargs)
+
+    def bootstrap(self, *args, **kwargs):
+        super().bootstrap(*args, **kwargs)
+        if WORKER_METRICS_PORT:
+            start_http_server(int(WORKER_METRICS_PORT))
+            logger.info(f"Worker metrics exposed on :{WORKER_METRICS_PORT}")
+
+    def _start_scheduler(self, burst=False, logging_level="INFO", date_format=DEFAULT_LOGGING_DATE_FORMAT,
+                         log_format=DEFAULT_LOGGING_FORMAT):
+        #RQ's own, with the scheduler that indexes the jobs it enqueues
+        self.scheduler = IndexedScheduler(
+            self.queues,
+            connection=self.connection,
+            logging_level=logging_level if logging_level is not None else self.log.level,
+            date_format=date_format,
+            log_format=log_format,
+            serializer=self.serializer,
+        )
+        self.scheduler.acquire_locks()
+        if self.scheduler.acquired_locks:
+            if burst:
+                self.scheduler.enqueue_scheduled_jobs()
+                self.scheduler.release_locks()
+            else:
+                self.scheduler.start()
+
+    def perform_job(self, job, queue):
+        self._index_status(job, JobStatus.STARTED)
+        try:
+            #An offloaded result is kept as long as the result
+            with payload_ttl(job.get_result_ttl(self.default_result_ttl)):
+                return super().perform_job(job, queue)
+        finally:
+            #finished, failed, or scheduled again by a Retry
+            self._index_status(job)
+            JobSession.remove()
+            logger.debug(f"NETCONF pool after job {job.id}: {device_pool.stats()}")
+            logger.debug(f"DB pool after job {job.id}: {engine.pool.status()}")
+
+    def _index_status(self, job, status=None):
+        #The job index is a listing aid, a Redis hiccup here must not fail the job
+        try:
+            status = status or job.get_status(refresh=True)
+            if status:
+                update_job_status(job, status)
+        except (RedisError, InvalidJobOperation) as e:
+            logger.warning(f"Could not update job index for {job.id}: {e}")
+
+    def teardown(self):
+        device_pool.close_all()
+        engine.dispose()
+        super().teardown()
@@ -0,0 +1,294 @@
+import logging
+import math
+import os
+import time
+import uuid
+
+from dotenv import load_dotenv
+from rq import get_current_job
+from rq.job import Job, JobStatus, Retry
+from rq.utils import import_attribute
+
+from juniper_cfg.jobindex import update_job_status
+from juniper_cfg.logstream import append_log
+from juniper_cfg.serializer import JunoxSerializer
+
+load_dotenv()
+
+logger = logging.getLogger("Workflow")
+
+#How long workflow state and step outputs are kept in Redis
+WORKFLOW_TTL = int(os.getenv("WORKFLOW_TTL", str(24 * 3600)))
+#How often a step may be put off by an error that says when to retry (retry_after)
+WORKFLOW_STEP_DEFERRALS = int(os.getenv("WORKFLOW_STEP_DEFERRALS", "20"))
+#A workflow still running this long after its start is failed: a step whose worker
+#died never reports back, its on_finish would never run
+WORKFLOW_TIMEOUT = int(os.getenv("WORKFLOW_TIMEOUT", "1800"))
+
+#Running workflows scored by their deadline
+RUNNING_KEY = "workflows:running"
+
+#Ends a workflow only if it is still running, so on_finish runs once however it ended
+_END = """
+redis.call('ZREM', KEYS[2], ARGV[3])
+if redis.call('HGET', KEYS[1], 'status') ~= 'running' then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'status', ARGV[1], 'ended_at', ARGV[2])
+return 1
+"""
+
+
+class Step:
+    """
+    One node of a workflow: func(params, inputs) runs once every step in
+    `after` finished. params are the workflow parameters, inputs maps each
+    step in `after` to its output. Must be an importable module-level function.
+    """
+
+    def __init__(self, name: str, func, after=()):
+        self.name = name
+        self.func = func
+        self.after = tuple(after)
+
+    @property
+    def func_path(self):
+        return f"{self.func.__module__}.{self.func.__qualname__}"
+
+
+class Workflow:
+    """
+    A DAG of steps declared once, e.g.
+
+        DEVICE_SYNC = Workflow("device_sync", [
+            Step("interfaces", fetch_interfaces),
+            Step("sync_interfaces", sync_interfaces, after=["interfaces"]),
+            Step("vlans", fetch_vlans),
+        ])
+
+    start_workflow runs every step as its own RQ job with depends_on, so steps
+    that don't depend on each other run in parallel on separate workers.
+    on_finish(workflow_id, status, params) is called once the workflow
+    finished or failed, it must be an importable module-level function too.
+    """
+
+    def __init__(self, name: str, steps: list, on_finish=None):
+        self.name = name
+        self.steps = steps
+        self.on_finish = on_finish
+        known = set()
+        for step in steps:
+            if step.name in known:
+                raise ValueError(f"Workflow {name}: duplicate step {step.name}")
+            missing = [dep for dep in step.after if dep not in known]
+            if missing:
+                raise ValueError(f"Workflow {name}: step {step.name} runs after undeclared {missing}, "
+                                 "declare steps after the ones they depend on")
+            known.add(step.name)
+
+
+def _key(workflow_id):
+    return f"workflow:{workflow_id}"
+
+
+def _output_key(workflow_id, step):
+    return f"workflow:{workflow_id}:out:{step}"
+
+
+def _params_key(workflow_id):
+    return f"workflow:{workflow_id}:params"
+
+
+def start_workflow(workflow: Workflow, queue, params: dict, meta: dict = None):
+    """
+    Enqueues every step of the workflow on queue. Returns (workflow_id, {step: job_id}).
+    meta is copied to every step job (e.g. session_id for the WebSocket logs,
+    target for the job index: the device the workflow works on).
+    """
+    workflow_id = str(uuid.uuid4())
+    conn = queue.connection
+    created_at = time.time()
+    with conn.pipeline() as pipe:
+        pipe.hset(_key(workflow_id), mapping={
+            "name": workflow.name,
+            "status": "running",
+            "created_at": created_at,
+            "deadline": created_at + WORKFLOW_TIMEOUT,
+            "total": len(workflow.steps),
+            "done": 0,
+            "steps": ",".join(step.name for step in workflow.steps),
+            "on_finish": f"{workflow.on_finish.__module__}.{workflow.on_finish.__qualname__}"
+                         if workflow.on_finish else "",
+        })
+        pipe.set(_params_key(workflow_id), JunoxSerializer.dumps(params), ex=WORKFLOW_TTL)
+        pipe.expire(_key(workflow_id), WORKFLOW_TTL)
+        pipe.zadd(RUNNING_KEY, {workflow_id: created_at + WORKFLOW_TIMEOUT})
+        pipe.execute()
+
+    jobs = {}
+    for step in workflow.steps:
+        job = Job.create(
+            run_step,
+            args=(workflow_id, step.name, step.func_path, step.after),
+            connection=conn,
+            serializer=queue.serializer,
+            depends_on=[jobs[dep] for dep in step.after] or None,
+            meta={**(meta or {}), "workflow_id": workflow_id, "workflow_step": f"{workflow.name}.{step.name}"},
+        )
+        jobs[step.name] = job
+    #Step job ids are known before anything runs, a failing step can cancel the rest
+    conn.hset(_key(workflow_id), mapping={f"step:{name}:job_id": job.id for name, job in jobs.items()})
+    for job in jobs.values():
+        queue.enqueue_job(job)
+
+    return workflow_id, {name: job.id for name, job in jobs.items()}
+
+
+def _load(conn, key):
+    data = conn.get(key)
+    return JunoxSerializer.loads(data) if data is not None else None
+
+
+def run_step(workflow_id: str, step: str, func_path: str, after: tuple):
+    """
+    RQ job of one workflow step: loads the outputs of the steps it runs after,
+    calls the step function and stores its output once for the steps after it.
+    The job result is only a summary, the output is read by key.
+    A step failing with an error that has a retry_after (e.g. SessionRateLimited)
+    is rescheduled instead of failing the workflow, up to WORKFLOW_STEP_DEFERRALS times.
+    """
+    job = get_current_job()
+    conn = job.connection
+    key = _key(workflow_id)
+    session_id = job.meta.get("session_id")
+
+    params = _load(conn, _params_key(workflow_id)) or {}
+    inputs = {dep: _load(conn, _output_key(workflow_id, dep)) for dep in after}
+
+    conn.hset(key, mapping={f"step:{step}:status": "started", f"step:{step}:started_at": time.time()})
+    started = time.perf_counter()
+    try:
+        output = import_attribute(func_path)(params, inputs)
+    except Exception as e:
+        retry_after = getattr(e, "retry_after", None)
+        deferrals = job.meta.get("deferrals", 0)
+        if retry_after is not None and deferrals < WORKFLOW_STEP_DEFERRALS:
+            job.meta["deferrals"] = deferrals + 1
+            job.save_meta()
+            conn.hset(key, f"step:{step}:status", "deferred")
+            logger.info(f"Workflow {workflow_id} step {step} deferred by {retry_after:.1f}s: {e}")
+            #RQ schedules the retry, the worker needs --with-scheduler
+            return Retry(max=WORKFLOW_STEP_DEFERRALS, interval=max(1, math.ceil(retry_after)))
+        duration = round(time.perf_counter() - started, 3)
+        conn.hset(key, mapping={f"step:{step}:status": "failed", f"step:{step}:duration": duration,
+                                f"step:{step}:error": str(e)})
+        if session_id:
+            append_log(conn, session_id, f"\x1b[31m--- [FAILED] {step}: {e} ---\x1b[0m")
+        if _end(conn, workflow_id, "failed"):
+            _cancel_pending(conn, workflow_id, job.serializer)
+            _on_finish(conn, workflow_id, "failed", params)
+        raise
+
+    duration = round(time.perf_counter() - started, 3)
+    with conn.pipeline() as pipe:
+        if output is not None:
+            pipe.set(_output_key(workflow_id, step), JunoxSerializer.dumps(output), ex=WORKFLOW_TTL)
+        pipe.hset(key, mapping={f"step:{step}:status": "finished", f"step:{step}:duration": duration})
+        pipe.hincrby(key, "done", 1)
+        pipe.hmget(key, "total", "created_at")
+        done, (total, created_at) = pipe.execute()[-2:]
+
+    if done == int(total) and _end(conn, workflow_id, "finished"):
+        elapsed = time.time() - float(created_at)
+        logger.info(f"Workflow {workflow_id} finished in {elapsed:.2f}s")
+        if session_id:
+            append_log(conn, session_id, f"\x1b[32m--- [COMPLETED] Workflow finished in {elapsed:.2f}s ---\x1b[0m")
+        _on_finish(conn, workflow_id, "finished", params)
+
+    return {"workflow_id": workflow_id, "step": step, "duration": duration}
+
+
+def _end(conn, workflow_id, status):
+    return conn.eval(_END, 2, _key(workflow_id), RUNNING_KEY, status, time.time(), workflow_id) == 1
+
+
+def _on_finish(conn, workflow_id, status, params):
+    func_path = conn.hget(_key(workflow_id), "on_finish")
+    if not func_path:
+        return
+    try:
+        import_attribute(func_path.decode())(workflow_id, status, params)
+    except Exception as e:
+        logger.error(f"on_finish of workflow {workflow_id} failed: {e}")
+
+
+def _cancel_pending(conn, workflow_id, serializer):
+    info = get_workflow(conn, workflow_id)
+    pending = [step for step in info["steps"] if step["status"] in ("pending", "deferred")]
+    for job in Job.fetch_many([step["job_id"] for step in pending], connection=conn, serializer=serializer):
+        if job is not None and job.get_status() in (JobStatus.DEFERRED, JobStatus.QUEUED, JobStatus.SCHEDULED):
+            job.cancel()
+            update_job_status(job, JobStatus.CANCELED)
+    if pending:
+        conn.hset(_key(workflow_id), mapping={f"step:{step['name']}:status": "canceled" for step in pending})
+
+
+def _fail_stale(conn, workflow_id, serializer=JunoxSerializer):
+    if not _end(conn, workflow_id, "failed"):
+        return False
+    info = get_workflow(conn, workflow_id)
+    lost = [step["name"] for step in info["steps"] if step["status"] == "started"]
+    if lost:
+        error = f"No outcome within the workflow timeout ({WORKFLOW_TIMEOUT}s)"
+        conn.hset(_key(workflow_id), mapping={field: value for name in lost for field, value in
+                                              ((f"step:{name}:status", "failed"), (f"step:{name}:error", error))})
+    _cancel_pending(conn, workflow_id, serializer)
+    logger.warning(f"Workflow {workflow_id} failed: still running after {WORKFLOW_TIMEOUT}s, lost steps {lost}")
+    _on_finish(conn, workflow_id, "failed", _load(conn, _params_key(workflow_id)) or {})
+    return True
+
+
+def fail_stale_workflows(conn):
+    """
+    Fails every workflow still running past its deadline (WORKFLOW_TIMEOUT) and
+    runs its on_finish. Called by the fleet scheduler tick; get_workflow does the
+    same for the workflow it reads. Returns how many were failed.
+    """
+    stale = conn.zrangebyscore(RUNNING_KEY, "-inf", time.time())
+    return sum(_fail_stale(conn, workflow_id.decode()) for workflow_id in stale)
+
+
+def get_workflow(conn, workflow_id: str):
+    """
+    Status of a workflow and of each step (job id, status, duration), None if unknown.
+    """
+    raw = conn.hgetall(_key(workflow_id))
+    if not raw:
+        return None
+    data = {field.decode(): value.decode() for field, value in raw.items()}
+    if data["status"] == "running" and float(data.get("deadline", "inf")) < time.time():
+        if _fail_stale(conn, workflow_id):
+            return get_workflow(conn, workflow_id)
+
+    steps = []
+    for name in data["steps"].split(","):
+        duration = data.get(f"step:{name}:duration")
+        steps.append({
+            "name": name,
+            "job_id": data.get(f"step:{name}:job_id"),
+            "status": data.get(f"step:{name}:status", "pending"),
+            "duration": float(duration) if duration else None,
+            "error": data.get(f"step:{name}:error"),
+        })
+
+    created_at = float(data["created_at"])
+    ended_at = float(data["ended_at"]) if data.get("ended_at") else None
+    return {
+        "workflow_id": workflow_id,
+        "name": data["name"],
+        "status": data["status"],
+        "created_at": created_at,
+        "ended_at": ended_at,
+        "elapsed": round((ended_at or time.time()) - created_at, 3),
+        "steps": steps,
+    }
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+from prometheus_client import Counter, Gauge
+import redis.asyncio as aioredis
+
+load_dotenv()
+
+logger = logging.getLogger("WSHub")
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+#Messages buffered per socket before it counts as too slow and is disconnected
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "1000"))
+
+WS_ACTIVE_SOCKETS = Gauge('ws_active_sockets', 'WebSocket/SSE clients attached to a hub', ['hub'])
+WS_SLOW_CLIENTS = Counter('ws_slow_clients_total', 'WebSocket/SSE clients disconnected because their queue was full', ['hub'])
+
+
+class Subscription:
+    """
+    One socket's view of a channel: messages are queued by the hub and sent
+    by the socket's own task. overflowed is set when the queue was full and a
+    message had to be dropped, the socket should then be closed.
+    """
+
+    def __init__(self, channel: str, maxsize: int):
+        self.channel = channel
+        self.queue = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+
+class ChannelHub:
+    """
+    Fans Redis channels matching pattern out to WebSocket/SSE clients.
+    A single pattern subscription per process reads from Redis and pushes each
+    message into the queue of every client subscribed to that channel, so open
+    consoles cost a queue each instead of a Redis connection and a poll loop.
+    A client that can't keep up fills its queue and is dropped instead of
+    holding messages (and memory) for everyone else.
+    """
+
+    def __init__(self, name: str, redis_conn, pattern: str, queue_size: int = WS_QUEUE_SIZE):
+        self.name = name
+        self.r = redis_conn
+        self.pattern = pattern
+        self.queue_size = queue_size
+        self._subscriptions = {}
+        self._task = None
+
+    def subscribe(self, channel: str) -> Subscription:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._listen())
+        subscription = Subscription(channel, self.queue_size)
+        self._subscriptions.setdefault(channel, set()).add(subscription)
+        WS_ACTIVE_SOCKETS.labels(hub=self.name).inc()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._subscriptions.get(subscription.channel)
+        if subscribers is None or subscription not in subscribers:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self._subscriptions[subscription.channel]
+        WS_ACTIVE_SOCKETS.labels(hub=self.name).dec()
+
+    def _dispatch(self, channel: str, data):
+        for subscription in self._subscriptions.get(channel, ()):
+            try:
+                subscription.queue.put_nowait(data)
+            except asyncio.QueueFull:
+                if not subscription.overflowed:
+                    WS_SLOW_CLIENTS.labels(hub=self.name).inc()
+                subscription.overflowed = True
+
+    async def _listen(self):
+        while True:
+            pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.psubscribe(self.pattern)
+                while True:
+                    #Blocks until a message arrives, the timeout only lets redis-py
+                    #run its health check on an idle connection
+                    message = await pubsub.get_message(timeout=30)
+                    if message is None or message["type"] != "pmessage":
+                        continue
+                    self._dispatch(message["channel"], message["data"])
+            except asyncio.CancelledError:
+                await pubsub.aclose()
+                raise
+            except Exception as e:
+                logger.warning(f"{self.name} hub lost Redis ({e}), reconnecting")
+                await pubsub.aclose()
+                await asyncio.sleep(5)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+hub_redis = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True, health_check_interval=30)
+#Provisioning consoles (/ws/logs) and job state transitions (/other/jobs/events)
+log_hub = ChannelHub("logs", hub_redis, "logs_*")
+job_hub = ChannelHub("jobs", hub_redis, "job_notifications")
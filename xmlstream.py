@@ -0,0 +1,222 @@
+import os
+
+from dotenv import load_dotenv
+from lxml import etree
+from ncclient.operations.third_party.juniper.rpc import ExecuteRpc
+from ncclient.operations.errors import TimeoutExpiredError
+
+load_dotenv()
+
+#Entries handed to the sink at once
+MAC_CHUNK_SIZE = int(os.getenv("MAC_CHUNK_SIZE", "5000"))
+ROUTE_CHUNK_SIZE = int(os.getenv("ROUTE_CHUNK_SIZE", "10000"))
+#Size of the slices of the raw reply fed to the parser
+FEED_SIZE = 64 * 1024
+
+
+class RpcReplyError(Exception):
+    pass
+
+
+def rpc_reply_raw(dev, rpc_name: str, timeout=None, **kwargs):
+    """
+    Sends an RPC over the open PyEZ device and returns the reply as the raw
+    string ncclient received. dev.rpc.<name>() would parse it into a tree and
+    then copy that tree once more to strip the namespaces, which is what makes
+    100k+ entry replies so expensive. ncclient still buffers the whole reply
+    before handing it over, the string grows with the table. Arguments follow
+    the dev.rpc convention: True for flags, anything else becomes the text of
+    the child element.
+    """
+    rpc = etree.Element(rpc_name.replace("_", "-"))
+    for name, value in kwargs.items():
+        arg = etree.SubElement(rpc, name.replace("_", "-"))
+        if value is not True:
+            arg.text = str(value)
+
+    conn = dev._conn
+    request = ExecuteRpc(conn._session, device_handler=conn._device_handler,
+                         async_mode=True, huge_tree=True)
+    request.request(rpc)
+    request.event.wait(timeout or dev.timeout)
+    if not request.event.is_set():
+        raise TimeoutExpiredError(f"{rpc_name} timed out waiting for the reply")
+    if request.error:
+        raise request.error
+    return request.reply._raw
+
+
+def iter_elements(raw, tag: str):
+    """
+    Yields every <tag> element of the raw reply, ignoring namespaces, while the
+    reply is parsed incrementally. An element is cleared once the caller is done
+    with it, so only one entry is held as a tree at a time.
+    Raises RpcReplyError for an rpc-error of severity error.
+    """
+    parser = etree.XMLPullParser(events=("end",), tag=(f"{{*}}{tag}", "{*}rpc-error"), huge_tree=True)
+    for offset in range(0, len(raw), FEED_SIZE):
+        chunk = raw[offset:offset + FEED_SIZE]
+        parser.feed(chunk.encode() if isinstance(chunk, str) else chunk)
+        yield from _drain(parser)
+    parser.close()
+    yield from _drain(parser)
+
+
+def _drain(parser):
+    for _, element in parser.read_events():
+        if element.tag.endswith("}rpc-error") or element.tag == "rpc-error":
+            if element.findtext("{*}error-severity", default="error").strip() == "error":
+                raise RpcReplyError(element.findtext("{*}error-message", default="rpc-error").strip())
+            continue
+        yield element
+        element.clear()
+        #Drop the already processed siblings too, clear() keeps the element itself
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+def iter_chunks(items, size: int):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+#child tag -> key of the entry dict
+MAC_ENTRY_FIELDS = {
+    "l2ng-l2-mac-vlan-name": "vlan",
+    "l2ng-l2-mac-address": "mac",
+    "l2ng-l2-mac-logical-interface": "interface",
+}
+
+
+def iter_mac_entries(raw):
+    """
+    MAC entries of a get-ethernet-switching-table-information reply (ELS/l2ng format).
+    """
+    for entry in iter_elements(raw, "l2ng-mac-entry"):
+        item = {"vlan": "N/A", "mac": "N/A", "interface": "N/A"}
+        #One pass over the children, findtext with a {*} wildcard scans them once per field
+        for child in entry.iterchildren(tag=etree.Element):
+            key = MAC_ENTRY_FIELDS.get(child.tag.rpartition("}")[2])
+            if key and child.text:
+                item[key] = child.text.strip()
+        yield item
+
+
+def iter_mac_chunks(raw, chunk_size=MAC_CHUNK_SIZE):
+    """
+    Yields the MAC table of a raw reply in lists of at most chunk_size entries.
+    Peak memory is the raw reply plus one chunk: O(raw reply), not bounded. What
+    the incremental parse saves is the tree and the dict list on top of the reply.
+    """
+    yield from iter_chunks(iter_mac_entries(raw), chunk_size)
+
+
+def _localname(element):
+    return element.tag.rpartition("}")[2]
+
+
+def _child_texts(element):
+    """
+    {child localname: stripped text} of the direct children, first one wins.
+    """
+    texts = {}
+    for child in element.iterchildren(tag=etree.Element):
+        name = _localname(child)
+        if name not in texts:
+            texts[name] = (child.text or "").strip()
+    return texts
+
+
+def iter_arp_entries(raw):
+    """
+    Entries of a get-arp-table-information reply.
+    """
+    for entry in iter_elements(raw, "arp-table-entry"):
+        texts = _child_texts(entry)
+        yield {
+            "ip": texts.get("ip-address", "N/A"),
+            "mac": texts.get("mac-address", "N/A"),
+            "interface": texts.get("interface-name", "N/A"),
+        }
+
+
+def _route_entry(rt_entry):
+    """
+    (protocol, preference, age, next_hop) of one rt-entry.
+    Next hop is the selected nh's <to>, else its <via>/local interface, else the nh-type (Discard, Receive...).
+    """
+    texts = _child_texts(rt_entry)
+    nexthops = list(rt_entry.iterchildren("{*}nh"))
+    selected = next((nh for nh in nexthops if nh.find("{*}selected-next-hop") is not None),
+                    nexthops[0] if nexthops else None)
+    next_hop = texts.get("nh-type", "")
+    if selected is not None:
+        nh = _child_texts(selected)
+        next_hop = nh.get("to") or nh.get("via") or nh.get("nh-local-interface") or next_hop
+    preference = texts.get("preference", "")
+    return (
+        texts.get("protocol-name", ""),
+        int(preference) if preference.isdigit() else None,
+        texts.get("age", ""),
+        next_hop,
+    )
+
+
+def iter_route_entries(raw):
+    """
+    One entry per destination of a get-route-information reply: the active
+    route (current-active), or the first one listed when none is active.
+    """
+    for rt in iter_elements(raw, "rt"):
+        destination = rt.findtext("{*}rt-destination", default="").strip()
+        prefix = rt.findtext("{*}rt-prefix-length")
+        if prefix and "/" not in destination:
+            destination = f"{destination}/{prefix.strip()}"
+        entries = list(rt.iterchildren("{*}rt-entry"))
+        if not entries:
+            continue
+        active = next((e for e in entries if e.find("{*}current-active") is not None), entries[0])
+        protocol, preference, age, next_hop = _route_entry(active)
+        yield {
+            "destination": destination,
+            "next_hop": next_hop,
+            "protocol": protocol,
+            "preference": preference,
+            "age": age,
+        }
+
+
+def route_slices(table: str):
+    """
+    Destinations that split a routing table into replies of bounded size: one
+    `longer` query per /8 plus the default route. Prefixes shorter than /8 other
+    than the default are not covered, they don't show up in real tables.
+    """
+    if table.startswith("inet6."):
+        yield {"destination": "::/0", "exact": True}
+        for first in range(256):
+            yield {"destination": f"{first:02x}00::/8", "longer": True}
+    else:
+        yield {"destination": "0.0.0.0/0", "exact": True}
+        for first in range(256):
+            yield {"destination": f"{first}.0.0.0/8", "longer": True}
+
+
+def iter_route_chunks(dev, tables, sliced=True, chunk_size=ROUTE_CHUNK_SIZE):
+    """
+    Fetches the routing tables and yields their routes in chunks.
+    ncclient buffers a whole reply before handing it over, so a full BGP table
+    is never requested in one go when sliced: every /8 is its own RPC and only
+    one slice's reply is held at a time.
+    """
+    for table in tables:
+        for args in (route_slices(table) if sliced else [{}]):
+            raw = rpc_reply_raw(dev, "get_route_information", table=table, **args)
+            yield from iter_chunks(iter_route_entries(raw), chunk_size)
+            del raw